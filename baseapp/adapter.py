@@ -0,0 +1,88 @@
+"""
+Converts between the database and the core data model (see core.py): loads
+core objects for a date with plain value queries, without building model
+instances, and saves draws made with them.
+"""
+from django.db import transaction
+from .models import Attendance, Debate, MatchDay, Veto, Room
+from .draw_context import DrawContext, load_history
+from .draw_result import DrawResult
+from .allocator import save_draw
+from .profiling import phase
+from . import core
+
+
+def load_attendances(attendances):
+    """
+    Loads the given Attendance queryset as core.Attendances, with their teams
+    and speakers, in two queries. The order of the queryset is kept.
+    """
+    rows = list(attendances.values_list('pk', 'date', 'want_to_judge', 'team', 'team__name',
+                                        'team__judged_before'))
+    speakers = {}
+    attendance_speakers = {pk: [] for pk, *_ in rows}
+    AttendanceSpeaker = Attendance.speakers.through
+    for attendance_id, speaker_id, name, team_id, qualification_score in \
+            AttendanceSpeaker.objects.filter(attendance__in=attendance_speakers)\
+                .order_by('pk')\
+                .values_list('attendance', 'speaker', 'speaker__name', 'speaker__team',
+                             'speaker__qualification_score'):
+        if speaker_id not in speakers:
+            speakers[speaker_id] = core.Speaker(speaker_id, name, team_id, qualification_score)
+        attendance_speakers[attendance_id].append(speakers[speaker_id])
+
+    teams = {}
+    result = []
+    for pk, date, want_to_judge, team_id, team_name, judged_before in rows:
+        if team_id not in teams:
+            teams[team_id] = core.Team(team_id, team_name, judged_before)
+        result.append(core.Attendance(pk, date, teams[team_id], attendance_speakers[pk], want_to_judge))
+    return result
+
+
+def load_vetoes(attendances):
+    """ Loads the vetoes between the speakers of the given core.Attendances, in one query. """
+    speakers = {speaker.pk: speaker for attendance in attendances for speaker in attendance.speakers}
+    return [core.Veto(pk, speakers[initiator_id], speakers[receiver_id])
+            for pk, initiator_id, receiver_id in
+                Veto.objects.filter(initiator__in=speakers, receiver__in=speakers)
+                    .values_list('pk', 'initiator', 'receiver')]
+
+
+def load_rooms(date):
+    """ Loads the rooms for the given date as core.Rooms. """
+    return [core.Room(pk, name) for pk, name in Room.objects.filter(date=date).values_list('pk', 'name')]
+
+
+def load_context(date, rng=None):
+    """
+    Returns the DrawContext of core objects for all the attendances on the
+    given date, other than those withdrawn. Loaded in a fixed number of queries, like DrawContext.for_date.
+    """
+    with phase('context'):
+        attendances = load_attendances(Attendance.objects.filter(date=date, withdrawn=False).order_by('pk'))
+        history = load_history({attendance.team.pk for attendance in attendances}, date)
+        return DrawContext.from_core(attendances, load_vetoes(attendances), history, date=date, rng=rng)
+
+
+def to_debates(match_day: MatchDay, debates):
+    """ Returns unsaved Debate instances for the given core.Debates. """
+    return [Debate(match_day=match_day, affirmative_id=debate.affirmative.pk, negative_id=debate.negative.pk,
+                   room_id=debate.room.pk if debate.room is not None else None)
+            for debate in debates]
+
+
+def commit_core_draw(draw: DrawResult):
+    """
+    Saves a draw made with core objects, as allocator.commit_draw does for a
+    draw made with model instances.
+
+    :param draw: the DrawResult to save, with core.Debates
+    :return: the MatchDay saved
+    """
+    with phase('persistence'), transaction.atomic():
+        match_day, created = MatchDay.objects.get_or_create(date=draw.date)
+        match_day.attendances_competing.set([attendance.pk for attendance in draw.attendances_competing])
+        match_day.attendances_judging.set([attendance.pk for attendance in draw.attendances_judging])
+        save_draw(match_day, to_debates(match_day, draw.debates), draw.panels, draw.vetoes_affected)
+    return match_day
@@ -1,13 +1,44 @@
 from django.contrib import admin
+from django.db.models import Prefetch
 
 from .models import Team, Speaker, Attendance, Debate, Score, MatchDay, Veto, Room
+from .draw_context import VetoIndex
+from .repair import repair_draw
+from .pinning import redo_unpinned_debates
+from .exceptions import CannotFindWorkingConfigurationException, NotEnoughJudgesException, NotEnoughRoomsException, \
+    NotEnoughAttendancesException, DrawLockedException
 from django.urls import path, include
 from django.utils import timezone
 from django.core.exceptions import ValidationError, NON_FIELD_ERRORS
 from django.contrib import messages
 from ajax_select import make_ajax_form
 
-class ScoreInstanceInlineForDebate(admin.TabularInline):
+class CachedChoicesMixin:
+    """
+    Evaluates the choices of the inline's related fields once for the request,
+    instead of once for every form in the inline.
+    """
+
+    def _cache_choices(self, formfield, request, db_field):
+        if formfield is None or db_field.remote_field.model is self.parent_model:
+            # The foreign key to the parent is not shown in the inline
+            return formfield
+        cache = request.__dict__.setdefault('_inline_choices', {})
+        key = (type(self), db_field.name)
+        if key not in cache:
+            cache[key] = list(formfield.choices)
+        formfield.choices = cache[key]
+        return formfield
+
+    def formfield_for_foreignkey(self, db_field, request, **kwargs):
+        formfield = super().formfield_for_foreignkey(db_field, request, **kwargs)
+        return self._cache_choices(formfield, request, db_field)
+
+    def formfield_for_manytomany(self, db_field, request, **kwargs):
+        formfield = super().formfield_for_manytomany(db_field, request, **kwargs)
+        return self._cache_choices(formfield, request, db_field)
+
+class ScoreInstanceInlineForDebate(CachedChoicesMixin, admin.TabularInline):
     model = Score
     extra = 0
     can_delete = False
@@ -15,9 +46,8 @@ class ScoreInstanceInlineForDebate(admin.TabularInline):
     def get_min_num(self, request, obj=None, **kwargs):
         max_num = 6
         if obj:
-            max_num = 0
-            for attendance in obj.get_attendances():
-                max_num += len(attendance.speakers.all())
+            max_num = Attendance.speakers.through.objects\
+                .filter(attendance__in=[obj.affirmative_id, obj.negative_id]).count()
 
         return max_num
 
@@ -42,7 +72,7 @@ class SpeakerInstanceInline(admin.TabularInline):
     extra = 0
     can_delete = False
 
-class DebateInstanceInline(admin.TabularInline):
+class DebateInstanceInline(CachedChoicesMixin, admin.TabularInline):
     model = Debate
     extra = 0
     can_delete = False
@@ -55,6 +85,11 @@ class DebateInstanceInline(admin.TabularInline):
     #     'judges': 'judges_for_debate'
     # })
 
+    def get_queryset(self, request):
+        return super().get_queryset(request)\
+            .select_related('match_day', 'affirmative__team', 'negative__team', 'room')\
+            .prefetch_related('judges')
+
     def get_max_num(self, request, obj=None, **kwargs):
         if obj and obj.date != timezone.localdate():
             return Debate.objects.filter(match_day=obj).count()
@@ -71,10 +106,10 @@ class DebateInstanceInline(admin.TabularInline):
         if db_field.name == "affirmative" or db_field.name == "negative":
             try:
                 match_day = MatchDay.objects.get(date=timezone.localdate())
-                kwargs["queryset"] = match_day.attendances_competing.all()
+                kwargs["queryset"] = match_day.attendances_competing.select_related('team')
             except MatchDay.DoesNotExist:
                 # Then no need to change queryset
-                pass
+                kwargs["queryset"] = Attendance.objects.select_related('team')
         # TODO: order these attendances
         # TODO: dynamic filtering based on selected teams/judges
         return super().formfield_for_foreignkey(db_field, request, **kwargs)
@@ -83,12 +118,7 @@ class DebateInstanceInline(admin.TabularInline):
         if db_field.name == "judges":
             try:
                 match_day = MatchDay.objects.get(date=timezone.localdate())
-                # Empty Speaker queryset
-                # FIXME: this looks like a hack more than anything hahaha.
-                qs = Speaker.objects.filter(id=0).all()
-                for attendance_judging in match_day.attendances_judging.all():
-                    qs |= attendance_judging.speakers.all()
-                kwargs["queryset"] = qs
+                kwargs["queryset"] = Speaker.objects.filter(attendance__judging_matchdays=match_day).distinct()
             except MatchDay.DoesNotExist:
                 pass
         return super().formfield_for_manytomany(db_field, request, **kwargs)
@@ -108,13 +138,20 @@ class DebateInstanceInline(admin.TabularInline):
                 instance.save()
 
 class MyTeamAdmin(admin.ModelAdmin):
-    list_display = ("name", "wins")
+    list_display = ("name", "wins", "rating")
     # list_filter = ("wins",)
     inlines = [SpeakerInstanceInline]
 
+    def get_queryset(self, request):
+        return super().get_queryset(request).select_related('standing')
+
     def wins(self, obj):
         return obj.get_wins()
-    wins.admin_order_field = '-debates_won'
+    wins.admin_order_field = '-standing__wins'
+
+    def rating(self, obj):
+        return round(obj.get_rating())
+    rating.admin_order_field = '-standing__rating'
 
 
     def has_add_permission(self, request, obj=None):
@@ -126,6 +163,7 @@ class MyDebateAdmin(admin.ModelAdmin):
         'match_day', 'affirmative', 'negative'
     )
     list_filter = ('match_day',)
+    list_select_related = ('match_day', 'affirmative__team', 'negative__team')
     # list_editable = (
     #     'affirmative', 'negative', 'judges',
     # )
@@ -135,6 +173,11 @@ class MyDebateAdmin(admin.ModelAdmin):
     def has_add_permission(self, request, obj=None):
         return False
 
+    def formfield_for_foreignkey(self, db_field, request, **kwargs):
+        if db_field.name == "affirmative" or db_field.name == "negative":
+            kwargs["queryset"] = Attendance.objects.select_related('team')
+        return super().formfield_for_foreignkey(db_field, request, **kwargs)
+
 
     def get_readonly_fields(self, request, obj):
         if obj.match_day.date != timezone.localdate():
@@ -170,6 +213,7 @@ class MySpeakerAdmin(admin.ModelAdmin):
     # inlines = [ScoreInstanceInlineForSpeaker]
     list_display = ("name", "team", "qualification_score", "get_avg_score")
     list_filter = ("team",)
+    list_select_related = ("team",)
 
     # Allow search for speakers by name
     search_fields = ('name',)
@@ -182,14 +226,44 @@ class MySpeakerAdmin(admin.ModelAdmin):
 
 class MyScoreAdmin(admin.ModelAdmin):
     list_display = ('speaker', 'debate')
+    list_select_related = ('speaker', 'debate__match_day')
 
     def has_add_permission(self, request, obj=None):
         return False
 
 
+def _report_repair(request, match_day, changes):
+    """ Tells the user what repair_draw (or redo_unpinned_debates) changed in the draw for the match day. """
+    messages.success(request, f"{match_day}: {changes['created']} debates created, " +
+                                f"{changes['updated']} updated, {changes['deleted']} deleted, " +
+                                f"{changes['panels_changed']} panels changed.")
+    for attendance in changes.get('judging', ()):
+        messages.warning(request, f"{match_day}: {attendance.team.name} will judge instead of competing, " +
+                                    "as there was no opponent or not enough judges for them.")
+
+
 class MyAttendanceAdmin(admin.ModelAdmin):
-    list_display = ("date", "team", "count_qualified_judges")
-    list_filter = ("date", "team")
+    list_display = ("date", "team", "count_qualified_judges", "withdrawn")
+    list_filter = ("date", "team", "withdrawn")
+    actions = ['withdraw_from_draw']
+
+    def withdraw_from_draw(self, request, queryset):
+        """ Takes the selected attendances out of the draws for their dates, leaving the rest of the draws as they are. """
+        # Without a draw yet, they are just left out when it is made
+        queryset.exclude(date__in=MatchDay.objects.values('date')).update(withdrawn=True)
+        for match_day in MatchDay.objects.filter(date__in=queryset.values('date')):
+            removed = [attendance for attendance in queryset if attendance.date == match_day.date]
+            try:
+                changes = repair_draw(match_day, added=(), removed=removed)
+            except (CannotFindWorkingConfigurationException, NotEnoughJudgesException,
+                        NotEnoughRoomsException, DrawLockedException) as e:
+                messages.error(request, f"{match_day}: {e}")
+            else:
+                _report_repair(request, match_day, changes)
+    withdraw_from_draw.short_description = "Withdraw selected attendances from their draws"
+
+    def get_queryset(self, request):
+        return super().get_queryset(request).select_related('team').prefetch_related('speakers')
 
     # # Allow search for attendances by team name
     # ordering = ['-date']
@@ -207,21 +281,66 @@ class MyAttendanceAdmin(admin.ModelAdmin):
 class MyMatchDayAdmin(admin.ModelAdmin):
     inlines = [DebateInstanceInline]
     fields = ('date', 'attendances_competing', 'attendances_judging')
+    actions = ['update_for_late_attendances', 'redo_unpinned']
+
+    def update_for_late_attendances(self, request, queryset):
+        """ Adds the late attendances (and teams left without an opponent) to the selected draws. """
+        for match_day in queryset:
+            try:
+                changes = repair_draw(match_day)
+            except (CannotFindWorkingConfigurationException, NotEnoughJudgesException,
+                        NotEnoughRoomsException, DrawLockedException) as e:
+                messages.error(request, f"{match_day}: {e}")
+            else:
+                _report_repair(request, match_day, changes)
+    update_for_late_attendances.short_description = "Update selected draws for late attendances"
+
+    def redo_unpinned(self, request, queryset):
+        """ Redoes the selected draws, keeping the pinned teams, judges and rooms. """
+        for match_day in queryset:
+            try:
+                changes = redo_unpinned_debates(match_day)
+            except (CannotFindWorkingConfigurationException, NotEnoughJudgesException,
+                        NotEnoughRoomsException, NotEnoughAttendancesException, DrawLockedException) as e:
+                messages.error(request, f"{match_day}: {e}")
+            else:
+                _report_repair(request, match_day, changes)
+    redo_unpinned.short_description = "Redo the unpinned debates of selected draws"
+
     def get_readonly_fields(self, request, obj):
         if obj and obj.date != timezone.localdate():
             return ('date', 'attendances_judging', 'attendances_competing')
         else:
             return ('date',)
 
+    def get_queryset(self, request):
+        return super().get_queryset(request).prefetch_related(
+            Prefetch('attendances_competing', queryset=Attendance.objects.select_related('team')),
+            Prefetch('attendances_judging', queryset=Attendance.objects.select_related('team')))
+
     def formfield_for_manytomany(self, db_field, request, **kwargs):
         if db_field.name == "attendances_competing" or db_field.name == "attendances_judging":
-            kwargs["queryset"] = Attendance.objects.filter(date=timezone.localdate())
+            kwargs["queryset"] = Attendance.objects.filter(date=timezone.localdate()).select_related('team')
         return super().formfield_for_manytomany(db_field, request, **kwargs)
 
+    def save_related(self, request, form, formsets, change):
+        super().save_related(request, form, formsets, change)
+
+        # Warn about debates that go against a veto
+        match_day = form.instance
+        debates = match_day.debate_set.select_related('affirmative', 'negative', 'room')
+        veto_index = VetoIndex.for_attendances(
+            match_day.attendances_competing.prefetch_related('speakers'))
+        for debate in debates:
+            for veto in veto_index.get_blocking_vetoes(debate.affirmative, debate.negative):
+                messages.warning(request, f"Debate in room {debate.room.name if debate.room else '-'} " +
+                                            f"goes against veto: {veto}.")
+
 
 class MyVetoAdmin(admin.ModelAdmin):
     autocomplete_fields = ('initiator', 'receiver')
     list_display = ('initiator', 'receiver', 'affected_debates')
+    list_select_related = ('initiator', 'receiver')
     list_display_links = ('initiator', 'receiver')
 
 
@@ -1,9 +1,24 @@
 from .models import Attendance, Speaker, Team, Debate, MatchDay, Veto, Room
 from django.utils import timezone
+from django.db import transaction
+from django.db.models import F
 from typing import List
+import logging
 import math
 from operator import itemgetter, attrgetter
-from .exceptions import NotEnoughJudgesException, CannotFindWorkingConfigurationException, NotEnoughAttendancesException, NotEnoughRoomsException
+from .exceptions import NotEnoughJudgesException, CannotFindWorkingConfigurationException, NotEnoughAttendancesException, NotEnoughRoomsException, VetoConflictException, \
+    DrawLockedException
+from .draw_context import DrawContext
+from . import core
+from .draw_result import DrawResult
+from .pairing import PAIRING_STRATEGIES
+from .judge_allocation import allocate_judges
+from .judge_selection import select_judging_attendances
+from .local_search import improve_draw
+from .feasibility import find_conflicting_vetoes
+from .profiling import phase, record_phases, is_profiling_enabled
+from . import draw_cache
+from .ratings import get_ranking
 
 # Weightings
 WEIGHTS = {
@@ -13,8 +28,10 @@ WEIGHTS = {
     'one_present': 12,
 }
 
+logger = logging.getLogger(__name__)
+
 def count_qualified_judges(attendance: Attendance):
-    sum(1 for speaker in attendance.speakers.all() if speaker.is_qualified_as_judge())
+    return sum(1 for speaker in attendance.speakers.all() if speaker.is_qualified_as_judge())
 
 # FIXME: algo would end up always having most qualified teams to judge?
 # --> Actually maybe not - since we take into account never_judged
@@ -34,22 +51,31 @@ def assign_judging_priority(attendance: Attendance):
 
     return score
 
-def rank_attendances(attendances_competing):
+# Ways of ranking teams, each giving a team's sort key - the higher, the better
+RANKING_KEYS = {
+    # Number of wins, then speakers' average score
+    'wins': lambda context, team: (context.get_wins(team), context.get_speakers_avg_score(team)),
+    # Elo rating (see ratings.py)
+    'rating': lambda context, team: (context.get_rating(team),),
+}
+
+def rank_attendances(attendances_competing, context: DrawContext, ranking=None):
     """ 
-    Returns a new list of attendances, where the attendances are ranked by
-    the attendance's team's number of wins in the tournament in descending order, 
-    then by the attendance's team's speakers' average score for the past debates 
-    in the tournament, in descending order.
+    Returns a new list of attendances, ranked by their teams in descending
+    order of the ranking key given. By default, that is the team's number of
+    wins in the tournament, then the team's speakers' average score for the
+    past debates in the tournament.
 
     Original list 'attendances_competing' is not affected.
+
+    :param ranking: name of the ranking in RANKING_KEYS - ratings.get_ranking() if None
     """
+    key = RANKING_KEYS[ranking or get_ranking()]
     sorting_list = []
     for attendance in attendances_competing:
-        team = attendance.team
-        sorting_list.append((team.get_wins(), team.get_speakers_avg_score(), attendance))
-    # Sort teams by wins then by average speaker score
-    sorting_list.sort(key=itemgetter(0, 1), reverse=True)
-    return [item[2] for item in sorting_list]
+        sorting_list.append((key(context, attendance.team), attendance))
+    sorting_list.sort(key=itemgetter(0), reverse=True)
+    return [item[1] for item in sorting_list]
 
 def _number_of_debates(attendances_count: int):
     return math.floor(attendances_count / 2)
@@ -64,49 +90,14 @@ def get_qualified_judges(attendance):
             qualified_judges.append(judge)
     return qualified_judges
 
-def get_attr_for_attendance(debate: Debate, attendance: Attendance):
-    """
-    Returns the attribute name (either 'affirmative' or 'negative') of the given attendance
-    in the debate given.
-    i.e. if debate.affirmative == attendance, then this function return 'affirmative', etc.
-
-    Raises an ValueError if given attendance is not in the given debate.
-    """
-    affirmative = debate.affirmative
-    negative = debate.negative
-    if attendance == affirmative:
-        return "affirmative"
-    elif attendance == negative:
-        return "negative"
-    else:
-        raise ValueError("Given attendance is not in the given debate.")
-
-def get_vetoed_speakers_for_attendance(attendance: Attendance):
-    vetoed_speakers = []
-    for speaker in attendance.speakers.all():
-        initiated_vetoes = Veto.objects.filter(initiator=speaker).all()
-        for veto in initiated_vetoes:
-            vetoed_speakers.append(veto.receiver)
-    return vetoed_speakers
-
-def is_vetoed(initiator: Attendance, receiver: Attendance):
+def is_vetoed(initiator: Attendance, receiver: Attendance, context: DrawContext):
     """
         Returns True if any speaker in 'initiator' has initiated a veto against any speaker in 'receiver'.
         Return False otherwise.
     """
-    initiator_vetoed_speakers = get_vetoed_speakers_for_attendance(initiator)
-    for speaker in receiver.speakers.all():
-        if speaker in initiator_vetoed_speakers:
-            return True
-    return False
+    return context.vetoes.is_vetoed(initiator, receiver)
 
-def is_speaker_in_attendance(speaker: Speaker, attendance: Attendance):
-    """ 
-    Returns True if given speaker is in the given attendancee, False otherwise.
-    """
-    return attendance.speakers.filter(pk=speaker.pk).exists()
-
-def get_vetoes(init_attendance: Attendance, rec_attendance: Attendance):
+def get_vetoes(init_attendance: Attendance, rec_attendance: Attendance, context: DrawContext):
     """
     Finds all of the Veto instances where the initiator is a speaker in init_attendance
     and the receiver is a speaker in rec_attendance.
@@ -114,63 +105,7 @@ def get_vetoes(init_attendance: Attendance, rec_attendance: Attendance):
     Returns an empty list if no speaker in init_attendance has initiated a veto
     against any speaker in rec_attendance.
     """
-    vetoes = []
-    for speaker in init_attendance.speakers.all():
-        vetoes_initiated = Veto.objects.filter(initiator=speaker).all()
-        if vetoes_initiated:
-            for veto in vetoes_initiated:
-                if is_speaker_in_attendance(veto.receiver, rec_attendance):
-                    vetoes.append(veto)
-    return vetoes
-
-
-
-def find_highest_ranked_non_vetoed_attendance_in_debate(initiator: Attendance, debate: Debate):
-    """
-    Finds the highest ranked attendance in 'debate' that 'initiator' has not vetoed.
-    Returns a string, either 'affirmative' or 'negative', which indicates the corresponding attendance.
-    If both teams in the debate have the same ranking, returns 'affirmative' (for now).
-    Returns None if no such attendance can be found in the 'debate' given.
-
-    :ensures: returns either 'affirmative', 'negative', or None
-    """
-    attendances = rank_attendances([debate.affirmative, debate.negative])
-    for attendance in attendances:
-        if not is_vetoed(initiator, attendance):
-            return get_attr_for_attendance(debate, attendance)
-    return None
-
-
-def find_attendance_to_swap(attendance_to_swap: Attendance, debate_choices: List[Debate]):
-    """
-    This function is for veto purposes.
-    Finds the highest ranked attendance in the debates in 'debate_choices' that 'attendance_to_swap' has not vetoed.
-    Returns a tuple that contains (in this order): 
-        - the debate that the found attendance is in
-        - a string, either 'affirmative' or 'negative', that signifies which of the attendances in the debate
-          is the found attendance
-
-    If no such attendance can be found, returns None.
-    """
-    for debate in debate_choices:
-        attendance_available = find_highest_ranked_non_vetoed_attendance_in_debate(attendance_to_swap, debate)
-        if attendance_available is not None:
-            return (debate, attendance_available)
-
-    # If function has not returned yet, then no attendance can be found to swap with 'attendance_to_swap'
-    return None      
-
-def can_host_debates(attendances_competing, judges_count: int):
-    """
-    Returns True if both of these conditions are true:
-        1. 'judge_count' is large enough to host the debates where 'attendances_competing'
-        would partake in
-        2. 'attendances_competing' has an even number of elements.
-    Returns False otherwise.
-    """
-    attendances_competing_count = len(attendances_competing)
-    return (judges_count >=  _number_of_debates(attendances_competing_count) \
-            and attendances_competing_count % 2 == 0)
+    return context.vetoes.get_vetoes(init_attendance, rec_attendance)
 
 def _assign_competing_teams(attendances: List[Attendance]):
     """
@@ -190,105 +125,80 @@ def _assign_competing_teams(attendances: List[Attendance]):
     for attendance in attendances:
         qualified_attendances.append(attendance) if get_qualified_judges(attendance) \
             else unqualified_attendances.append(attendance)
-    # Sort qualified attendance based on judging score
-    qualified_attendances.sort(key=assign_judging_priority, reverse=True)
-
-    qualified_attenances_count = len(qualified_attendances)
-    attendances_competing = qualified_attendances + unqualified_attendances
-    attendances_judging = []
-    qualified_judges_count = 0
-
-    SEEK_FORWARD_LIMIT = 3
-
-    # Pop until we have enough qualified judges or we have no teams left
-    while (not can_host_debates(attendances_competing, qualified_judges_count)) \
-            and qualified_attenances_count > 0:
-        indexToRemove = 0
-        delta = _number_of_debates(len(attendances_competing)) - qualified_judges_count
-        if len(attendances_competing) % 2 != 0 and 0 < delta <= 3:
-            # In this case we may be able to only pop one more team from PQ
-            # Seek forward to see which team (if any) matches required number of qualified judges
-            for i in range(1, min(SEEK_FORWARD_LIMIT, qualified_attenances_count)):
-                potential_attendance = attendances_competing[i]
-                if count_qualified_judges(potential_attendance) == delta:
-                    indexToRemove = i
-                    break
-        # Remove item at indexToRemove from PQ (defaults to 0, but if seek forward finds a better match this would be non-zero)
-        judging_attendance = attendances_competing.pop(indexToRemove)
-        qualified_attenances_count -= 1
-        attendances_judging.append(judging_attendance)
-        for judge in judging_attendance.speakers.all():
-            if judge.is_qualified_as_judge():
-                qualified_judges_count += 1
-
-    # Check if assigning process gave valid results
-    # i.e. check if loop exited just because it has exhuasted all the qualified attendances available
-    if not can_host_debates(attendances_competing, qualified_judges_count):
-        return NotEnoughJudgesException("Not enough qualified judges to host debates.")
+
+    # Choose the fewest attendances to judge that leave enough judges for the
+    # debates, preferring the attendances with the highest judging priority
+    judging_indices = select_judging_attendances(
+        len(attendances),
+        [count_qualified_judges(attendance) for attendance in qualified_attendances],
+        [assign_judging_priority(attendance) for attendance in qualified_attendances]
+    )
+    if judging_indices is None:
+        raise NotEnoughJudgesException("Not enough qualified judges to host debates.")
+
+    judging_indices = set(judging_indices)
+    attendances_judging = [attendance for i, attendance in enumerate(qualified_attendances)
+                                if i in judging_indices]
+    attendances_competing = [attendance for i, attendance in enumerate(qualified_attendances)
+                                if i not in judging_indices] + unqualified_attendances
 
     # Result valid
     return (attendances_competing, attendances_judging)
-    
-    
 
-def assign_teams_for_date(date, ignore_rooms=False):
-    attendances_today = Attendance.objects.filter(date=date)
-    rooms_today_count = Room.objects.filter(date=date).count()
 
-    attendances_competing, attendances_judging = _assign_competing_teams(attendances_today)
+def _split_attendances(context: DrawContext, rooms_count: int, ignore_rooms=False):
+    """
+    Splits the attendances in the context into those competing and those judging,
+    checking that there are enough rooms for the debates.
+
+    :return: a tuple of (attendances competing, attendances judging)
+    """
+    with phase('split'):
+        attendances_competing, attendances_judging = _assign_competing_teams(context.attendances)
 
     # Check if there are enough rooms
-    if not ignore_rooms and _number_of_debates(len(attendances_competing)) > rooms_today_count:
+    if not ignore_rooms and _number_of_debates(len(attendances_competing)) > rooms_count:
         raise NotEnoughRoomsException("Not enough rooms available for debates.")
 
-    # Assigning process gives valid result - now save to new MatchDay instance
-    match_day = MatchDay(date=date)
-    match_day.save()
-    match_day.attendances_competing.set(attendances_competing)
-    match_day.attendances_judging.set(attendances_judging)
-    match_day.save()
-
-    return match_day
+    return (attendances_competing, attendances_judging)
 
-def compare_aff_neg(team: Team):
+def compare_aff_neg(team: Team, context: DrawContext):
         """
         Finds the number of times the team given has been the affirmative/negative side
         in the debates in the tournament.
 
         Returns the affirmative count - negative count.
         """
-        aff_count = Debate.objects.filter(affirmative__team=team).count()
-        neg_count = Debate.objects.filter(negative__team=team).count()
-        return aff_count - neg_count
+        return context.compare_aff_neg(team)
 
-def get_attendance_higher_aff_neg_diff(attendance1: Attendance, attendance2: Attendance):
+def get_attendance_higher_aff_neg_diff(attendance1: Attendance, attendance2: Attendance, context: DrawContext):
     """
     Returns the attendance out of 'attendance1' and 'attendance2' whose team has the 
     higher affirmative_count - negative_count difference.
 
-    If both teams have the same aff_neg difference, then returns one of the two at random.
+    If both teams have the same aff_neg difference, then returns one of the two at random,
+    using the context's random number generator.
 
     For the definition of the aforementioned difference, consult documentation for 
     Team.compare_aff_neg.
 
     :ensures: returned value is either 'attendance1' or 'attendance2'
     """
-    if compare_aff_neg(attendance1.team) > compare_aff_neg(attendance2.team):
+    if compare_aff_neg(attendance1.team, context) > compare_aff_neg(attendance2.team, context):
         return attendance1
-    elif compare_aff_neg(attendance1.team) < compare_aff_neg(attendance2.team):
+    elif compare_aff_neg(attendance1.team, context) < compare_aff_neg(attendance2.team, context):
         return attendance2
     else:
-        from random import randint
-        return [attendance1, attendance2][randint(0,1)]
+        return [attendance1, attendance2][context.rng.randint(0,1)]
 
-def assign_aff_neg(debate: Debate, attendance1: Attendance, attendance2: Attendance):
+def assign_aff_neg(debate: Debate, attendance1: Attendance, attendance2: Attendance, context: DrawContext):
     """
     Assigns which of attendance1 or attendance2 would be affirmative or negative in the debate.
     """
     # Check each team's affirmative/negative diff in past debates
     # Try to make it so that each team has roughly an equal share of
     # being affirmative or negative in the tournament's debates
-    if get_attendance_higher_aff_neg_diff(attendance1, attendance2) == attendance1:
+    if get_attendance_higher_aff_neg_diff(attendance1, attendance2, context) == attendance1:
         debate.negative = attendance1
         debate.affirmative = attendance2
     else:
@@ -298,131 +208,307 @@ def assign_aff_neg(debate: Debate, attendance1: Attendance, attendance2: Attenda
     return debate
 
 
-def is_debated_before(team1: Team, team2: Team):
-    qs = Debate.objects.filter(affirmative__team=team1, negative__team=team2) |\
-            Debate.objects.filter(affirmative__team=team2, negative__team=team1)
-    return qs.exists()
+def is_debated_before(team1: Team, team2: Team, context: DrawContext):
+    return context.is_debated_before(team1, team2)
 
-def _matchmake(match_day: MatchDay, ignore_rooms=False):
+def check_vetoes(attendances_competing, context: DrawContext):
     """
-    Assigns the debates for the day.
+    Checks that the attendances competing can be paired up without going against
+    any vetoes, before any pairing is done.
 
-    :param match_day: the MatchDay to generate debates for
-    :return: the generated MatchDay
+    :raises VetoConflictException: if they cannot - the exception holds a minimal
+            set of conflicting vetoes
+    """
+    conflicting_vetoes = find_conflicting_vetoes(attendances_competing, context.vetoes)
+    if conflicting_vetoes:
+        raise VetoConflictException(conflicting_vetoes)
+
+def check_draw_editable(match_day: MatchDay):
+    """
+    Checks that the draw for the match day can still be changed (see
+    MatchDay.is_draw_editable), as the debates of past draws are read-only.
+
+    :raises DrawLockedException: if it cannot
+    """
+    if not match_day.is_draw_editable():
+        raise DrawLockedException(
+            f"The draw for {match_day} can no longer be changed, as it is not for today or has results.")
+
+def plan_draw(attendances_competing, judges, context: DrawContext, strategy='greedy', improve=False):
+    """
+    Pairs up the attendances competing, chooses their sides and allocates the
+    judges, without any database access. This is the core of the allocator:
+    it works the same on model instances and on core objects (see core.py).
+
+    :param attendances_competing: the attendances competing
+    :param judges: the qualified judges available
+    :param context: snapshot of the attendances for the day - the debates planned
+                    are recorded in it
+    :param strategy: name of the pairing strategy in pairing.PAIRING_STRATEGIES to use
+    :param improve: if True, the draw is improved with local search (local_search.improve_draw).
+                    Local search is always used if the pairing has debates against vetoes.
+    :return: a tuple of (list of (affirmative, negative) tuples highest ranked debate first,
+             panels of judges for each debate, vetoes affected)
+    :raises VetoConflictException: if no draw can satisfy the vetoes
+    :raises CannotFindWorkingConfigurationException: if the vetoes cannot be satisfied
     :requires:  - len(attendances_competing) is greater than zero and even
                 - len(judges) >= floor(len(attendances) / 2)
-                - number of rooms for the day is at least the number of debates
-
     """
-    # Clear any existing debates for the day
-    Debate.objects.filter(match_day=match_day).delete()
+    return _plan(attendances_competing, judges, context, strategy, improve)
 
-    attendances_competing = match_day.attendances_competing.all()
+def plan_pairings(attendances_competing, context: DrawContext, strategy='greedy', improve=False):
+    """
+    Pairs up the attendances competing and chooses their sides like plan_draw,
+    but leaves the judges to the caller - e.g. for pinning.redo_unpinned_debates,
+    which allocates them along with the debates that keep their teams.
+
+    :return: a tuple of (list of (affirmative, negative) tuples highest ranked debate first,
+             vetoes affected)
+    :raises VetoConflictException: if no draw can satisfy the vetoes
+    :raises CannotFindWorkingConfigurationException: if the vetoes cannot be satisfied
+    :requires: len(attendances_competing) is greater than zero and even
+    """
+    sides, _, vetoes_affected = _plan(attendances_competing, None, context, strategy, improve)
+    return (sides, vetoes_affected)
+
+def _plan(attendances_competing, judges, context: DrawContext, strategy, improve):
+    """ Does the work of plan_draw - without allocating judges if 'judges' is None. """
+    # Fail fast if no draw can satisfy the vetoes
+    with phase('veto_check'):
+        check_vetoes(attendances_competing, context)
+
+    # Rank teams - teams that are level are ranked at random
+    with phase('ranking'):
+        attendances_competing = list(attendances_competing)
+        context.rng.shuffle(attendances_competing)
+        attendances_competing = rank_attendances(attendances_competing, context)
+
+    # Pair up teams
+    with phase('pairing'):
+        pairs = PAIRING_STRATEGIES[strategy](attendances_competing, context)
+    if pairs is None:
+        raise CannotFindWorkingConfigurationException(
+            "Cannot allocate debates that satisfy veto criteria - you may wish to change the vetoes."
+        )
+
+    # Choose the sides for each debate
+    with phase('sides'):
+        sides = []
+        for attendance1, attendance2 in pairs:
+            debate = assign_aff_neg(core.Debate(), attendance1, attendance2, context)
+            sides.append((debate.affirmative, debate.negative))
+
+    # Assign judges, avoiding judges with vetoes against the speakers in the debate
+    if judges is None:
+        judges, panels = [], [[] for _ in sides]
+    else:
+        with phase('judge_allocation'):
+            panels = allocate_judges(judges, sides, context)
+
+    # Improve the draw with local search - also needed to move teams apart
+    # that have vetoes between them, which the greedy strategy ignores
+    vetoes_clashing = [context.vetoes.get_blocking_vetoes(affirmative, negative)
+                        for affirmative, negative in sides]
+    vetoes_affected = []
+    if improve or any(vetoes_clashing):
+        with phase('veto_repair'):
+            improved_sides, panels = improve_draw(attendances_competing, sides, panels, judges, context)
+        improved_debates = {frozenset((affirmative.pk, negative.pk)) for affirmative, negative in improved_sides}
+        for (affirmative, negative), vetoes_for_debate in zip(sides, vetoes_clashing):
+            if vetoes_for_debate and frozenset((affirmative.pk, negative.pk)) not in improved_debates:
+                logger.info("Moved apart %s and %s, who have a veto between them",
+                            affirmative.team.name, negative.team.name)
+                vetoes_affected.extend(vetoes_for_debate)
+        sides = improved_sides
+
+    if any(context.vetoes.is_blocked(affirmative, negative) for affirmative, negative in sides):
+        raise CannotFindWorkingConfigurationException(
+            "Cannot allocate debates that satisfy veto criteria - you may wish to change the debates generated."
+        )
+
+    for affirmative, negative in sides:
+        context.record_debate(affirmative, negative)
+
+    return (sides, panels, vetoes_affected)
+
+def _get_judges(attendances_judging):
+    """ Returns the qualified judges of the attendances judging. """
     judges = []
-
-    for attendance in match_day.attendances_judging.all():
+    for attendance in attendances_judging:
         for judge in get_qualified_judges(attendance):
             judges.append(judge)
+    return judges
 
-    rooms = list(Room.objects.filter(date=match_day.date))
-
-    # Rank teams
-    attendances_competing = rank_attendances(attendances_competing)
-    number_of_debates = _number_of_debates(len(attendances_competing))
+def _plan_debates(attendances_competing, attendances_judging, rooms, context: DrawContext,
+                    ignore_rooms=False, strategy='greedy', improve=False, debate_class=Debate):
+    """
+    Works out the debates for the day in memory, without writing to the database.
+
+    :param attendances_competing: the attendances competing
+    :param attendances_judging: the attendances judging
+    :param rooms: the rooms available for the day
+    :param context: snapshot of the attendances for the day - the debates planned
+                    are recorded in it
+    :param strategy: name of the pairing strategy in pairing.PAIRING_STRATEGIES to use
+    :param improve: if True, the draw is improved with local search (see plan_draw)
+    :param debate_class: the class of the debates made - Debate, or core.Debate for core objects
+    :return: a tuple of (unsaved debates, panels of judges for each debate, vetoes affected)
+    :raises VetoConflictException: if no draw can satisfy the vetoes
+    :raises CannotFindWorkingConfigurationException: if the vetoes cannot be satisfied
+    :requires:  - len(attendances_competing) is greater than zero and even
+                - len(judges) >= floor(len(attendances) / 2)
+                - len(rooms) is at least the number of debates, unless ignore_rooms
+    """
+    sides, panels, vetoes_affected = plan_draw(attendances_competing, _get_judges(attendances_judging),
+                                               context, strategy=strategy, improve=improve)
 
+    # Generate the debate objects - these are only saved once the whole draw is done
     debates = []
-    # Generate the debate objects
-    for i in range(0, number_of_debates):
-        attendance1 = attendances_competing.pop(0)
-        # Find opponent
-        TEAM_WINS_DELTA_LIMIT = 1
-        for j, attendance in enumerate(attendances_competing):
-            # TODO: can optimise so that we don't go through entire list
-            if not is_debated_before(attendance1.team, attendance.team) and \
-                    abs(attendance1.team.get_wins() - attendance.team.get_wins()) <= \
-                        TEAM_WINS_DELTA_LIMIT:
-                attendance2 = attendances_competing.pop(j)
-                break
-        else:
-            # No opponent found that attendance1's team has not VS'ed before
-            # In this case just debate with the highest ranked team
-            attendance2 = attendances_competing.pop(0)
-
-
-        debate = Debate()
-        debate.match_day = match_day
-
-        assign_aff_neg(debate, attendance1, attendance2)
-        debate.save() # For ManyToManyRelation for judges
-
-        # Assign judges - do this circularly (i.e. if there are excess judges
-        # assign to higher ranked debates in order)
-        judge_indices = range(i, len(judges), number_of_debates)
-        for judge_index in judge_indices:
-            debate.judges.add(judges[judge_index])
-        
+    for i, (affirmative, negative) in enumerate(sides):
+        debate = debate_class(affirmative=affirmative, negative=negative)
+
         if not ignore_rooms:
             # Assign room
             debate.room = rooms[i]
 
-        debate.save()
         debates.append(debate)
 
-    # Check for vetoes
-    # The reason to use another for loop is to make sure that all the debates
-    # are generated beforehand, so that if the algorithm can't find a working
-    # solution in the end, at least it can give a partially working one
-    for i, debate in enumerate(debates):
-        affirmative = debate.affirmative
-        negative = debate.negative
-
-        vetoes_for_debate = get_vetoes(affirmative, negative) + get_vetoes(negative, affirmative)
-
-        if vetoes_for_debate:
-            print("veto: ", affirmative.team.name, negative.team.name)
-            # Swap lower ranked team in debate with the highest ranked non-vetoed
-            # attendance ranked below
-            debates_below = [debates[j] for j in range(i+1, len(debates))]
-            lower_ranked_team = rank_attendances([affirmative, negative])[1]
-            lower_ranked_team_attr = get_attr_for_attendance(debate, lower_ranked_team)
-            swap_details = find_attendance_to_swap(lower_ranked_team, debates_below)
-            if swap_details is not None:
-                debate_to_swap, attendance_attr = swap_details
-                attendance_to_swap = getattr(debate_to_swap, attendance_attr)
-                print("swap: ", lower_ranked_team.team.name, attendance_to_swap.team.name)
-                # Swap lower_ranked_team with attendace_to_swap
-                if lower_ranked_team_attr == "affirmative":
-                    debate.affirmative = attendance_to_swap
-                elif lower_ranked_team_attr == "negative":
-                    debate.negative = attendance_to_swap
-                if attendance_attr == "affirmative":
-                    debate_to_swap.affirmative = lower_ranked_team
-                elif attendance_attr == "negative":
-                    debate_to_swap.negative = lower_ranked_team
-                # TODO: Add to debates_affected counter for Veto
-                for veto in vetoes_for_debate:
-                    veto.affected_debates += 1
-                    veto.save()
-                # Now reassign aff and neg sides for the affected debates
-                assign_aff_neg(debate, debate.affirmative, debate.negative).save()
-                assign_aff_neg(debate_to_swap, debate_to_swap.affirmative, debate_to_swap.negative).save()
-            else:
-                # No available attendance to swap with - raise exception for now
-                raise CannotFindWorkingConfigurationException(
-                    "Cannot allocate debates that satisfy veto criteria - you may wish to change the debates generated."
-                )
-                # TODO: use a status code instead?
+    return (debates, panels, vetoes_affected)
+
+def create_debates(match_day: MatchDay, debates: List[Debate]):
+    """
+    Inserts the given unsaved debates for the match day in bulk, making sure
+    their primary keys are set afterwards.
+    """
+    Debate.objects.bulk_create(debates)
+    if any(debate.pk is None for debate in debates):
+        # The database backend does not return primary keys from bulk inserts,
+        # but they are assigned in increasing order
+        pks = list(Debate.objects.filter(match_day=match_day).order_by('-pk')
+                    .values_list('pk', flat=True)[:len(debates)])
+        for debate, pk in zip(debates, reversed(pks)):
+            debate.pk = pk
+            debate._state.adding = False
+            debate._state.db = Debate.objects.db
+
+def save_draw(match_day: MatchDay, debates: List[Debate], panels, vetoes_affected: List[Veto]):
+    """
+    Saves a draw computed in memory, replacing any existing debates for the match day.
+    Everything is written in a single transaction, with a fixed number of statements
+    regardless of the number of debates.
+
+    :param match_day: the MatchDay the debates are for
+    :param debates: the unsaved Debate instances
+    :param panels: the judges for each debate in 'debates'
+    :param vetoes_affected: the Vetoes whose affected_debates counter should be incremented
+    """
+    with transaction.atomic():
+        # Clear any existing debates for the day
+        Debate.objects.filter(match_day=match_day).delete()
+
+        create_debates(match_day, debates)
+
+        DebateJudge = Debate.judges.through
+        DebateJudge.objects.bulk_create([
+            DebateJudge(debate_id=debate.pk, speaker_id=judge.pk)
+            for debate, panel in zip(debates, panels) for judge in panel
+        ])
+
+        if vetoes_affected:
+            Veto.objects.filter(pk__in={veto.pk for veto in vetoes_affected})\
+                .update(affected_debates=F('affected_debates') + 1)
 
+        # Bulk writes send no signals
+        draw_cache.invalidate_draw(match_day.date)
+
+def build_draw(context: DrawContext, rooms, ignore_rooms=False, strategy='greedy', improve=False,
+                debate_class=Debate):
+    """
+    Works out a draw for the attendances in the given context, without any
+    database access.
+
+    :param context: snapshot of the attendances for the day - the draw is recorded in it,
+                    so a context should only be used for one draw
+    :param rooms: the rooms available for the day
+    :param strategy: the pairing strategy, as for generate_debates
+    :param ignore_rooms: if True, rooms are neither checked nor assigned
+    :param improve: if True, the draw is improved with local search
+    :param debate_class: the class of the debates made - core.Debate for a context of core
+                         objects (see DrawContext.from_core)
+    :return: a DrawResult, which can be saved with commit_draw (or adapter.commit_core_draw
+             for core objects)
+    """
+    attendances_competing, attendances_judging = _split_attendances(context, len(rooms), ignore_rooms)
+    debates, panels, vetoes_affected = _plan_debates(attendances_competing, attendances_judging, rooms,
+                                                     context, ignore_rooms=ignore_rooms, strategy=strategy,
+                                                     improve=improve, debate_class=debate_class)
+    return DrawResult(context.date, attendances_competing, attendances_judging, debates, panels,
+                      vetoes_affected, context, strategy=strategy)
+
+def preview_debates(date, rng=None, strategy='greedy', ignore_rooms=False, improve=False):
+    """
+    Works out the debates for the given date without writing anything to the
+    database, so that the draw can be looked over before it is saved.
+
+    :param date: the date to generate debates for
+    :param rng: random.Random instance for random choices - pass a seeded one
+                to reproduce a draw exactly
+    :param strategy: the pairing strategy, as for generate_debates
+    :param ignore_rooms: if True, rooms are neither checked nor assigned
+    :param improve: if True, the draw is improved with local search
+    :return: a DrawResult, which can be saved with commit_draw. Unless profiling is turned
+             off (see profiling.is_profiling_enabled), its 'phases' hold the time and queries
+             of each phase of the allocator, which are logged at DEBUG level.
+    """
+    with record_phases(enabled=is_profiling_enabled()) as recorder:
+        with phase('context'):
+            context = DrawContext.for_date(date, rng=rng)
+            rooms = list(Room.objects.filter(date=date))
+        draw = build_draw(context, rooms, ignore_rooms=ignore_rooms, strategy=strategy, improve=improve)
+    if recorder is not None:
+        draw.phases = recorder
+        logger.debug("Draw for %s made in %.0fms: %s", date, recorder.total_time * 1000, recorder)
+    return draw
+
+def commit_draw(draw: DrawResult):
+    """
+    Saves a draw from preview_debates, creating the MatchDay for its date if needed.
+    Any existing debates for the day are replaced. Everything is written in a
+    single transaction.
+
+    :param draw: the DrawResult to save - the time it takes is added to its phases, if any
+    :return: the MatchDay saved
+    :requires: 'draw' has not been committed before
+    """
+    with record_phases(draw.phases, enabled=draw.phases is not None), \
+            phase('persistence'), transaction.atomic():
+        match_day, created = MatchDay.objects.get_or_create(date=draw.date)
+        match_day.attendances_competing.set(draw.attendances_competing)
+        match_day.attendances_judging.set(draw.attendances_judging)
+        for debate in draw.debates:
+            debate.match_day = match_day
+        save_draw(match_day, draw.debates, draw.panels, draw.vetoes_affected)
+    if draw.phases is not None:
+        logger.debug("Draw for %s saved in %.0fms", draw.date, draw.phases.phases['persistence']['time'] * 1000)
     return match_day
 
-def generate_debates(date, **kwargs):
+def generate_debates(date, rng=None, strategy='greedy', **kwargs):
     """
     Generates debates given the date.
     Instantiates Debate objects and saves them to the database.
 
-    :param attendances: Attendances to generate debates for
+    All the data needed for the draw is loaded upfront into a DrawContext, so
+    the number of queries made does not grow with the number of attendances.
+    The draw is worked out in full before anything is written, so nothing is
+    kept if it fails part way through.
+
+    :param date: the date to generate debates for
+    :param rng: random.Random instance for random choices - pass a seeded one
+                to reproduce a draw exactly
+    :param strategy: the pairing strategy - 'greedy' pairs the highest ranked teams
+                     first and moves teams around vetoes afterwards, 'matching' finds
+                     the optimal draw that satisfies all vetoes
+    :param improve: if True, the draw is improved with local search before it is saved
     :return: the generated MatchDay
     """
-    match_day = _matchmake(assign_teams_for_date(date, **kwargs), **kwargs)
-    match_day.save()
-    return match_day
+    return commit_draw(preview_debates(date, rng=rng, strategy=strategy, **kwargs))
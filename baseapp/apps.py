@@ -3,3 +3,7 @@ from django.apps import AppConfig
 
 class BaseAppConfig(AppConfig):
     name = 'baseapp'
+
+    def ready(self):
+        # Keeps the team standings up to date
+        from . import signals  # noqa: F401
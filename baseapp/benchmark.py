@@ -0,0 +1,237 @@
+"""
+Times the allocator on synthetic leagues (see run_benchmark and the
+benchmark_allocator command).
+
+The leagues are written to the database to be drawn, so the benchmark only
+runs in a throwaway test database set up with test_database: writing them
+to the configured database would lock the tables that results are entered
+into, and rebuilding the standings for them would take the live ones away
+until the writes were rolled back.
+"""
+import datetime
+import random
+import time
+import tracemalloc
+from collections import defaultdict
+from contextlib import contextmanager
+from django.db import transaction
+from django.db.models import Max
+from django.test.utils import setup_databases, teardown_databases
+from .models import Team, Speaker, Attendance, Veto, Room, MatchDay, Debate, Score
+from .profiling import record_phases
+from . import allocator, core, standings
+
+# League sizes (number of teams) benchmarked by default
+BENCHMARK_SIZES = (20, 200, 2000)
+
+# Qualification scores given to the speakers that are qualified as judges
+QUALIFICATION_SCORES = (5, 10, 20, 30, 40, 100)
+
+# Date of the draws saved by the benchmark - the writes are rolled back, so
+# that the runs in a test database start from the same state
+BENCHMARK_DATE = datetime.date(2100, 1, 1)
+
+
+def make_league(teams_count: int, vetoes_per_team=0.1, qualified_rate=0.5, history_rounds=5,
+                rng=None, first_pk=1, date=BENCHMARK_DATE):
+    """
+    Makes a synthetic league out of core objects, without touching the database.
+    Every team attends, with two or three speakers, and each speaker is
+    qualified as a judge with probability 'qualified_rate'. The history is
+    made by playing 'history_rounds' rounds of random debates, a week apart,
+    where the stronger team is more likely to win and its speakers score higher.
+
+    :param teams_count: the number of teams
+    :param vetoes_per_team: the average number of vetoes initiated by the speakers of a team
+    :param qualified_rate: the probability that a speaker is qualified as a judge
+    :param history_rounds: the number of rounds played before the draw
+    :param rng: random.Random instance for random choices
+    :param first_pk: the primary key of the first team, speaker, attendance, veto and room
+    :param date: the date of the attendances
+    :return: a tuple of (core.Attendances, core.Vetoes, history, core.Rooms), where
+             the history is a list of (affirmative, negative, winner, scores) tuples,
+             one for each debate played - the core.Attendances of the debate and
+             of its winner, and a dict of speaker pk -> score
+    """
+    rng = rng if rng is not None else random.Random()
+    attendances = []
+    speakers = []
+    for i in range(teams_count):
+        team = core.Team(first_pk + i, f"Benchmark team {first_pk + i}", judged_before=rng.random() < 0.5)
+        team_speakers = []
+        for _ in range(rng.choice((2, 3))):
+            score = rng.choice(QUALIFICATION_SCORES) if rng.random() < qualified_rate else 0
+            speaker = core.Speaker(first_pk + len(speakers), f"Speaker {first_pk + len(speakers)}",
+                                   team.pk, score)
+            team_speakers.append(speaker)
+            speakers.append(speaker)
+        attendances.append(core.Attendance(first_pk + i, date, team, team_speakers,
+                                           want_to_judge=rng.random() < 0.15))
+
+    vetoes = []
+    for _ in range(round(vetoes_per_team * teams_count)):
+        initiator, receiver = rng.sample(speakers, 2)
+        if initiator.team_id != receiver.team_id:
+            vetoes.append(core.Veto(first_pk + len(vetoes), initiator, receiver))
+
+    strengths = {attendance.team.pk: rng.random() for attendance in attendances}
+    history = []
+    for round_index in range(history_rounds):
+        round_date = date - datetime.timedelta(weeks=history_rounds - round_index)
+        first_attendance_pk = first_pk + teams_count * (round_index + 1)
+        order = [core.Attendance(first_attendance_pk + i, round_date, attendance.team, attendance.speakers)
+                 for i, attendance in enumerate(attendances)]
+        rng.shuffle(order)
+        for affirmative, negative in zip(order[::2], order[1::2]):
+            aff_win_prob = 0.5 + (strengths[affirmative.team.pk] - strengths[negative.team.pk]) / 2
+            winner = affirmative if rng.random() < aff_win_prob else negative
+            scores = {speaker.pk: 70 + round(10 * strengths[attendance.team.pk]) + rng.randint(0, 5)
+                      for attendance in (affirmative, negative) for speaker in attendance.speakers}
+            history.append((affirmative, negative, winner, scores))
+
+    rooms = [core.Room(first_pk + i, f"Room {i}") for i in range(teams_count // 2)]
+    return attendances, vetoes, history, rooms
+
+
+def _save_league(attendances, vetoes, history, rooms):
+    """
+    Inserts a league from make_league - its teams, speakers, attendances,
+    vetoes and rooms, and the debates, results and scores of its history -
+    and rebuilds the standings, so that the draw for it is loaded from the
+    database like a real one. Meant to run in a transaction that is rolled
+    back afterwards.
+    """
+    Team.objects.bulk_create([Team(pk=attendance.team.pk, name=attendance.team.name,
+                                   judged_before=attendance.team.judged_before)
+                              for attendance in attendances])
+    Speaker.objects.bulk_create([Speaker(pk=speaker.pk, name=speaker.name, team_id=speaker.team_id,
+                                         qualification_score=speaker.qualification_score)
+                                 for attendance in attendances for speaker in attendance.speakers])
+    all_attendances = attendances + [attendance for debate in history for attendance in debate[:2]]
+    Attendance.objects.bulk_create([Attendance(pk=attendance.pk, date=attendance.date, team_id=attendance.team.pk,
+                                               want_to_judge=attendance.want_to_judge)
+                                    for attendance in all_attendances])
+    AttendanceSpeaker = Attendance.speakers.through
+    AttendanceSpeaker.objects.bulk_create([AttendanceSpeaker(attendance_id=attendance.pk, speaker_id=speaker.pk)
+                                           for attendance in all_attendances for speaker in attendance.speakers])
+    Veto.objects.bulk_create([Veto(pk=veto.pk, initiator_id=veto.initiator.pk, receiver_id=veto.receiver.pk)
+                              for veto in vetoes])
+    Room.objects.bulk_create([Room(pk=room.pk, name=room.name, date=BENCHMARK_DATE) for room in rooms])
+
+    rounds = defaultdict(list)
+    for debate in history:
+        rounds[debate[0].date].append(debate)
+    for date, debates in rounds.items():
+        match_day, created = MatchDay.objects.get_or_create(date=date)
+        Debate.objects.bulk_create([Debate(match_day=match_day, affirmative_id=affirmative.pk,
+                                           negative_id=negative.pk, winning_team_id=winner.team.pk)
+                                    for affirmative, negative, winner, scores in debates])
+        # Debates made by bulk_create have no pks on every database, so they are read back
+        saved = Debate.objects.filter(match_day=match_day).order_by('pk').values_list('pk', flat=True)
+        Score.objects.bulk_create([Score(debate_id=debate_id, speaker_id=speaker_id, score=score)
+                                   for debate_id, (_, _, _, scores) in zip(saved, debates)
+                                   for speaker_id, score in scores.items()])
+    standings.rebuild_standings()
+
+
+def get_free_pk():
+    """ Returns a primary key above those of all the teams, speakers, attendances, vetoes and rooms. """
+    return 1 + max(model.objects.aggregate(Max('pk'))['pk__max'] or 0
+                   for model in (Team, Speaker, Attendance, Veto, Room))
+
+
+class _Rollback(Exception):
+    pass
+
+
+# Whether the databases are test databases set up by test_database
+_in_test_database = False
+
+
+@contextmanager
+def test_database():
+    """
+    Swaps the configured databases for empty test databases within the
+    block, as the test runner does, and destroys them afterwards. The
+    benchmark refuses to run outside of one (see run_benchmark).
+    """
+    global _in_test_database
+    old_config = setup_databases(verbosity=0, interactive=False)
+    _in_test_database = True
+    try:
+        yield
+    finally:
+        _in_test_database = False
+        teardown_databases(old_config, verbosity=0)
+
+
+def run_benchmark(teams_count: int, strategy='greedy', improve=False, vetoes_per_team=0.1,
+                  qualified_rate=0.5, history_rounds=5, seed=0, persist=True, memory=True):
+    """
+    Times a draw for a synthetic league (see make_league), phase by phase.
+
+    The league and its history are saved in a transaction that is rolled
+    back afterwards, and the draw is made with allocator.preview_debates and
+    saved with allocator.commit_draw, as views.generate_debates does. If
+    'persist' is False, the draw is not saved, and the persistence phase is
+    not timed.
+
+    :param teams_count: the number of teams in the league
+    :param strategy: name of the pairing strategy in pairing.PAIRING_STRATEGIES to use
+    :param improve: if True, the draw is improved with local search
+    :param seed: seed for the league and the draw
+    :param persist: if True, the persistence phase is timed as well
+    :param memory: if True, the peak memory used while drawing is measured, on a second run
+    :return: dict with the 'teams', 'strategy', 'debates', draw 'score', 'total_time'
+             (seconds), 'queries', 'peak_memory' (bytes while drawing, or None if not
+             measured) and 'phases' (phase name -> {'time', 'queries', 'db_time', 'calls'})
+    :raises RuntimeError: if it is not run in a test_database block
+    """
+    if not _in_test_database:
+        raise RuntimeError("The benchmark writes to the database, so it only runs in a test database "
+                           "(see benchmark.test_database).")
+    rng = random.Random(seed)
+    league = make_league(teams_count, vetoes_per_team=vetoes_per_team, qualified_rate=qualified_rate,
+                         history_rounds=history_rounds, rng=rng, first_pk=get_free_pk())
+
+    try:
+        with transaction.atomic():
+            _save_league(*league)
+
+            start = time.perf_counter()
+            with record_phases() as recorder:
+                draw = allocator.preview_debates(BENCHMARK_DATE, rng=random.Random(seed), strategy=strategy,
+                                                 improve=improve)
+                elapsed = time.perf_counter() - start
+
+                if persist:
+                    persist_start = time.perf_counter()
+                    allocator.commit_draw(draw)
+                    elapsed += time.perf_counter() - persist_start
+
+            # Tracing allocations slows the draw down many times over, so memory is
+            # measured on a separate run of the same draw
+            peak_memory = None
+            if memory:
+                tracemalloc.start()
+                try:
+                    allocator.preview_debates(BENCHMARK_DATE, rng=random.Random(seed), strategy=strategy,
+                                              improve=improve)
+                    peak_memory = tracemalloc.get_traced_memory()[1]
+                finally:
+                    tracemalloc.stop()
+            raise _Rollback()
+    except _Rollback:
+        pass
+
+    return {
+        'teams': teams_count,
+        'strategy': strategy,
+        'improve': improve,
+        'debates': len(draw),
+        'score': draw.score,
+        'total_time': elapsed,
+        'queries': recorder.total_queries,
+        'peak_memory': peak_memory,
+        'phases': recorder.as_dict(),
+    }
@@ -0,0 +1,134 @@
+"""
+A compact, database-free data model for the allocator.
+
+The classes here have the same attributes as the models the allocator reads
+(e.g. attendance.team, attendance.speakers.all(), speaker.qualification_score),
+so the allocator functions work on either. They hold only what the allocator
+needs, with __slots__, so a league of them takes a fraction of the memory of the
+model instances and can be built without a database - see adapter.py for
+loading them from the database, and DrawContext.from_core for drawing with them.
+"""
+
+# Qualification score a speaker needs to judge - models.Speaker uses it too
+JUDGE_THRESHOLD = 1
+
+
+class Team:
+    __slots__ = ('pk', 'name', 'judged_before')
+
+    def __init__(self, pk: int, name: str, judged_before=False):
+        self.pk = pk
+        self.name = name
+        self.judged_before = judged_before
+
+    def __str__(self):
+        return self.name
+
+
+class Speaker:
+    __slots__ = ('pk', 'name', 'team_id', 'qualification_score')
+
+    def __init__(self, pk: int, name: str, team_id: int, qualification_score=0):
+        self.pk = pk
+        self.name = name
+        self.team_id = team_id
+        self.qualification_score = qualification_score
+
+    def is_qualified_as_judge(self):
+        return self.qualification_score >= JUDGE_THRESHOLD
+
+    def __str__(self):
+        return self.name
+
+
+class Speakers(tuple):
+    """ The speakers of an attendance, with all() like a related manager. """
+    __slots__ = ()
+
+    def all(self):
+        return self
+
+
+class Attendance:
+    __slots__ = ('pk', 'date', 'team', 'speakers', 'want_to_judge')
+
+    def __init__(self, pk: int, date, team: Team, speakers=(), want_to_judge=False):
+        self.pk = pk
+        self.date = date
+        self.team = team
+        self.speakers = Speakers(speakers)
+        self.want_to_judge = want_to_judge
+
+    @property
+    def team_id(self):
+        return self.team.pk
+
+    def __str__(self):
+        return f"{self.date}  {self.team.name}"
+
+
+class Veto:
+    __slots__ = ('pk', 'initiator', 'receiver')
+
+    def __init__(self, pk: int, initiator: Speaker, receiver: Speaker):
+        self.pk = pk
+        self.initiator = initiator
+        self.receiver = receiver
+
+    @property
+    def initiator_id(self):
+        return self.initiator.pk
+
+    @property
+    def receiver_id(self):
+        return self.receiver.pk
+
+    def __str__(self):
+        return f"{self.initiator.name} against {self.receiver.name}"
+
+
+class Room:
+    __slots__ = ('pk', 'name')
+
+    def __init__(self, pk: int, name: str):
+        self.pk = pk
+        self.name = name
+
+    def __str__(self):
+        return self.name
+
+
+class Debate:
+    """ A debate in a draw that has not been saved. """
+    __slots__ = ('affirmative', 'negative', 'room')
+
+    def __init__(self, affirmative: Attendance = None, negative: Attendance = None, room: Room = None):
+        self.affirmative = affirmative
+        self.negative = negative
+        self.room = room
+
+    def get_attendances(self):
+        return [self.affirmative, self.negative]
+
+
+class History:
+    """
+    The history of the tournament that the allocator takes into account,
+    as plain counts keyed by team pk.
+    """
+    __slots__ = ('wins', 'avg_scores', 'side_counts', 'meetings', 'ratings')
+
+    def __init__(self, wins=None, avg_scores=None, side_counts=(), meetings=(), ratings=None):
+        """
+        :param wins: dict of team pk -> number of debates won
+        :param avg_scores: dict of team pk -> average score of the team's speakers
+        :param side_counts: list of (team pk, affirmative count, negative count) tuples
+        :param meetings: list of (team pk, team pk) tuples, one for each debate held
+        :param ratings: dict of team pk -> Elo rating (see ratings.py) - teams
+                        left out have the initial rating
+        """
+        self.wins = wins if wins is not None else {}
+        self.avg_scores = avg_scores if avg_scores is not None else {}
+        self.side_counts = list(side_counts)
+        self.meetings = list(meetings)
+        self.ratings = ratings if ratings is not None else {}
@@ -0,0 +1,233 @@
+"""
+Caches the public draw of each match day (see views.debates), so that the
+rush of attendees loading the draw when it is released is served without
+touching the database.
+
+Each date's draw is cached along with the version of the draw it was built
+from. Changes to the draw bump the version once their transaction commits
+(see invalidate_draw and signals.py), which makes the cached draw stale
+without racing a rebuild that is still reading the old draw. Renaming a
+team or speaker bumps a version shared by all the dates. When the cached
+draw is stale, one worker rebuilds it while the others wait for it.
+
+The draw is cached as JSON too, with an ETag and the time it last changed,
+for views.draw_json to answer polls without building anything.
+
+settings.DRAW_CACHE_ALIAS must name a cache shared by all the workers (the
+database cache in settings.CACHES, or e.g. Memcached or Redis): a worker
+with a cache of its own never sees the versions bumped by the others, and
+keeps serving the draw it cached until it times out. Reading the cache is
+then the only query made for a cached draw.
+"""
+import hashlib
+import json
+import threading
+import time
+import uuid
+import weakref
+from django.conf import settings
+from django.core.cache import caches
+from django.db import connection, transaction
+from .models import Debate, MatchDay
+
+# Seconds a worker may take to rebuild a draw before another one can
+DRAW_CACHE_LOCK_TIMEOUT = 10
+
+# Seconds to wait for another worker's rebuild before rebuilding anyway,
+# and how often to check for it
+DRAW_CACHE_WAIT = 5
+DRAW_CACHE_POLL_INTERVAL = 0.05
+
+# Version of the draws of all the dates
+_ALL_DATES = 'all'
+
+
+def get_draw_cache():
+    """ Returns the cache the draws are kept in - settings.DRAW_CACHE_ALIAS, or the default cache. """
+    return caches[getattr(settings, 'DRAW_CACHE_ALIAS', 'default')]
+
+
+def get_draw_cache_timeout():
+    """ Returns the number of seconds a draw is cached for - settings.DRAW_CACHE_TIMEOUT, or a day. """
+    return getattr(settings, 'DRAW_CACHE_TIMEOUT', 60 * 60 * 24)
+
+
+def _get_version_key(date):
+    return f'draw:version:{date}'
+
+
+def _get_draw_key(date):
+    return f'draw:{date}'
+
+
+def build_draw(date):
+    """
+    Returns the draw for the given date as plain data for the list_debates
+    template, in a fixed number of queries.
+
+    :return: list of dicts, one per debate - empty if there is no draw for the date
+    """
+    debates = Debate.objects.filter(match_day__date=date).order_by('pk')\
+        .select_related('room', 'affirmative__team', 'negative__team')\
+        .prefetch_related('affirmative__speakers', 'negative__speakers', 'judges')
+    return [
+        {
+            'debate_id': debate.id,
+            'room': debate.room.name if debate.room else '',
+            'team1': {
+                'name': debate.affirmative.team.name,
+                'speakers': [{'id': speaker.id, 'name': speaker.name} for speaker in debate.affirmative.speakers.all()]
+            },
+            'team2': {
+                'name': debate.negative.team.name,
+                'speakers': [{'id': speaker.id, 'name': speaker.name} for speaker in debate.negative.speakers.all()]
+            },
+            'judges': ", ".join(judge.name for judge in debate.judges.all()),
+            'panel': [{'id': judge.id, 'name': judge.name} for judge in debate.judges.all()]
+        }
+        for debate in debates
+    ]
+
+
+def format_draw_json(date, draw):
+    """ Returns the draw from build_draw as the data sent by views.draw_json. """
+    return {
+        'date': date.isoformat(),
+        'debates': [
+            {
+                'id': debate['debate_id'],
+                'room': debate['room'],
+                'affirmative': {'team': debate['team1']['name'], 'speakers': debate['team1']['speakers']},
+                'negative': {'team': debate['team2']['name'], 'speakers': debate['team2']['speakers']},
+                'judges': debate['panel'],
+            }
+            for debate in draw
+        ]
+    }
+
+
+def build_draw_entry(date, version=()):
+    """
+    Builds the draw for the given date along with what is cached with it.
+
+    :param version: the versions of the draw read before building it
+    :return: dict with the draw from build_draw ('debates'), the draw as JSON
+             ('json'), its ETag ('etag') and the time it last changed, in
+             seconds since the epoch ('last_modified') - the time it is built
+             if it has not changed since the versions were dropped from the cache
+    """
+    draw = build_draw(date)
+    draw_json = json.dumps(format_draw_json(date, draw), separators=(',', ':'))
+    changed = [part['modified'] for part in version if part is not None]
+    return {
+        'debates': draw,
+        'json': draw_json,
+        'etag': hashlib.sha1(draw_json.encode()).hexdigest(),
+        'last_modified': int(max(changed) if changed else time.time()),
+    }
+
+
+def get_draw(date):
+    """
+    Returns the draw for the given date (see build_draw) from the cache,
+    rebuilding it if it is stale. Makes no queries but the cache's own if it
+    is not.
+    """
+    return get_draw_entry(date)['debates']
+
+
+def get_draw_entry(date):
+    """
+    Returns the draw for the given date and what is cached with it (see
+    build_draw_entry) from the cache, rebuilding it if it is stale. Makes no
+    queries but the cache's own if it is not.
+    """
+    cache = get_draw_cache()
+    version_keys = [_get_version_key(_ALL_DATES), _get_version_key(date)]
+    draw_key = _get_draw_key(date)
+    found = cache.get_many(version_keys + [draw_key])
+    version = tuple(found.get(key) for key in version_keys)
+    cached = found.get(draw_key)
+    if cached is not None and cached[0] == version:
+        return cached[1]
+
+    # Single flight: only the worker holding the lock rebuilds the draw
+    lock_key = f'{draw_key}:lock'
+    if cache.add(lock_key, True, DRAW_CACHE_LOCK_TIMEOUT):
+        try:
+            entry = build_draw_entry(date, version)
+            cache.set(draw_key, (version, entry), get_draw_cache_timeout())
+        finally:
+            cache.delete(lock_key)
+        return entry
+
+    deadline = time.monotonic() + DRAW_CACHE_WAIT
+    while time.monotonic() < deadline:
+        time.sleep(DRAW_CACHE_POLL_INTERVAL)
+        cached = cache.get(draw_key)
+        if cached is not None and cached[0] == version:
+            return cached[1]
+    return build_draw_entry(date, version)
+
+
+class _Invalidation:
+    """ The draws to invalidate once the current transaction commits. """
+
+    def __init__(self):
+        self.dates = set()
+        self.match_day_ids = set()
+
+    def __call__(self):
+        if _get_pending() is self:
+            del _pending.invalidation
+        dates = set(self.dates)
+        if self.match_day_ids:
+            dates.update(MatchDay.objects.filter(pk__in=self.match_day_ids).values_list('date', flat=True))
+        # New versions rather than counters, so that a version evicted from
+        # the cache and started again cannot match a draw cached before
+        modified = time.time()
+        get_draw_cache().set_many({_get_version_key(date): {'id': uuid.uuid4().hex, 'modified': modified}
+                                   for date in dates}, None)
+
+
+# The _Invalidation waiting for the current transaction of this thread to
+# commit, by weak reference: a rollback drops Django's reference to it, so
+# the dates of a rolled back transaction go along with it. A savepoint
+# rolled back after the transaction's first invalidation leaves its dates
+# in, which only rebuilds a draw that did not need it.
+_pending = threading.local()
+
+
+def _get_pending():
+    """ Returns the _Invalidation waiting for the current transaction to commit, if any. """
+    reference = getattr(_pending, 'invalidation', None)
+    return reference() if reference is not None else None
+
+
+def invalidate_draw(date=None, match_day_id=None, all_dates=False):
+    """
+    Makes the cached draw for the given date, or match day, stale once the
+    current transaction commits - right away outside of a transaction. The
+    draws invalidated in a transaction are invalidated together, with at most
+    one query, and not at all if it is rolled back.
+
+    :param all_dates: if True, the draws of all the dates are made stale
+    """
+    invalidation = None
+    if connection.in_atomic_block:
+        invalidation = _get_pending()
+    if invalidation is None:
+        invalidation = _Invalidation()
+        if connection.in_atomic_block:
+            _pending.invalidation = weakref.ref(invalidation)
+            transaction.on_commit(invalidation)
+
+    if date is not None:
+        invalidation.dates.add(date)
+    if match_day_id is not None:
+        invalidation.match_day_ids.add(match_day_id)
+    if all_dates:
+        invalidation.dates.add(_ALL_DATES)
+
+    if not connection.in_atomic_block:
+        invalidation()
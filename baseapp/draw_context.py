@@ -0,0 +1,357 @@
+import random
+from collections import defaultdict, Counter
+import numpy as np
+from django.db.models import Avg, Count, Q
+from django.db.models.query import QuerySet, prefetch_related_objects
+from .models import Attendance, Debate, Score, TeamStanding, Veto
+from .core import History
+from . import ratings
+
+
+class VetoIndex:
+    """
+    Maps pairs of attendances to the vetoes that block them from debating each other.
+
+    The index is built once from the vetoes between the attending speakers, after
+    which looking up whether (and by which vetoes) two attendances are blocked
+    does not touch the database.
+    """
+
+    def __init__(self, attendances, vetoes):
+        """
+        :param attendances: the attendances to index, with their speakers prefetched
+        :param vetoes: the Veto instances to index
+        """
+        speaker_attendances = defaultdict(list)
+        for attendance in attendances:
+            for speaker in attendance.speakers.all():
+                speaker_attendances[speaker.pk].append(attendance.pk)
+
+        # (initiating attendance pk, receiving attendance pk) -> Veto instances
+        self._vetoes = defaultdict(list)
+        # attendance pk -> pks of the attendances it is blocked from, in either direction
+        self._blocked = defaultdict(set)
+        # speaker pk -> pks of the attendances with a speaker that has vetoed or
+        # been vetoed by that speaker, for judge allocation
+        self._speaker_conflicts = defaultdict(set)
+        for veto in vetoes:
+            for initiator in speaker_attendances[veto.initiator_id]:
+                for receiver in speaker_attendances[veto.receiver_id]:
+                    self._vetoes[(initiator, receiver)].append(veto)
+                    self._blocked[initiator].add(receiver)
+                    self._blocked[receiver].add(initiator)
+            self._speaker_conflicts[veto.initiator_id].update(speaker_attendances[veto.receiver_id])
+            self._speaker_conflicts[veto.receiver_id].update(speaker_attendances[veto.initiator_id])
+
+    @classmethod
+    def for_attendances(cls, attendances):
+        """
+        Builds the index for the given attendances, which must have their speakers
+        prefetched. Loads the vetoes in a single query.
+        """
+        speaker_ids = {speaker.pk for attendance in attendances
+                            for speaker in attendance.speakers.all()}
+        vetoes = Veto.objects.filter(initiator__in=speaker_ids, receiver__in=speaker_ids)\
+                    .select_related('initiator', 'receiver')
+        return cls(attendances, vetoes)
+
+    def get_vetoes(self, init_attendance, rec_attendance):
+        """
+        Returns a list of the Veto instances where the initiator is a speaker in
+        'init_attendance' and the receiver is a speaker in 'rec_attendance'.
+        """
+        return self._vetoes.get((init_attendance.pk, rec_attendance.pk), [])
+
+    def get_blocking_vetoes(self, attendance1, attendance2):
+        """ Returns the vetoes between the two attendances, in either direction. """
+        if not self.is_blocked(attendance1, attendance2):
+            return []
+        return self.get_vetoes(attendance1, attendance2) + self.get_vetoes(attendance2, attendance1)
+
+    def is_vetoed(self, initiator, receiver):
+        """ Returns True if any speaker in 'initiator' has vetoed any speaker in 'receiver'. """
+        return (initiator.pk, receiver.pk) in self._vetoes
+
+    def is_blocked(self, attendance1, attendance2):
+        """ Returns True if either attendance has vetoed the other. """
+        return attendance2.pk in self._blocked.get(attendance1.pk, ())
+
+    def get_blocked(self, attendance):
+        """ Returns the pks of the attendances that 'attendance' cannot debate against. """
+        return self._blocked.get(attendance.pk, set())
+
+    def get_speaker_conflicts(self, speaker):
+        """
+        Returns the pks of the attendances with a speaker that 'speaker' has vetoed
+        or has been vetoed by, i.e. the attendances 'speaker' should not judge.
+        """
+        return self._speaker_conflicts.get(speaker.pk, set())
+
+    def as_matrix(self, attendances):
+        """
+        Returns a symmetric boolean matrix where entry [i, j] is True if
+        attendances[i] and attendances[j] cannot debate each other.
+        """
+        index = {attendance.pk: i for i, attendance in enumerate(attendances)}
+        matrix = np.zeros((len(attendances), len(attendances)), dtype=bool)
+        for attendance_id, blocked in self._blocked.items():
+            if attendance_id in index:
+                matrix[index[attendance_id], [index[pk] for pk in blocked if pk in index]] = True
+        return matrix
+
+
+class HeadToHead:
+    """
+    Counts the number of times each pair of teams has debated each other.
+
+    Pairs are unordered, i.e. it does not matter which team was affirmative.
+    The counts can be updated in place as new debates are created.
+    """
+
+    def __init__(self, pairs=()):
+        """
+        :param pairs: iterable of (team pk, team pk) tuples, one for each debate held
+        """
+        self._meetings = Counter(frozenset(pair) for pair in pairs if None not in pair)
+
+    def times_met(self, team1, team2):
+        """ Returns the number of times 'team1' and 'team2' have debated each other. """
+        return self._meetings[frozenset((team1.pk, team2.pk))]
+
+    def has_met(self, team1, team2):
+        return self.times_met(team1, team2) > 0
+
+    def record(self, team1, team2):
+        """ Records a debate between 'team1' and 'team2'. """
+        self._meetings[frozenset((team1.pk, team2.pk))] += 1
+
+    def discard(self, team1, team2):
+        """ Removes a debate between 'team1' and 'team2' recorded earlier. """
+        pair = frozenset((team1.pk, team2.pk))
+        if self._meetings[pair] > 0:
+            self._meetings[pair] -= 1
+
+    def as_matrix(self, teams):
+        """
+        Returns a symmetric integer matrix where entry [i, j] is the number of
+        times teams[i] and teams[j] have debated each other.
+        """
+        index = defaultdict(list)
+        for i, team in enumerate(teams):
+            index[team.pk].append(i)
+        matrix = np.zeros((len(teams), len(teams)), dtype=int)
+        for pair, count in self._meetings.items():
+            if len(pair) == 2 and count:
+                team1, team2 = pair
+                for i in index.get(team1, ()):
+                    matrix[i, index.get(team2, [])] = count
+                for j in index.get(team2, ()):
+                    matrix[j, index.get(team1, [])] = count
+        return matrix
+
+
+class SideBalance:
+    """
+    Counts the number of times each team has been the affirmative and the
+    negative side, so that sides can be balanced over the tournament.
+
+    The counts can be updated in place as sides are assigned.
+    """
+
+    def __init__(self, counts=()):
+        """
+        :param counts: iterable of (team pk, affirmative count, negative count) tuples
+        """
+        self._aff_counts = defaultdict(int)
+        self._neg_counts = defaultdict(int)
+        for team_id, aff_count, neg_count in counts:
+            self._aff_counts[team_id] = aff_count
+            self._neg_counts[team_id] = neg_count
+
+    def get_aff_count(self, team):
+        return self._aff_counts[team.pk]
+
+    def get_neg_count(self, team):
+        return self._neg_counts[team.pk]
+
+    def compare_aff_neg(self, team):
+        """ Returns the team's affirmative count - negative count. """
+        return self._aff_counts[team.pk] - self._neg_counts[team.pk]
+
+    def record(self, affirmative_team, negative_team):
+        """ Records a debate with the given sides. """
+        self._aff_counts[affirmative_team.pk] += 1
+        self._neg_counts[negative_team.pk] += 1
+
+    def discard(self, affirmative_team, negative_team):
+        """ Removes a debate with the given sides recorded earlier. """
+        self._aff_counts[affirmative_team.pk] -= 1
+        self._neg_counts[negative_team.pk] -= 1
+
+
+def load_history(team_ids, date=None):
+    """
+    Loads the history of the given teams from the debates held before 'date',
+    in a fixed number of queries. Wins, speaker averages and ratings are read
+    from the team standings unless debates from 'date' on already have results.
+
+    :param team_ids: pks of the teams
+    :param date: only debates before this date are counted - all debates if None
+    :return: a core.History
+    """
+    history = Debate.objects.all()
+    scores = Score.objects.all()
+    if date is not None:
+        history = history.exclude(match_day__date__gte=date)
+        scores = scores.exclude(debate__match_day__date__gte=date)
+
+    if date is None or not Debate.objects.filter(match_day__date__gte=date)\
+            .filter(Q(winning_team__isnull=False) | Q(score__isnull=False)).exists():
+        # Nothing from 'date' on has a result or scores yet, so the standings
+        # are the history up to 'date'
+        wins = {}
+        avg_scores = {}
+        team_ratings = {}
+        for team_id, team_wins, score_sum, score_count, rating in TeamStanding.objects.filter(team__in=team_ids)\
+                .values_list('team', 'wins', 'score_sum', 'score_count', 'rating'):
+            wins[team_id] = team_wins
+            avg_scores[team_id] = float(score_sum) / score_count if score_count else 0
+            team_ratings[team_id] = rating
+    else:
+        # Wins of each team
+        wins = dict(history.filter(winning_team__in=team_ids)
+                        .values_list('winning_team').annotate(Count('pk')))
+
+        # Average of the scores of each team's speakers
+        avg_scores = {team_id: float(avg_score) for team_id, avg_score in
+                      scores.filter(speaker__team__in=team_ids)
+                          .values_list('speaker__team').annotate(Avg('score')).order_by()}
+
+        # Ratings from the results before 'date'
+        replayed = ratings.replay(ratings.load_results(before=date))
+        team_ratings = {team_id: replayed.get(team_id) for team_id in team_ids}
+
+    # Number of times each team has been affirmative/negative
+    # Debates are held on the date of their attendances, so the attendances
+    # before 'date' give the side history
+    past_attendances = Attendance.objects.filter(team__in=team_ids)
+    if date is not None:
+        past_attendances = past_attendances.filter(date__lt=date)
+    side_counts = past_attendances.values_list('team').annotate(
+        Count('debates_affirmative', distinct=True),
+        Count('debates_negative', distinct=True)
+    )
+
+    # Teams that have debated each other
+    meetings = history.filter(Q(affirmative__team__in=team_ids) | Q(negative__team__in=team_ids))\
+                    .values_list('affirmative__team', 'negative__team')
+
+    return History(wins, avg_scores, side_counts, meetings, team_ratings)
+
+
+class DrawContext:
+    """
+    An in-memory snapshot of everything the allocator needs to know about a
+    set of attendances: their teams and speakers, the teams' wins, speaker
+    averages and ratings, the vetoes between the attending speakers, and the
+    side and head-to-head history of the tournament.
+
+    The snapshot is loaded in a fixed number of queries, independent of the
+    number of attendances, teams or debates. Once built, none of its methods
+    touch the database. A context can also be built from core objects (see
+    core.py) with from_core, which does not touch the database at all.
+
+    Only debates held before 'date' count towards the history, so that
+    regenerating the draw for a day does not see that day's own debates.
+
+    Random choices made by the allocator (e.g. side tie-breaks) are drawn from
+    'rng', so that a draw can be reproduced by passing in a seeded Random.
+    """
+
+    def __init__(self, attendances, date=None, rng=None):
+        """
+        :param attendances: the Attendances (list or queryset) to generate debates for
+        :param date: only debates before this date are considered as history.
+                     Defaults to the date of the attendances given.
+        :param rng: the random.Random instance to use for random choices
+        """
+        if isinstance(attendances, QuerySet):
+            attendances = list(attendances.select_related('team').prefetch_related('speakers'))
+        else:
+            attendances = list(attendances)
+            prefetch_related_objects(attendances, 'team', 'speakers')
+        if date is None and attendances:
+            date = attendances[0].date
+
+        team_ids = {attendance.team_id for attendance in attendances}
+        self._set_data(attendances, date, rng, load_history(team_ids, date),
+                       VetoIndex.for_attendances(attendances))
+
+    @classmethod
+    def from_core(cls, attendances, vetoes, history: History, date=None, rng=None):
+        """
+        Returns the DrawContext for the given core.Attendances, without touching
+        the database.
+
+        :param attendances: the core.Attendances to generate debates for
+        :param vetoes: the core.Vetoes between the attending speakers
+        :param history: the core.History of the attending teams
+        :param date: the date the draw is for - defaults to the date of the attendances given
+        :param rng: the random.Random instance to use for random choices
+        """
+        attendances = list(attendances)
+        if date is None and attendances:
+            date = attendances[0].date
+        context = cls.__new__(cls)
+        context._set_data(attendances, date, rng, history, VetoIndex(attendances, vetoes))
+        return context
+
+    def _set_data(self, attendances, date, rng, history: History, vetoes: VetoIndex):
+        self.attendances = attendances
+        self.date = date
+        self.rng = rng if rng is not None else random.Random()
+        self._wins = defaultdict(int, history.wins)
+        self._avg_scores = dict(history.avg_scores)
+        self._ratings = dict(history.ratings)
+        self.vetoes = vetoes
+        self.sides = SideBalance(history.side_counts)
+        self.head_to_head = HeadToHead(history.meetings)
+
+    @classmethod
+    def for_date(cls, date, rng=None):
+        """ Returns the DrawContext for all the attendances on the given date, other than those withdrawn. """
+        return cls(Attendance.objects.filter(date=date, withdrawn=False).order_by('pk'), date=date, rng=rng)
+
+    def get_attendances(self, pks):
+        """
+        Returns the attendances in this context whose primary key is in 'pks',
+        in the order they appear in the context.
+        """
+        pks = set(pks)
+        return [attendance for attendance in self.attendances if attendance.pk in pks]
+
+    def get_wins(self, team):
+        return self._wins[team.pk]
+
+    def get_speakers_avg_score(self, team):
+        return self._avg_scores.get(team.pk, 0)
+
+    def get_rating(self, team):
+        return self._ratings.get(team.pk, ratings.INITIAL_RATING)
+
+    def compare_aff_neg(self, team):
+        """ Returns the team's affirmative count - negative count. """
+        return self.sides.compare_aff_neg(team)
+
+    def is_debated_before(self, team1, team2):
+        return self.head_to_head.has_met(team1, team2)
+
+    def record_debate(self, affirmative, negative):
+        """ Updates the side and head-to-head history with a debate between the given attendances. """
+        self.sides.record(affirmative.team, negative.team)
+        self.head_to_head.record(affirmative.team, negative.team)
+
+    def discard_debate(self, affirmative, negative):
+        """ Reverts record_debate for a debate between the given attendances. """
+        self.sides.discard(affirmative.team, negative.team)
+        self.head_to_head.discard(affirmative.team, negative.team)
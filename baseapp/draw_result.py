@@ -0,0 +1,128 @@
+import hashlib
+import json
+from .draw_context import DrawContext
+
+# Penalties used to compare draws, per unit of each metric from get_draw_metrics
+DRAW_SCORE_WEIGHTS = {
+    'repeats': 40,
+    'win_gap_total': 20,
+    'win_gap_max': 10,
+    'side_imbalance': 5,
+    'veto_clashes': 1000,
+    'judge_conflicts': 1000,
+    'panel_strength_spread': 1,
+}
+
+
+def get_draw_metrics(debates, panels, context: DrawContext):
+    """
+    Measures the quality of a draw.
+
+    :param debates: Debate instances (saved or not) with affirmative and negative set
+    :param panels: the judges for each debate in 'debates'
+    :param context: the DrawContext the draw was made with, with the draw's debates
+                    already recorded in it
+    :return: dict with the following (lower is better, apart from 'debates'):
+        - 'debates': number of debates
+        - 'repeats': number of debates between teams that have met before
+        - 'win_gap_total': sum of the differences in wins between opposing teams
+        - 'win_gap_max': largest difference in wins between opposing teams
+        - 'side_imbalance': sum over the competing teams of |affirmative - negative|
+        - 'veto_clashes': number of debates that go against a veto
+        - 'judge_conflicts': number of judges placed in a debate with a speaker they
+                             have vetoed or have been vetoed by
+        - 'panel_strength_spread': difference between the strongest and weakest
+                                   panels' total qualification score
+    """
+    win_gaps = [abs(context.get_wins(debate.affirmative.team) - context.get_wins(debate.negative.team))
+                    for debate in debates]
+    panel_strengths = [sum(judge.qualification_score for judge in panel) for panel in panels]
+    judge_conflicts = 0
+    for debate, panel in zip(debates, panels):
+        for judge in panel:
+            conflicting = context.vetoes.get_speaker_conflicts(judge)
+            if debate.affirmative.pk in conflicting or debate.negative.pk in conflicting:
+                judge_conflicts += 1
+
+    return {
+        'debates': len(debates),
+        'repeats': sum(1 for debate in debates
+                        if context.head_to_head.times_met(debate.affirmative.team, debate.negative.team) > 1),
+        'win_gap_total': sum(win_gaps),
+        'win_gap_max': max(win_gaps, default=0),
+        'side_imbalance': sum(abs(context.compare_aff_neg(attendance.team))
+                                for debate in debates for attendance in debate.get_attendances()),
+        'veto_clashes': sum(1 for debate in debates
+                                if context.vetoes.is_blocked(debate.affirmative, debate.negative)),
+        'judge_conflicts': judge_conflicts,
+        'panel_strength_spread': max(panel_strengths, default=0) - min(panel_strengths, default=0),
+    }
+
+
+def get_draw_score(metrics, weights=DRAW_SCORE_WEIGHTS):
+    """
+    Returns the score of a draw from its metrics (as from get_draw_metrics),
+    weighted by 'weights'. Lower is better.
+    """
+    return sum(weight * metrics[name] for name, weight in weights.items())
+
+
+class DrawResult:
+    """
+    A draw computed in memory that has not been saved to the database yet.
+    Can be inspected as a preview, then saved with allocator.commit_draw.
+    """
+
+    def __init__(self, date, attendances_competing, attendances_judging, debates, panels,
+                    vetoes_affected, context: DrawContext, strategy=None, seed=None):
+        """
+        :param date: the date the draw is for
+        :param attendances_competing: the attendances competing
+        :param attendances_judging: the attendances judging
+        :param debates: unsaved Debate instances, highest ranked debate first
+        :param panels: the judges for each debate in 'debates'
+        :param vetoes_affected: the Vetoes that teams were swapped around
+        :param context: the DrawContext the draw was made with
+        :param strategy: the pairing strategy the draw was made with
+        :param seed: the seed that reproduces the draw, if known
+        """
+        self.date = date
+        self.attendances_competing = attendances_competing
+        self.attendances_judging = attendances_judging
+        self.debates = debates
+        self.panels = panels
+        self.vetoes_affected = vetoes_affected
+        self.strategy = strategy
+        self.seed = seed
+        # profiling.PhaseRecorder with the time and queries of each phase, if recorded
+        self.phases = None
+        self.metrics = get_draw_metrics(debates, panels, context)
+        self.score = get_draw_score(self.metrics)
+
+    def get_fingerprint(self):
+        """
+        Returns a hash of what the draw is made of: the attendances with
+        their speakers, and each debate's teams, sides, room and judges. A
+        draw made again has the same fingerprint only if it is the same draw.
+        """
+        def describe(attendance):
+            return [attendance.pk, attendance.team.pk, sorted(speaker.pk for speaker in attendance.speakers.all())]
+
+        made_of = {
+            'date': str(self.date),
+            'competing': sorted(describe(attendance) for attendance in self.attendances_competing),
+            'judging': sorted(describe(attendance) for attendance in self.attendances_judging),
+            'debates': [[debate.affirmative.pk, debate.negative.pk, debate.room.pk if debate.room else None,
+                         sorted(judge.pk for judge in panel)] for debate, panel in self],
+        }
+        return hashlib.sha1(json.dumps(made_of).encode()).hexdigest()
+
+    def __iter__(self):
+        """ Iterates over (debate, panel) tuples. """
+        return iter(zip(self.debates, self.panels))
+
+    def __len__(self):
+        return len(self.debates)
+
+    def __str__(self):
+        return f"{self.date} ({len(self.debates)} debates)"
@@ -12,4 +12,26 @@ class CannotFindWorkingConfigurationException(Exception):
 
 class NotEnoughRoomsException(Exception):
     def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
\ No newline at end of file
+        super().__init__(*args, **kwargs)
+
+class DrawLockedException(Exception):
+    """ Raised when a draw that is not for today, or that has results, would be changed. """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+class DrawSearchTimeoutException(Exception):
+    """ Raised when a search for the best draw finds no candidate in time, e.g. because a worker died. """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+class VetoConflictException(CannotFindWorkingConfigurationException):
+    """ Raised when the vetoes between the attendances competing cannot all be satisfied. """
+    def __init__(self, vetoes, *args, **kwargs):
+        """
+        :param vetoes: a minimal set of Vetoes that cannot be satisfied together
+        """
+        self.vetoes = vetoes
+        if not args:
+            args = ("Cannot allocate debates that satisfy veto criteria - these vetoes conflict: " +
+                    ", ".join(str(veto) for veto in vetoes) + ".",)
+        super().__init__(*args, **kwargs)
@@ -0,0 +1,95 @@
+from itertools import combinations
+from .draw_context import VetoIndex
+from .matching import min_cost_perfect_matching
+
+
+def _can_pair_up(n: int, blocked_pairs):
+    """
+    Returns True if the vertices range(n) can all be paired up, without any of
+    the (i, j) pairs in 'blocked_pairs', i.e. if the graph of allowed pairings
+    has a perfect matching.
+    """
+    if n % 2 != 0:
+        return False
+    # By Dirac's theorem, if every vertex can be paired with at least half of the
+    # others, the allowed pairings contain a Hamiltonian cycle - and so a perfect
+    # matching. This saves solving a matching in the usual case of few vetoes.
+    blocked_counts = [0] * n
+    for i, j in blocked_pairs:
+        blocked_counts[i] += 1
+        blocked_counts[j] += 1
+    if all(n - 1 - blocked >= n / 2 for blocked in blocked_counts):
+        return True
+
+    blocked_pairs = set(blocked_pairs)
+    allowed = [pair for pair in combinations(range(n), 2) if pair not in blocked_pairs]
+    if _greedy_pair_up(n, allowed):
+        return True
+    return min_cost_perfect_matching(n, dict.fromkeys(allowed, 0)) is not None
+
+
+def _greedy_pair_up(n: int, allowed):
+    """
+    Tries to pair up the vertices range(n) with the (i, j) pairs in 'allowed',
+    by repeatedly pairing the vertex with the fewest options left with its
+    neighbour with the fewest options left. Returns True if this pairs up all
+    the vertices - False does not mean that they cannot be paired up.
+    """
+    neighbours = [set() for _ in range(n)]
+    for i, j in allowed:
+        neighbours[i].add(j)
+        neighbours[j].add(i)
+    unpaired = set(range(n))
+    while unpaired:
+        vertex = min(unpaired, key=lambda v: len(neighbours[v]))
+        if not neighbours[vertex]:
+            return False
+        partner = min(neighbours[vertex], key=lambda v: len(neighbours[v]))
+        for v in (vertex, partner):
+            unpaired.remove(v)
+            for neighbour in neighbours[v]:
+                neighbours[neighbour].discard(v)
+            neighbours[v] = set()
+    return True
+
+
+def find_conflicting_vetoes(attendances, vetoes: VetoIndex):
+    """
+    Checks whether the given attendances can all be paired up in debates without
+    going against any vetoes.
+
+    If they cannot, a minimal set of conflicting vetoes is found with a deletion
+    filter: the pairings blocked by vetoes are allowed in turn, and are only kept
+    in the set if the attendances can then be paired up. The vetoes found cannot
+    all be satisfied together, but any one of them can be dropped to fix that
+    (as far as these vetoes go).
+
+    :param attendances: the attendances competing
+    :param vetoes: the VetoIndex for the attendances
+    :return: list of the conflicting Vetoes, or an empty list if the attendances
+             can be paired up
+    """
+    attendances = list(attendances)
+    blocked_pairs = [(i, j) for i, j in combinations(range(len(attendances)), 2)
+                        if vetoes.is_blocked(attendances[i], attendances[j])]
+    if _can_pair_up(len(attendances), blocked_pairs):
+        return []
+
+    # Drop blocked pairings in chunks, halving the chunk size on each pass -
+    # the final pass goes one by one, which makes the set minimal
+    conflicting = list(blocked_pairs)
+    chunk = max(1, len(conflicting) // 2)
+    while True:
+        i = 0
+        while i < len(conflicting):
+            remaining = conflicting[:i] + conflicting[i + chunk:]
+            if not _can_pair_up(len(attendances), remaining):
+                conflicting = remaining
+            else:
+                i += chunk
+        if chunk == 1:
+            break
+        chunk //= 2
+
+    return [veto for i, j in conflicting
+                for veto in vetoes.get_blocking_vetoes(attendances[i], attendances[j])]
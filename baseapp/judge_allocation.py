@@ -0,0 +1,140 @@
+import numpy as np
+from .draw_context import DrawContext
+
+# Cost of having a judge adjudicate a debate with a speaker they have vetoed
+# or have been vetoed by - large enough to only happen when unavoidable
+JUDGE_CONFLICT_COST = 10 ** 6
+
+
+def solve_assignment(costs):
+    """
+    Solves the assignment problem for the given cost matrix with the Hungarian
+    algorithm, in O(n^2 m) time.
+
+    :param costs: n x m array of costs, with n <= m
+    :return: numpy array 'assignment' of length n, where assignment[i] is the
+             column assigned to row i, such that the total cost is minimal
+    """
+    costs = np.asarray(costs, dtype=float)
+    n, m = costs.shape
+    # Potentials for rows (u) and columns (v); row/column 0 is a sentinel
+    u = np.zeros(n + 1)
+    v = np.zeros(m + 1)
+    # p[j] is the row (1-indexed) assigned to column j, or 0
+    p = np.zeros(m + 1, dtype=int)
+    way = np.zeros(m + 1, dtype=int)
+
+    for i in range(1, n + 1):
+        p[0] = i
+        j0 = 0
+        minv = np.full(m + 1, np.inf)
+        used = np.zeros(m + 1, dtype=bool)
+        # Grow an alternating tree from row i until a free column is reached
+        while True:
+            used[j0] = True
+            i0 = p[j0]
+            free = ~used[1:]
+            reduced = costs[i0 - 1] - u[i0] - v[1:]
+            improved = free & (reduced < minv[1:])
+            minv[1:][improved] = reduced[improved]
+            way[1:][improved] = j0
+            candidates = np.where(free, minv[1:], np.inf)
+            j1 = int(np.argmin(candidates)) + 1
+            delta = candidates[j1 - 1]
+            u[p[used]] += delta
+            v[used] -= delta
+            minv[~used] -= delta
+            j0 = j1
+            if p[j0] == 0:
+                break
+        # Augment along the path found
+        while j0 != 0:
+            j1 = way[j0]
+            p[j0] = p[j1]
+            j0 = j1
+
+    assignment = np.empty(n, dtype=int)
+    for j in range(1, m + 1):
+        if p[j]:
+            assignment[p[j] - 1] = j - 1
+    return assignment
+
+
+def get_panel_sizes(judges_count: int, debates_count: int):
+    """
+    Returns the number of judges for each debate, where excess judges go to
+    the higher ranked debates.
+    """
+    base, extra = divmod(judges_count, debates_count)
+    return [base + 1 if i < extra else base for i in range(debates_count)]
+
+
+def get_target_strengths(strengths, panel_sizes):
+    """
+    Assigns a target strength to each judging slot, by dealing out the given
+    judge strengths strongest first in a snake order: the chairs go from the
+    highest ranked debate down, the next judges from the lowest ranked debate
+    up, and so on. This gives the strongest chairs to the highest ranked debates
+    while keeping the total strength of the panels balanced.
+
+    :param strengths: the strengths of all the judges
+    :param panel_sizes: number of judges for each debate, as from get_panel_sizes
+    :return: list of (debate index, target strength) tuples, one for each slot
+    """
+    strengths = sorted(strengths, reverse=True)
+    slots = []
+    for position in range(max(panel_sizes, default=0)):
+        debate_indices = [i for i, size in enumerate(panel_sizes) if size > position]
+        if position % 2 == 1:
+            debate_indices.reverse()
+        for i in debate_indices:
+            slots.append((i, strengths[len(slots)]))
+    return slots
+
+
+def build_conflict_matrix(judges, pairs, context: DrawContext):
+    """
+    Returns a boolean matrix where entry [j, d] is True if judges[j] has vetoed,
+    or has been vetoed by, a speaker in either team of the debate pairs[d].
+    """
+    conflicts = np.zeros((len(judges), len(pairs)), dtype=bool)
+    for j, judge in enumerate(judges):
+        conflicting = context.vetoes.get_speaker_conflicts(judge)
+        if conflicting:
+            conflicts[j] = [attendance1.pk in conflicting or attendance2.pk in conflicting
+                                for attendance1, attendance2 in pairs]
+    return conflicts
+
+
+def allocate_judges(judges, pairs, context: DrawContext):
+    """
+    Allocates the judges given to the debates given, by solving an assignment
+    problem between judges and judging slots. The cost of placing a judge in a
+    slot is the difference between the judge's qualification score and the
+    slot's target strength (see get_target_strengths), plus JUDGE_CONFLICT_COST
+    if the judge has a veto against a speaker in the debate.
+
+    :param judges: the qualified judges available
+    :param pairs: list of (attendance, attendance) tuples, highest ranked debate first
+    :return: list of panels (lists of judges), one for each debate in 'pairs'
+    :requires: len(judges) >= len(pairs)
+    """
+    if not pairs:
+        return []
+    panel_sizes = get_panel_sizes(len(judges), len(pairs))
+    strengths = np.array([judge.qualification_score for judge in judges], dtype=float)
+    slots = get_target_strengths(strengths, panel_sizes)
+    slot_debates = np.array([debate_index for debate_index, target in slots])
+    slot_targets = np.array([target for debate_index, target in slots])
+
+    conflicts = build_conflict_matrix(judges, pairs, context)
+    costs = np.abs(strengths[:, None] - slot_targets[None, :]) + \
+            JUDGE_CONFLICT_COST * conflicts[:, slot_debates]
+
+    panels = [[] for _ in pairs]
+    for j, slot in enumerate(solve_assignment(costs)):
+        panels[slot_debates[slot]].append(judges[j])
+    # Chair (strongest judge) first
+    for panel in panels:
+        panel.sort(key=lambda judge: judge.qualification_score, reverse=True)
+    return panels
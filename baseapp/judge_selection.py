@@ -0,0 +1,98 @@
+from collections import defaultdict
+import math
+import numpy as np
+
+
+def _min_judging_count(attendances_count: int, judge_counts):
+    """
+    Returns the smallest number of attendances that can judge such that the
+    remaining attendances can compete, or None if there is no such number.
+    The remaining attendances can compete if there is an even, non-zero number
+    of them and there are enough judges for their debates.
+    """
+    most_judges_first = sorted((judges for judges in judge_counts if judges > 0), reverse=True)
+    judges = 0
+    for k in range(0, len(most_judges_first) + 1):
+        if k > 0:
+            judges += most_judges_first[k - 1]
+        competing = attendances_count - k
+        if competing < 2:
+            break
+        if competing % 2 == 0 and judges >= competing // 2:
+            return k
+    return None
+
+
+def select_judging_attendances(attendances_count: int, judge_counts, priorities):
+    """
+    Chooses which attendances judge. The smallest possible number of attendances
+    judge, such that the remaining attendances can compete (an even, non-zero number
+    of them, with at least one judge per debate). Among those choices, the one with
+    the highest total judging priority is returned.
+
+    Attendances with the same number of judges are interchangeable as far as the
+    constraints go, so only the highest priority ones are ever picked from each
+    such group. The choice of how many to pick from each group is solved exactly
+    with dynamic programming over (attendances picked, judges picked), where the
+    number of judges is capped at the number required.
+
+    :param attendances_count: the number of attendances in total
+    :param judge_counts: the number of qualified judges in each attendance that can judge
+    :param priorities: the judging priority of each attendance that can judge
+    :return: list of the indices (into judge_counts/priorities) of the attendances
+             to judge, or None if no valid choice exists
+    """
+    k = _min_judging_count(attendances_count, judge_counts)
+    if k is None:
+        return None
+    required = math.floor((attendances_count - k) / 2)
+
+    # Group the attendances by number of judges, highest priority first
+    groups = defaultdict(list)
+    for i, (judges, priority) in enumerate(zip(judge_counts, priorities)):
+        if judges > 0:
+            groups[judges].append(i)
+    for indices in groups.values():
+        indices.sort(key=lambda i: priorities[i], reverse=True)
+
+    # best[c, q]: best total priority picking c attendances with q judges (capped at 'required')
+    best = np.full((k + 1, required + 1), -np.inf)
+    best[0, 0] = 0
+    stages = []
+    for judges, indices in sorted(groups.items()):
+        previous = best
+        best = previous.copy()
+        picked = np.zeros(best.shape, dtype=int)
+        prefix = np.cumsum([0] + [priorities[i] for i in indices])
+        for m in range(1, min(len(indices), k) + 1):
+            shift = judges * m
+            candidate = np.full((k + 1 - m, required + 1), -np.inf)
+            if shift < required:
+                candidate[:, shift:required] = previous[:k + 1 - m, :required - shift]
+            candidate[:, required] = previous[:k + 1 - m, max(0, required - shift):].max(axis=1)
+            candidate += prefix[m]
+            improved = candidate > best[m:]
+            best[m:][improved] = candidate[improved]
+            picked[m:][improved] = m
+        stages.append((judges, indices, previous, picked, prefix))
+
+    if not np.isfinite(best[k, required]):
+        return None
+
+    # Trace back how many attendances were picked from each group
+    chosen = []
+    count, judges_total = k, required
+    value = best[k, required]
+    for judges, indices, previous, picked, prefix in reversed(stages):
+        m = picked[count, judges_total]
+        chosen.extend(indices[:m])
+        shift = judges * m
+        count -= m
+        value -= prefix[m]
+        if judges_total < required:
+            judges_total -= shift
+        else:
+            # The judges were capped; find the state this one came from
+            start = max(0, required - shift)
+            judges_total = start + int(np.argmax(previous[count, start:] == value))
+    return chosen
@@ -0,0 +1,210 @@
+import math
+import time
+import numpy as np
+from .draw_context import DrawContext
+from .pairing import PAIRING_WEIGHTS, build_cost_matrix
+from .judge_allocation import JUDGE_CONFLICT_COST, get_panel_sizes, get_target_strengths
+
+# Cost of a debate between two teams with a veto between them - large enough
+# that the search only keeps one when there is no way around it
+VETO_COST = 10 ** 6
+
+# Number of moves tried per debate
+LOCAL_SEARCH_ITERATIONS_PER_DEBATE = 500
+
+# Most moves tried to improve a draw, whatever its size - about half a second.
+# The search is bounded by moves rather than time, so that a seeded draw is
+# the same however fast the machine making it is.
+LOCAL_SEARCH_MAX_ITERATIONS = 100000
+
+# Team swaps are only tried between debates up to this many places apart,
+# once no debate is left against a veto - until then, teams may have to
+# move further to get away from the teams they have vetoes with
+SWAP_DISTANCE = 5
+
+# Annealing temperature at the start and end of the search
+START_TEMPERATURE = PAIRING_WEIGHTS['win_gap']
+END_TEMPERATURE = 0.5
+
+
+class _DrawState:
+    """
+    A draw as indices: debate d is between attendances aff[d] and neg[d] (into
+    the ranked attendances), judged by panels[d] (indices into the judges).
+    The cost of each debate is kept up to date, so that a move is evaluated by
+    recomputing only the debates it touches.
+    """
+
+    def __init__(self, aff, neg, panels, pair_costs, sides, side_weight, conflicts,
+                    strengths, target_strengths):
+        self.aff = aff
+        self.neg = neg
+        self.panels = panels
+        self._pair_costs = pair_costs
+        self._sides = sides
+        self._side_weight = side_weight
+        self._conflicts = conflicts
+        self._strengths = strengths
+        self._target_strengths = target_strengths
+        self.costs = [self.get_debate_cost(d) for d in range(len(aff))]
+        self.total = sum(self.costs)
+        # Number of debates between teams with a veto between them
+        self.veto_clashes = sum(self.is_vetoed(a, n) for a, n in zip(aff, neg))
+
+    def is_vetoed(self, aff, neg):
+        return self._pair_costs[aff][neg] >= VETO_COST
+
+    def get_debate_cost(self, d, aff=None, neg=None, panel=None):
+        """
+        Returns the cost of debate d, or what it would be with the attendances
+        and panel given instead.
+        """
+        aff = self.aff[d] if aff is None else aff
+        neg = self.neg[d] if neg is None else neg
+        panel = self.panels[d] if panel is None else panel
+        conflicts = self._conflicts
+        cost = self._pair_costs[aff][neg]
+        # How far each team is pushed off balance between affirmative and negative
+        cost += self._side_weight * (abs(self._sides[aff] + 1) + abs(self._sides[neg] - 1))
+        # Judges with vetoes against either team, and how far off the panel's strength is
+        cost += JUDGE_CONFLICT_COST * sum(conflicts[j][aff] + conflicts[j][neg] for j in panel)
+        cost += abs(sum(self._strengths[j] for j in panel) - self._target_strengths[d])
+        return cost
+
+    def copy_draw(self):
+        return list(self.aff), list(self.neg), [list(panel) for panel in self.panels]
+
+
+def _anneal(state, rng, iterations, deadline):
+    """
+    Runs simulated annealing on 'state', trying team swaps between debates,
+    side flips and judge swaps between panels. Team swaps are tried between
+    any two debates while a debate is against a veto, and only between nearby
+    debates (see SWAP_DISTANCE) after that.
+
+    :param deadline: the time.monotonic() to stop at, or None to try all the iterations
+    :return: (aff, neg, panels) of the best draw found
+    """
+    debates_count = len(state.aff)
+    best_total = state.total
+    best = state.copy_draw()
+    for iteration in range(iterations):
+        if deadline is not None and iteration % 64 == 0 and time.monotonic() >= deadline:
+            break
+        temperature = START_TEMPERATURE * (END_TEMPERATURE / START_TEMPERATURE) ** (iteration / iterations)
+
+        move = rng.random()
+        d1 = rng.randrange(debates_count)
+        if move < 0.2:
+            # Flip the sides of a debate
+            changes = {d1: (state.neg[d1], state.aff[d1], state.panels[d1])}
+        else:
+            if debates_count < 2:
+                continue
+            if state.veto_clashes:
+                d2 = rng.randrange(debates_count - 1)
+            else:
+                d2 = rng.randrange(max(0, d1 - SWAP_DISTANCE), min(debates_count, d1 + SWAP_DISTANCE + 1) - 1)
+            if d2 >= d1:
+                d2 += 1
+            if move < 0.7:
+                # Swap a team in one debate with a team in another, keeping their sides
+                teams1 = [state.aff[d1], state.neg[d1]]
+                teams2 = [state.aff[d2], state.neg[d2]]
+                side = rng.randrange(2)
+                teams1[side], teams2[side] = teams2[side], teams1[side]
+                changes = {d1: (teams1[0], teams1[1], state.panels[d1]),
+                           d2: (teams2[0], teams2[1], state.panels[d2])}
+            else:
+                # Swap a judge in one panel with a judge in another
+                if not state.panels[d1] or not state.panels[d2]:
+                    continue
+                panel1, panel2 = list(state.panels[d1]), list(state.panels[d2])
+                j1, j2 = rng.randrange(len(panel1)), rng.randrange(len(panel2))
+                panel1[j1], panel2[j2] = panel2[j2], panel1[j1]
+                changes = {d1: (state.aff[d1], state.neg[d1], panel1),
+                           d2: (state.aff[d2], state.neg[d2], panel2)}
+
+        new_costs = {d: state.get_debate_cost(d, *change) for d, change in changes.items()}
+        delta = sum(new_costs[d] - state.costs[d] for d in changes)
+        if delta <= 0 or rng.random() < math.exp(-delta / temperature):
+            for d, (aff, neg, panel) in changes.items():
+                state.veto_clashes += state.is_vetoed(aff, neg) - state.is_vetoed(state.aff[d], state.neg[d])
+                state.aff[d], state.neg[d], state.panels[d] = aff, neg, panel
+                state.costs[d] = new_costs[d]
+            state.total += delta
+            if state.total < best_total:
+                best_total = state.total
+                best = state.copy_draw()
+    return best
+
+
+def improve_draw(attendances_ranked, pairs, panels, judges, context: DrawContext,
+                    time_limit=None, iterations=None):
+    """
+    Improves a draw with simulated annealing over team swaps between debates,
+    side flips and judge swaps between panels. The cost of a draw is the sum of
+    the cost of each debate:
+        - the pairing cost from pairing.build_cost_matrix, with VETO_COST in
+          place of infinity for vetoed pairings
+        - how far each team is pushed off balance between affirmative and negative
+        - JUDGE_CONFLICT_COST per judge with a veto against either team, plus the
+          difference between the panel's strength and its target strength
+          (see judge_allocation.get_target_strengths)
+
+    The search is deterministic given the context's random number generator,
+    unless a time limit is given and reached first. All the data is taken
+    from the context, so the database is not queried.
+
+    :param attendances_ranked: attendances competing, ranked
+    :param pairs: list of (affirmative, negative) tuples, highest ranked debate first
+    :param panels: list of panels (lists of judges), one for each debate in 'pairs'
+    :param judges: the qualified judges available
+    :param context: snapshot of the attendances for the day, without the draw recorded
+    :param time_limit: the most time to spend, in seconds - none if None. A draw
+                       cut short by it cannot be reproduced from its seed.
+    :param iterations: number of moves to try - defaults to LOCAL_SEARCH_ITERATIONS_PER_DEBATE
+                       per debate, up to LOCAL_SEARCH_MAX_ITERATIONS
+    :return: (pairs, panels) of the best draw found, in the same format as given
+    :requires: every judge in 'panels' is in 'judges'
+    """
+    deadline = time.monotonic() + time_limit if time_limit is not None else None
+    if not pairs:
+        return pairs, panels
+    if iterations is None:
+        iterations = min(LOCAL_SEARCH_ITERATIONS_PER_DEBATE * len(pairs), LOCAL_SEARCH_MAX_ITERATIONS)
+
+    index = {attendance.pk: i for i, attendance in enumerate(attendances_ranked)}
+    judge_index = {judge.pk: j for j, judge in enumerate(judges)}
+
+    pair_costs = build_cost_matrix(attendances_ranked, context)
+    pair_costs[np.isinf(pair_costs)] = VETO_COST
+
+    conflicts = np.zeros((len(judges), len(attendances_ranked)), dtype=int)
+    for j, judge in enumerate(judges):
+        for attendance_pk in context.vetoes.get_speaker_conflicts(judge):
+            if attendance_pk in index:
+                conflicts[j, index[attendance_pk]] = 1
+
+    strengths = [judge.qualification_score for judge in judges]
+    target_strengths = [0] * len(pairs)
+    for debate_index, target in get_target_strengths(strengths, get_panel_sizes(len(judges), len(pairs))):
+        target_strengths[debate_index] += target
+
+    state = _DrawState(
+        aff=[index[affirmative.pk] for affirmative, negative in pairs],
+        neg=[index[negative.pk] for affirmative, negative in pairs],
+        panels=[[judge_index[judge.pk] for judge in panel] for panel in panels],
+        pair_costs=pair_costs.tolist(),
+        sides=[context.compare_aff_neg(attendance.team) for attendance in attendances_ranked],
+        side_weight=PAIRING_WEIGHTS['side_imbalance'],
+        conflicts=conflicts.tolist(),
+        strengths=strengths,
+        target_strengths=target_strengths,
+    )
+    aff, neg, panels = _anneal(state, context.rng, iterations, deadline)
+
+    pairs = [(attendances_ranked[a], attendances_ranked[n]) for a, n in zip(aff, neg)]
+    panels = [sorted((judges[j] for j in panel), key=lambda judge: judge.qualification_score, reverse=True)
+                for panel in panels]
+    return pairs, panels
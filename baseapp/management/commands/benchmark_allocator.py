@@ -0,0 +1,94 @@
+import json
+import platform
+import subprocess
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from baseapp.benchmark import BENCHMARK_SIZES, run_benchmark, test_database
+from baseapp.pairing import PAIRING_STRATEGIES
+
+
+def _get_commit():
+    """ Returns the current git commit, or None if it cannot be found. """
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL)\
+                    .decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class Command(BaseCommand):
+    help = "Times the allocator phase by phase on synthetic leagues, and writes the results to a JSON file. " \
+           "The leagues are drawn in a test database made for the run, never in the configured one."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', type=int, nargs='+', default=list(BENCHMARK_SIZES),
+                            help="Numbers of teams in the leagues.")
+        parser.add_argument('--strategies', nargs='+', default=['greedy', 'matching'],
+                            choices=sorted(PAIRING_STRATEGIES))
+        parser.add_argument('--improve', action='store_true', help="Improve the draws with local search.")
+        parser.add_argument('--vetoes', type=float, default=0.1, help="Average number of vetoes per team.")
+        parser.add_argument('--qualified-rate', type=float, default=0.5,
+                            help="Probability that a speaker is qualified as a judge.")
+        parser.add_argument('--history', type=int, default=5, help="Number of rounds played before the draw.")
+        parser.add_argument('--repeat', type=int, default=1, help="Number of runs of each benchmark.")
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--no-persist', action='store_true',
+                            help="Do not save the draws, and so do not time the persistence phase.")
+        parser.add_argument('--no-memory', action='store_true',
+                            help="Do not measure peak memory, which takes a second run of each draw.")
+        parser.add_argument('--output', default='bench_output.json', help="File to write the results to.")
+        parser.add_argument('--compare', help="Results file from an earlier run to compare against.")
+
+    def handle(self, *args, **options):
+        # The leagues are written to the database, so they go to a test database
+        with test_database():
+            results = []
+            for teams_count in options['sizes']:
+                for strategy in options['strategies']:
+                    for i in range(options['repeat']):
+                        result = run_benchmark(teams_count, strategy=strategy, improve=options['improve'],
+                                               vetoes_per_team=options['vetoes'],
+                                               qualified_rate=options['qualified_rate'],
+                                               history_rounds=options['history'], seed=options['seed'] + i,
+                                               persist=not options['no_persist'],
+                                               memory=not options['no_memory'])
+                        results.append(result)
+                        phases = ", ".join(f"{name} {totals['time'] * 1000:.0f}ms"
+                                           for name, totals in result['phases'].items())
+                        memory = f", {result['peak_memory'] / 2 ** 20:.1f}MiB peak" \
+                                    if result['peak_memory'] is not None else ""
+                        self.stdout.write(f"{teams_count} teams, {strategy}: {result['total_time'] * 1000:.0f}ms, " +
+                                          f"{result['queries']} queries{memory} ({phases})")
+
+        report = {
+            'commit': _get_commit(),
+            'created': timezone.now().isoformat(),
+            'python': platform.python_version(),
+            'options': {name: options[name] for name in ('sizes', 'strategies', 'improve', 'vetoes',
+                                                         'qualified_rate', 'history', 'repeat', 'seed',
+                                                         'no_persist', 'no_memory')},
+            'results': results,
+        }
+        with open(options['output'], 'w') as f:
+            json.dump(report, f, indent=2)
+        self.stdout.write(self.style.SUCCESS(f"Results written to {options['output']}."))
+
+        if options['compare']:
+            with open(options['compare']) as f:
+                earlier = json.load(f)
+            self._compare(earlier['results'], results)
+
+    def _compare(self, earlier, results):
+        """ Writes the change in the mean total time of each benchmark since the earlier results. """
+        def mean_times(runs):
+            times = {}
+            for run in runs:
+                times.setdefault((run['teams'], run['strategy']), []).append(run['total_time'])
+            return {key: sum(values) / len(values) for key, values in times.items()}
+
+        earlier_times = mean_times(earlier)
+        for key, time in mean_times(results).items():
+            if key in earlier_times and earlier_times[key] > 0:
+                change = (time - earlier_times[key]) / earlier_times[key]
+                self.stdout.write(f"{key[0]} teams, {key[1]}: {earlier_times[key] * 1000:.0f}ms -> " +
+                                  f"{time * 1000:.0f}ms ({change:+.0%})")
@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+from baseapp.standings import rebuild_speaker_scores, rebuild_standings
+
+
+class Command(BaseCommand):
+    help = "Recomputes the standings and ratings of all the teams and the speakers' running score totals from " + \
+           "the debate results and scores, e.g. after loading a fixture or editing the database by hand."
+
+    def handle(self, *args, **options):
+        count = rebuild_standings()
+        speaker_count = rebuild_speaker_scores()
+        self.stdout.write(self.style.SUCCESS(f"Rebuilt the standings of {count} teams and the score totals " +
+                                             f"of {speaker_count} speakers."))
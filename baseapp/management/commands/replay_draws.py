@@ -0,0 +1,62 @@
+import datetime
+import json
+from django.core.management.base import BaseCommand, CommandError
+from baseapp.models import MatchDay
+from baseapp.pairing import PAIRING_STRATEGIES
+from baseapp.replay import replay_history
+
+
+def _parse_date(value):
+    try:
+        return datetime.date.fromisoformat(value)
+    except ValueError:
+        raise CommandError(f"Invalid date: {value} - use YYYY-MM-DD.")
+
+
+class Command(BaseCommand):
+    help = "Reruns the allocator for past match days and compares the draws with the ones used. " + \
+           "Runs in a transaction that is rolled back - point DATABASE_URL at a copy of the database " + \
+           "to be safe."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--since', type=_parse_date, help="First date to replay (YYYY-MM-DD).")
+        parser.add_argument('--until', type=_parse_date, help="Last date to replay (YYYY-MM-DD).")
+        parser.add_argument('--strategies', nargs='+', default=['greedy', 'matching'],
+                            choices=sorted(PAIRING_STRATEGIES))
+        parser.add_argument('--improve', action='store_true', help="Improve the draws with local search.")
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--output', default='replay_output.jsonl',
+                            help="File to write the results to, one JSON line per match day.")
+
+    def handle(self, *args, **options):
+        match_days = MatchDay.objects.all()
+        if options['since']:
+            match_days = match_days.filter(date__gte=options['since'])
+        if options['until']:
+            match_days = match_days.filter(date__lte=options['until'])
+
+        replayed = 0
+        totals = {strategy: {'time': 0.0, 'score': 0, 'actual_score': 0, 'errors': 0}
+                  for strategy in options['strategies']}
+        with open(options['output'], 'w') as f:
+            for result in replay_history(match_days, strategies=options['strategies'],
+                                         improve=options['improve'], seed=options['seed']):
+                f.write(json.dumps(result) + "\n")
+                replayed += 1
+                for strategy, rerun in result['reruns'].items():
+                    totals[strategy]['time'] += rerun['time']
+                    if 'error' in rerun:
+                        totals[strategy]['errors'] += 1
+                    else:
+                        totals[strategy]['score'] += rerun['score']
+                        totals[strategy]['actual_score'] += result['actual']['score']
+                reruns = ", ".join(f"{strategy} {rerun['score'] if 'error' not in rerun else 'failed'} " +
+                                   f"in {rerun['time'] * 1000:.0f}ms"
+                                   for strategy, rerun in result['reruns'].items())
+                self.stdout.write(f"{result['date']}: used {result['actual']['score']}, {reruns}")
+
+        for strategy, total in totals.items():
+            self.stdout.write(f"{strategy}: total score {total['score']} against {total['actual_score']} " +
+                              f"for the draws used, {total['time']:.2f}s, {total['errors']} failed")
+        self.stdout.write(self.style.SUCCESS(f"{replayed} match days replayed - results written to "
+                                             f"{options['output']}."))
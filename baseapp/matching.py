@@ -0,0 +1,540 @@
+"""
+Weighted matching on general graphs, used to pair up teams for the draw.
+
+The implementation follows Edmonds' blossom algorithm with the primal-dual
+method described by Galil ("Efficient algorithms for finding maximum matching
+in graphs", 1986), and runs in O(n^3) time for a graph with n vertices.
+With integer weights, all computations are done on integers.
+
+This module is a port of mwmatching.py by Joris van Rantwijk
+(http://jorisvr.nl/article/maximum-matching), which its author placed in
+the public domain. The structure and variable names follow that file, so
+its comments also serve as documentation for the code below.
+"""
+
+
+def max_weight_matching(edges, max_cardinality=False):
+    """
+    Computes a maximum-weighted matching of the general undirected graph given.
+
+    :param edges: list of (i, j, weight) tuples, where i and j are vertex
+                  numbers in range(n) and weight is an integer
+    :param max_cardinality: if True, only maximum-cardinality matchings are
+                            considered as solutions
+    :return: list 'mate' of length n, where mate[i] is the vertex matched to
+             vertex i, or -1 if vertex i is not matched
+    """
+    if not edges:
+        return []
+
+    # Count vertices and find the maximum edge weight
+    nedge = len(edges)
+    nvertex = 0
+    for (i, j, w) in edges:
+        assert i >= 0 and j >= 0 and i != j
+        nvertex = max(nvertex, i + 1, j + 1)
+    maxweight = max(0, max(w for (i, j, w) in edges))
+
+    # If p is an edge endpoint, endpoint[p] is the vertex to which it is
+    # attached; edge k has endpoints 2k and 2k+1
+    endpoint = [edges[p // 2][p % 2] for p in range(2 * nedge)]
+
+    # neighbend[v] is the list of remote endpoints of the edges attached to v
+    neighbend = [[] for _ in range(nvertex)]
+    for k, (i, j, w) in enumerate(edges):
+        neighbend[i].append(2 * k + 1)
+        neighbend[j].append(2 * k)
+
+    # mate[v] is the remote endpoint of v's matched edge, or -1 if v is single
+    mate = nvertex * [-1]
+
+    # label[b] is 0 for free, 1 for S and 2 for T top-level blossoms (and vertices)
+    label = (2 * nvertex) * [0]
+
+    # labelend[b] is the endpoint through which b got its label, or -1
+    labelend = (2 * nvertex) * [-1]
+
+    # inblossom[v] is the top-level blossom to which vertex v belongs
+    inblossom = list(range(nvertex))
+
+    # blossomparent[b] is the immediate parent (sub-)blossom of b, or -1
+    blossomparent = (2 * nvertex) * [-1]
+
+    # blossomchilds[b] is the ordered list of sub-blossoms of b, starting
+    # with the base and going round the blossom
+    blossomchilds = (2 * nvertex) * [None]
+
+    # blossombase[b] is the base vertex of blossom b
+    blossombase = list(range(nvertex)) + nvertex * [-1]
+
+    # blossomendps[b] is the list of endpoints on the edges connecting the
+    # sub-blossoms of b, where blossomendps[b][i] connects blossomchilds[b][i]
+    # and blossomchilds[b][i+1]
+    blossomendps = (2 * nvertex) * [None]
+
+    # bestedge[b] is the least-slack edge to a different S-blossom, or -1
+    bestedge = (2 * nvertex) * [-1]
+
+    # blossombestedges[b] is the list of least-slack edges to neighbouring
+    # S-blossoms, for non-trivial top-level S-blossoms
+    blossombestedges = (2 * nvertex) * [None]
+
+    unusedblossoms = list(range(nvertex, 2 * nvertex))
+
+    # Dual variables; the vertex duals start at maxweight, blossom duals at 0
+    dualvar = nvertex * [maxweight] + nvertex * [0]
+
+    # allowedge[k] is True if edge k has zero slack
+    allowedge = nedge * [False]
+
+    # Queue of newly discovered S-vertices
+    queue = []
+
+    def slack(k):
+        (i, j, wt) = edges[k]
+        return dualvar[i] + dualvar[j] - 2 * wt
+
+    def blossom_leaves(b):
+        if b < nvertex:
+            yield b
+        else:
+            for t in blossomchilds[b]:
+                if t < nvertex:
+                    yield t
+                else:
+                    yield from blossom_leaves(t)
+
+    def assign_label(w, t, p):
+        # Assign label t to the top-level blossom containing vertex w,
+        # coming through endpoint p
+        b = inblossom[w]
+        label[w] = label[b] = t
+        labelend[w] = labelend[b] = p
+        bestedge[w] = bestedge[b] = -1
+        if t == 1:
+            # b became an S-blossom; add it to the queue
+            queue.extend(blossom_leaves(b))
+        elif t == 2:
+            # b became a T-blossom; assign label S to its mate
+            base = blossombase[b]
+            assign_label(endpoint[mate[base]], 1, mate[base] ^ 1)
+
+    def scan_blossom(v, w):
+        # Trace back from S-vertices v and w to discover either a new blossom
+        # (returns its base) or an augmenting path (returns -1)
+        path = []
+        base = -1
+        while v != -1 or w != -1:
+            b = inblossom[v]
+            if label[b] & 4:
+                base = blossombase[b]
+                break
+            path.append(b)
+            label[b] = 5
+            if labelend[b] == -1:
+                # The base of blossom b is single; stop tracing this path
+                v = -1
+            else:
+                v = endpoint[labelend[b]]
+                b = inblossom[v]
+                # b is a T-blossom; trace one more step back
+                v = endpoint[labelend[b]]
+            # Swap v and w so that we alternate between both paths
+            if w != -1:
+                v, w = w, v
+        # Remove the breadcrumbs
+        for b in path:
+            label[b] = 1
+        return base
+
+    def add_blossom(base, k):
+        # Construct a new blossom with the given base, containing edge k
+        (v, w, wt) = edges[k]
+        bb = inblossom[base]
+        bv = inblossom[v]
+        bw = inblossom[w]
+        b = unusedblossoms.pop()
+        blossombase[b] = base
+        blossomparent[b] = -1
+        blossomparent[bb] = b
+        blossomchilds[b] = path = []
+        blossomendps[b] = endps = []
+        # Trace back from v to base
+        while bv != bb:
+            blossomparent[bv] = b
+            path.append(bv)
+            endps.append(labelend[bv])
+            v = endpoint[labelend[bv]]
+            bv = inblossom[v]
+        path.append(bb)
+        path.reverse()
+        endps.reverse()
+        endps.append(2 * k)
+        # Trace back from w to base
+        while bw != bb:
+            blossomparent[bw] = b
+            path.append(bw)
+            endps.append(labelend[bw] ^ 1)
+            w = endpoint[labelend[bw]]
+            bw = inblossom[w]
+        # The new blossom is an S-blossom
+        label[b] = 1
+        labelend[b] = labelend[bb]
+        dualvar[b] = 0
+        # Relabel vertices
+        for v in blossom_leaves(b):
+            if label[inblossom[v]] == 2:
+                # This T-vertex now turns into an S-vertex
+                queue.append(v)
+            inblossom[v] = b
+        # Compute blossombestedges[b]
+        bestedgeto = (2 * nvertex) * [-1]
+        for bv in path:
+            if blossombestedges[bv] is None:
+                nblists = [[p // 2 for p in neighbend[v]] for v in blossom_leaves(bv)]
+            else:
+                nblists = [blossombestedges[bv]]
+            for nblist in nblists:
+                for k in nblist:
+                    (i, j, wt) = edges[k]
+                    if inblossom[j] == b:
+                        i, j = j, i
+                    bj = inblossom[j]
+                    if bj != b and label[bj] == 1 and \
+                            (bestedgeto[bj] == -1 or slack(k) < slack(bestedgeto[bj])):
+                        bestedgeto[bj] = k
+            blossombestedges[bv] = None
+            bestedge[bv] = -1
+        blossombestedges[b] = [k for k in bestedgeto if k != -1]
+        bestedge[b] = -1
+        for k in blossombestedges[b]:
+            if bestedge[b] == -1 or slack(k) < slack(bestedge[b]):
+                bestedge[b] = k
+
+    def expand_blossom(b, endstage):
+        # Expand the given top-level blossom
+        for s in blossomchilds[b]:
+            blossomparent[s] = -1
+            if s < nvertex:
+                inblossom[s] = s
+            elif endstage and dualvar[s] == 0:
+                expand_blossom(s, endstage)
+            else:
+                for v in blossom_leaves(s):
+                    inblossom[v] = s
+        # If we expand a T-blossom during a stage, its sub-blossoms must be
+        # relabeled
+        if not endstage and label[b] == 2:
+            # Start at the sub-blossom through which the expanding blossom got
+            # its label, and relabel sub-blossoms until we reach the base
+            entrychild = inblossom[endpoint[labelend[b] ^ 1]]
+            j = blossomchilds[b].index(entrychild)
+            if j & 1:
+                # Start index is odd; go forward and wrap
+                j -= len(blossomchilds[b])
+                jstep = 1
+                endptrick = 0
+            else:
+                # Start index is even; go backward
+                jstep = -1
+                endptrick = 1
+            # Move along the blossom until we get to the base
+            p = labelend[b]
+            while j != 0:
+                # Relabel the T-sub-blossom
+                label[endpoint[p ^ 1]] = 0
+                label[endpoint[blossomendps[b][j - endptrick] ^ endptrick ^ 1]] = 0
+                assign_label(endpoint[p ^ 1], 2, p)
+                # Step to the next S-sub-blossom and note its forward endpoint
+                allowedge[blossomendps[b][j - endptrick] // 2] = True
+                j += jstep
+                p = blossomendps[b][j - endptrick] ^ endptrick
+                # Step to the next T-sub-blossom
+                allowedge[p // 2] = True
+                j += jstep
+            # Relabel the base T-sub-blossom without creating more S-vertices
+            bv = blossomchilds[b][j]
+            label[endpoint[p ^ 1]] = label[bv] = 2
+            labelend[endpoint[p ^ 1]] = labelend[bv] = p
+            bestedge[bv] = -1
+            # Continue along the blossom until we get back to entrychild
+            j += jstep
+            while blossomchilds[b][j] != entrychild:
+                # Examine the vertices of the sub-blossom to see whether it is
+                # reachable from a neighbouring S-vertex outside the blossom
+                bv = blossomchilds[b][j]
+                if label[bv] == 1:
+                    # This sub-blossom just got label S through one of its
+                    # neighbours; leave it
+                    j += jstep
+                    continue
+                for v in blossom_leaves(bv):
+                    if label[v] != 0:
+                        break
+                # If the sub-blossom contains a reachable vertex, assign label T
+                if label[v] != 0:
+                    label[v] = 0
+                    label[endpoint[mate[blossombase[bv]]]] = 0
+                    assign_label(v, 2, labelend[v])
+                j += jstep
+        # Recycle the blossom number
+        label[b] = labelend[b] = -1
+        blossomchilds[b] = blossomendps[b] = None
+        blossombase[b] = -1
+        blossombestedges[b] = None
+        bestedge[b] = -1
+        unusedblossoms.append(b)
+
+    def augment_blossom(b, v):
+        # Swap matched/unmatched edges over an alternating path through
+        # blossom b between vertex v and the base vertex
+        t = v
+        while blossomparent[t] != b:
+            t = blossomparent[t]
+        # Recursively deal with the first sub-blossom
+        if t >= nvertex:
+            augment_blossom(t, v)
+        # Decide in which direction we will go round the blossom
+        i = j = blossomchilds[b].index(t)
+        if i & 1:
+            j -= len(blossomchilds[b])
+            jstep = 1
+            endptrick = 0
+        else:
+            jstep = -1
+            endptrick = 1
+        # Move along the blossom until we get to the base
+        while j != 0:
+            # Step to the next sub-blossom and augment it recursively
+            j += jstep
+            t = blossomchilds[b][j]
+            p = blossomendps[b][j - endptrick] ^ endptrick
+            if t >= nvertex:
+                augment_blossom(t, endpoint[p])
+            # Step to the next sub-blossom and augment it recursively
+            j += jstep
+            t = blossomchilds[b][j]
+            if t >= nvertex:
+                augment_blossom(t, endpoint[p ^ 1])
+            # Match the edge connecting those sub-blossoms
+            mate[endpoint[p]] = p ^ 1
+            mate[endpoint[p ^ 1]] = p
+        # Rotate the list of sub-blossoms to put the new base at the front
+        blossomchilds[b] = blossomchilds[b][i:] + blossomchilds[b][:i]
+        blossomendps[b] = blossomendps[b][i:] + blossomendps[b][:i]
+        blossombase[b] = blossombase[blossomchilds[b][0]]
+
+    def augment_matching(k):
+        # Swap matched/unmatched edges over an alternating path between two
+        # single vertices, which runs through edge k
+        (v, w, wt) = edges[k]
+        for (s, p) in ((v, 2 * k + 1), (w, 2 * k)):
+            # Match vertex s to remote endpoint p, then trace back from s
+            # until we find a single vertex, swapping matched and unmatched
+            # edges as we go
+            while True:
+                bs = inblossom[s]
+                # Augment through the S-blossom from s to its base
+                if bs >= nvertex:
+                    augment_blossom(bs, s)
+                mate[s] = p
+                # Trace one step back
+                if labelend[bs] == -1:
+                    # Reached a single vertex; stop
+                    break
+                t = endpoint[labelend[bs]]
+                bt = inblossom[t]
+                # Trace one more step back
+                s = endpoint[labelend[bt]]
+                j = endpoint[labelend[bt] ^ 1]
+                # Augment through the T-blossom from j to its base
+                if bt >= nvertex:
+                    augment_blossom(bt, j)
+                mate[j] = labelend[bt]
+                # Keep the opposite endpoint; it will be assigned to mate[s]
+                # in the next step
+                p = labelend[bt] ^ 1
+
+    # Each iteration of this loop is a "stage", which increases the number of
+    # matched vertices by two
+    for _ in range(nvertex):
+        # Remove labels from top-level blossoms and reset the least-slack edges
+        label[:] = (2 * nvertex) * [0]
+        bestedge[:] = (2 * nvertex) * [-1]
+        blossombestedges[nvertex:] = nvertex * [None]
+        allowedge[:] = nedge * [False]
+        queue[:] = []
+
+        # Label single blossoms/vertices with S and put them in the queue
+        for v in range(nvertex):
+            if mate[v] == -1 and label[inblossom[v]] == 0:
+                assign_label(v, 1, -1)
+
+        augmented = False
+        while True:
+            # Continue labeling until all vertices reachable through an
+            # alternating path have got a label
+            while queue and not augmented:
+                v = queue.pop()
+                # Scan the neighbours of S-vertex v
+                for p in neighbend[v]:
+                    k = p // 2
+                    w = endpoint[p]
+                    if inblossom[v] == inblossom[w]:
+                        # This edge is internal to a blossom; ignore it
+                        continue
+                    if not allowedge[k]:
+                        kslack = slack(k)
+                        if kslack <= 0:
+                            allowedge[k] = True
+                    if allowedge[k]:
+                        if label[inblossom[w]] == 0:
+                            # w is a free vertex; label it T and its mate S
+                            assign_label(w, 2, p ^ 1)
+                        elif label[inblossom[w]] == 1:
+                            # w is an S-vertex; look for a new blossom or an
+                            # augmenting path
+                            base = scan_blossom(v, w)
+                            if base >= 0:
+                                add_blossom(base, k)
+                            else:
+                                augment_matching(k)
+                                augmented = True
+                                break
+                        elif label[w] == 0:
+                            # w is inside a T-blossom but has not been reached
+                            # from an S-vertex yet
+                            label[w] = 2
+                            labelend[w] = p ^ 1
+                    elif label[inblossom[w]] == 1:
+                        # Keep track of the least-slack non-allowable edge to
+                        # a different S-blossom
+                        b = inblossom[v]
+                        if bestedge[b] == -1 or kslack < slack(bestedge[b]):
+                            bestedge[b] = k
+                    elif label[w] == 0:
+                        # w is a free vertex (or an unreached vertex inside a
+                        # T-blossom); keep track of the least-slack edge to it
+                        if bestedge[w] == -1 or kslack < slack(bestedge[w]):
+                            bestedge[w] = k
+
+            if augmented:
+                break
+
+            # There is no augmenting path under these constraints; compute
+            # delta and reduce slack in the optimization problem
+            deltatype = -1
+            delta = deltaedge = deltablossom = None
+
+            # Minimum value of any vertex dual
+            if not max_cardinality:
+                deltatype = 1
+                delta = min(dualvar[:nvertex])
+
+            # Minimum slack on any edge between an S-vertex and a free vertex
+            for v in range(nvertex):
+                if label[inblossom[v]] == 0 and bestedge[v] != -1:
+                    d = slack(bestedge[v])
+                    if deltatype == -1 or d < delta:
+                        delta = d
+                        deltatype = 2
+                        deltaedge = bestedge[v]
+
+            # Half the minimum slack on any edge between a pair of S-blossoms
+            for b in range(2 * nvertex):
+                if blossomparent[b] == -1 and label[b] == 1 and bestedge[b] != -1:
+                    kslack = slack(bestedge[b])
+                    d = kslack // 2 if isinstance(kslack, int) else kslack / 2
+                    if deltatype == -1 or d < delta:
+                        delta = d
+                        deltatype = 3
+                        deltaedge = bestedge[b]
+
+            # Minimum dual of any T-blossom
+            for b in range(nvertex, 2 * nvertex):
+                if blossombase[b] >= 0 and blossomparent[b] == -1 and label[b] == 2 and \
+                        (deltatype == -1 or dualvar[b] < delta):
+                    delta = dualvar[b]
+                    deltatype = 4
+                    deltablossom = b
+
+            if deltatype == -1:
+                # No further improvement possible; max-cardinality optimum
+                # reached. Do a final delta update to make the optimum verifiable
+                deltatype = 1
+                delta = max(0, min(dualvar[:nvertex]))
+
+            # Update the dual variables according to delta
+            for v in range(nvertex):
+                if label[inblossom[v]] == 1:
+                    dualvar[v] -= delta
+                elif label[inblossom[v]] == 2:
+                    dualvar[v] += delta
+            for b in range(nvertex, 2 * nvertex):
+                if blossombase[b] >= 0 and blossomparent[b] == -1:
+                    if label[b] == 1:
+                        dualvar[b] += delta
+                    elif label[b] == 2:
+                        dualvar[b] -= delta
+
+            # Take action at the point where the minimum delta occurred
+            if deltatype == 1:
+                # No further improvement possible; optimum reached
+                break
+            elif deltatype == 2:
+                # Use the least-slack edge to continue the search
+                allowedge[deltaedge] = True
+                (i, j, wt) = edges[deltaedge]
+                if label[inblossom[i]] == 0:
+                    i, j = j, i
+                queue.append(i)
+            elif deltatype == 3:
+                # Use the least-slack edge to continue the search
+                allowedge[deltaedge] = True
+                (i, j, wt) = edges[deltaedge]
+                queue.append(i)
+            elif deltatype == 4:
+                # Expand the least-z blossom
+                expand_blossom(deltablossom, False)
+
+        # Stop when no more augmenting path can be found
+        if not augmented:
+            break
+
+        # End of a stage; expand all S-blossoms which have dualvar = 0
+        for b in range(nvertex, 2 * nvertex):
+            if blossomparent[b] == -1 and blossombase[b] >= 0 and \
+                    label[b] == 1 and dualvar[b] == 0:
+                expand_blossom(b, True)
+
+    # Transform mate[] such that mate[v] is the vertex to which v is paired
+    for v in range(nvertex):
+        if mate[v] >= 0:
+            mate[v] = endpoint[mate[v]]
+
+    return mate
+
+
+def min_cost_perfect_matching(n, costs):
+    """
+    Finds a perfect matching of minimum total cost on the graph with vertices
+    range(n) and the given edge costs.
+
+    :param n: the number of vertices
+    :param costs: dict mapping (i, j) vertex pairs to an integer cost; pairs
+                  missing from the dict cannot be matched
+    :return: list of (i, j) pairs, or None if no perfect matching exists
+    """
+    if n == 0:
+        return []
+    if n % 2 != 0 or not costs:
+        return None
+
+    # A maximum-cardinality matching of maximum weight (max cost + 1 - cost) is
+    # a perfect matching of minimum cost, if a perfect matching exists at all
+    max_cost = max(costs.values())
+    edges = [(i, j, max_cost + 1 - cost) for (i, j), cost in costs.items()]
+    mate = max_weight_matching(edges, max_cardinality=True)
+    if len(mate) < n or -1 in mate:
+        return None
+    return [(i, mate[i]) for i in range(n) if i < mate[i]]
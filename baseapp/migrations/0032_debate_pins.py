@@ -0,0 +1,28 @@
+# Generated by Django 2.2.13 on 2026-10-18 12:23
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('baseapp', '0031_auto_20190404_1234'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='debate',
+            name='judges_pinned',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name='debate',
+            name='pinned',
+            field=models.BooleanField(default=False, verbose_name='Teams pinned'),
+        ),
+        migrations.AddField(
+            model_name='debate',
+            name='room_pinned',
+            field=models.BooleanField(default=False),
+        ),
+    ]
@@ -0,0 +1,63 @@
+# Generated by Django 2.2.13 on 2026-10-18 12:41
+
+from django.db import migrations, models
+import django.db.models.deletion
+from collections import Counter, defaultdict
+
+
+def fill_standings(apps, schema_editor):
+    """ Computes the standings of the existing teams, as standings.rebuild_standings does. """
+    Debate = apps.get_model('baseapp', 'Debate')
+    Score = apps.get_model('baseapp', 'Score')
+    Team = apps.get_model('baseapp', 'Team')
+    TeamStanding = apps.get_model('baseapp', 'TeamStanding')
+
+    changes = defaultdict(Counter)
+    for winning_team_id, affirmative_team_id, negative_team_id in \
+            Debate.objects.filter(winning_team__isnull=False)\
+                .values_list('winning_team', 'affirmative__team', 'negative__team'):
+        changes[winning_team_id]['wins'] += 1
+        for team_id, side_field in ((affirmative_team_id, 'affirmative_count'), (negative_team_id, 'negative_count')):
+            if team_id is None:
+                continue
+            changes[team_id]['debates'] += 1
+            changes[team_id][side_field] += 1
+            if team_id != winning_team_id:
+                changes[team_id]['losses'] += 1
+    for team_id, score_sum, score_count in Score.objects.filter(speaker__team__isnull=False)\
+            .values_list('speaker__team').annotate(models.Sum('score'), models.Count('pk')).order_by():
+        changes[team_id]['score_sum'] += score_sum
+        changes[team_id]['score_count'] += score_count
+
+    TeamStanding.objects.bulk_create([
+        TeamStanding(team_id=team_id, **changes.get(team_id, {}))
+        for team_id in Team.objects.values_list('pk', flat=True)
+    ])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('baseapp', '0032_debate_pins'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TeamStanding',
+            fields=[
+                ('team', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='standing', serialize=False, to='baseapp.Team')),
+                ('wins', models.IntegerField(default=0)),
+                ('losses', models.IntegerField(default=0)),
+                ('debates', models.IntegerField(default=0)),
+                ('affirmative_count', models.IntegerField(default=0)),
+                ('negative_count', models.IntegerField(default=0)),
+                ('score_sum', models.DecimalField(decimal_places=1, default=0, max_digits=10)),
+                ('score_count', models.IntegerField(default=0)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='teamstanding',
+            index=models.Index(fields=['-wins'], name='baseapp_standing_wins_idx'),
+        ),
+        migrations.RunPython(fill_standings, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 2.2.13 on 2026-10-18 12:43
+
+from django.db import migrations, models
+
+
+def fill_score_totals(apps, schema_editor):
+    """ Computes the running score totals of the existing speakers, as standings.rebuild_speaker_scores does. """
+    Score = apps.get_model('baseapp', 'Score')
+    Speaker = apps.get_model('baseapp', 'Speaker')
+
+    totals = {speaker_id: (score_sum, score_count) for speaker_id, score_sum, score_count in
+              Score.objects.values_list('speaker').annotate(models.Sum('score'), models.Count('pk')).order_by()}
+    speakers = list(Speaker.objects.filter(pk__in=totals).only('pk'))
+    for speaker in speakers:
+        speaker.score_sum, speaker.score_count = totals[speaker.pk]
+    Speaker.objects.bulk_update(speakers, ['score_sum', 'score_count'], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('baseapp', '0033_teamstanding'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='speaker',
+            name='score_count',
+            field=models.IntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='speaker',
+            name='score_sum',
+            field=models.DecimalField(decimal_places=1, default=0, editable=False, max_digits=8),
+        ),
+        migrations.RunPython(fill_score_totals, migrations.RunPython.noop),
+    ]
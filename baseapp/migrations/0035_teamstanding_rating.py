@@ -0,0 +1,82 @@
+# Generated by Django 2.2.13 on 2026-10-18 12:45
+
+import math
+from collections import defaultdict
+from django.db import migrations, models
+import django.db.models.deletion
+
+# Copied from ratings.py as they were when the ratings were added, so that
+# the migration does not change along with the app
+INITIAL_RATING = 1500.0
+K_FACTOR = 32
+RATING_SCALE = 400
+MARGIN_WEIGHT = 0.25
+
+
+def get_rating_change(winner_rating, loser_rating, margin):
+    """ Returns the number of points the winner of a debate gains, as ratings.get_rating_change does. """
+    expected = 1 / (1 + 10 ** ((loser_rating - winner_rating) / RATING_SCALE))
+    return K_FACTOR * (1 + MARGIN_WEIGHT * math.log1p(max(margin, 0))) * (1 - expected)
+
+
+def fill_ratings(apps, schema_editor):
+    """ Replays the existing results into the ratings, as ratings.rebuild_ratings does. """
+    Debate = apps.get_model('baseapp', 'Debate')
+    Score = apps.get_model('baseapp', 'Score')
+    TeamStanding = apps.get_model('baseapp', 'TeamStanding')
+
+    debates = Debate.objects.filter(winning_team__isnull=False, match_day__isnull=False)
+    debate_scores = defaultdict(dict)
+    for debate_id, team_id, score_sum in Score.objects.filter(debate__in=debates)\
+            .values_list('debate', 'speaker__team').annotate(models.Sum('score')).order_by():
+        debate_scores[debate_id][team_id] = float(score_sum)
+    ratings = defaultdict(lambda: INITIAL_RATING)
+    latest = {}
+    for debate_id, winner_id, affirmative_team_id, negative_team_id in \
+            debates.order_by('match_day__date', 'pk')\
+                .values_list('pk', 'winning_team', 'affirmative__team', 'negative__team'):
+        loser_id = negative_team_id if winner_id == affirmative_team_id else affirmative_team_id
+        if loser_id is None or loser_id == winner_id:
+            continue
+        scores = debate_scores[debate_id]
+        margin = scores.get(winner_id, 0) - scores.get(loser_id, 0)
+        latest.update({team_id: (debate_id, ratings[team_id]) for team_id in (winner_id, loser_id)})
+        change = get_rating_change(ratings[winner_id], ratings[loser_id], margin)
+        ratings[winner_id] += change
+        ratings[loser_id] -= change
+
+    standings = list(TeamStanding.objects.filter(team__in=list(latest)))
+    for standing in standings:
+        standing.rating = ratings[standing.team_id]
+        standing.rated_debate_id, standing.rating_before = latest[standing.team_id]
+    TeamStanding.objects.bulk_update(standings, ['rating', 'rated_debate', 'rating_before'], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('baseapp', '0034_speaker_score_totals'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='teamstanding',
+            name='rating',
+            field=models.FloatField(default=1500.0),
+        ),
+        migrations.AddIndex(
+            model_name='teamstanding',
+            index=models.Index(fields=['-rating'], name='baseapp_standing_rating_idx'),
+        ),
+        migrations.AddField(
+            model_name='teamstanding',
+            name='rated_debate',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='baseapp.Debate'),
+        ),
+        migrations.AddField(
+            model_name='teamstanding',
+            name='rating_before',
+            field=models.FloatField(default=1500.0),
+        ),
+        migrations.RunPython(fill_ratings, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 2.2.13 on 2026-10-18 13:08
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('baseapp', '0035_teamstanding_rating'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='attendance',
+            name='withdrawn',
+            field=models.BooleanField(default=False),
+        ),
+    ]
@@ -1,8 +1,10 @@
 from django.db import models
+from django.db.models.functions import NullIf
 from datetime import datetime, timedelta, tzinfo
 from django.utils import timezone
 from django.core.validators import MinValueValidator, MaxValueValidator
 from django.core.exceptions import ValidationError, NON_FIELD_ERRORS
+from . import core
 
 # TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
 TIME_FORMAT = '%Y-%m-%d'
@@ -14,34 +16,81 @@ class Team(models.Model):
     name = models.CharField(max_length=200, unique=True, verbose_name="Team Name")
     judged_before = models.BooleanField(default=False)
 
+    def _get_standing(self):
+        try:
+            return self.standing
+        except TeamStanding.DoesNotExist:
+            return TeamStanding(team=self)
+
     def get_speakers_avg_score(self):
-        avg = 0
-        speakers = self.speaker_set.all()
-        if not speakers:
-            return avg  # No speakers in team yet
-        for speaker in speakers:
-            avg += speaker.get_avg_score()
-        avg /= len(speakers)
-        return avg
+        return self._get_standing().get_speakers_avg_score()
 
     def count_qualified_judges(self):
         return sum(1 for speaker in self.speaker_set.all() if speaker.is_qualified_as_judge())
 
     def get_wins(self):
-        return self.debates_won.count()
+        return self._get_standing().wins
+
+    def get_rating(self):
+        return self._get_standing().rating
 
     def __str__(self):
         return self.name
 
 
-class SpeakerManager(models.Manager):
+class TeamStanding(models.Model):
+    """
+    The results of a team so far, kept up to date as results and scores are
+    entered (see signals.py), so that standings can be read in one query.
+    Only debates with a result count. Rebuild with the rebuild_standings command.
+    """
+
+    INITIAL_RATING = 1500.0
+
+    team = models.OneToOneField(Team, primary_key=True, on_delete=models.CASCADE, related_name="standing")
+    wins = models.IntegerField(default=0)
+    losses = models.IntegerField(default=0)
+    debates = models.IntegerField(default=0)
+    affirmative_count = models.IntegerField(default=0)
+    negative_count = models.IntegerField(default=0)
+    # Scores of the team's speakers
+    score_sum = models.DecimalField(max_digits=10, decimal_places=1, default=0)
+    score_count = models.IntegerField(default=0)
+    # Elo rating of the team (see ratings.py)
+    rating = models.FloatField(default=INITIAL_RATING)
+    # The debate of the team's latest rated result, and the team's rating
+    # before it - so that the result can be rated again with new scores
+    rated_debate = models.ForeignKey('Debate', null=True, on_delete=models.SET_NULL, related_name='+')
+    rating_before = models.FloatField(default=INITIAL_RATING)
+
+    class Meta:
+        indexes = [models.Index(fields=['-wins'], name='baseapp_standing_wins_idx'),
+                   models.Index(fields=['-rating'], name='baseapp_standing_rating_idx')]
+
+    def __str__(self):
+        return f"{self.team}: {self.wins} wins, {self.losses} losses"
+
+    def get_speakers_avg_score(self):
+        return float(self.score_sum) / self.score_count if self.score_count else 0
+
+
+class SpeakerAnalyticsManager(models.Manager):
+    """
+    Speakers with the average, number and best of their scores computed from
+    the Score table (avg_score, scores_counted, best_score). Joins and groups
+    all of the speakers' scores, so only use it for reports - otherwise use
+    the running totals on Speaker.
+    """
+
     def get_queryset(self):
-        return super().get_queryset().annotate(models.Avg('score'))
+        return super().get_queryset().annotate(avg_score=models.Avg('score__score'),
+                                               scores_counted=models.Count('score'),
+                                               best_score=models.Max('score__score'))
 
 
 class Speaker(models.Model):
 
-    JUDGE_THRESHOLD = 1
+    JUDGE_THRESHOLD = core.JUDGE_THRESHOLD
 
     WEIGHTS = {
         'StateTeam': 10,
@@ -55,7 +104,11 @@ class Speaker(models.Model):
         'HighQualified': 20,
         'JudgeBreak': 30
     }
-    objects = SpeakerManager()
+    # Fields kept up to date as scores are saved and deleted (see signals.py)
+    RUNNING_FIELDS = ('score_sum', 'score_count')
+
+    objects = models.Manager()
+    analytics = SpeakerAnalyticsManager()
 
     name = models.CharField(max_length=50)
     team = models.ForeignKey(Team, blank=True, null=True,
@@ -71,15 +124,16 @@ class Speaker(models.Model):
     high_qualified = models.BooleanField(default=False)
     judge_break = models.BooleanField(default=False)
     qualification_score = models.IntegerField(editable=False, default=0)
+    score_sum = models.DecimalField(max_digits=8, decimal_places=1, editable=False, default=0)
+    score_count = models.IntegerField(editable=False, default=0)
 
     def __str__(self):
         return self.name
 
     def get_avg_score(self):
-        avg = Score.objects.filter(speaker=self)\
-                .aggregate(models.Avg('score'))['score__avg']
-        return avg if avg else 0
-    get_avg_score.admin_order_field = 'score__avg'
+        return float(self.score_sum) / self.score_count if self.score_count else 0
+    get_avg_score.admin_order_field = models.ExpressionWrapper(
+        models.F('score_sum') / NullIf('score_count', 0), output_field=models.DecimalField())
     get_avg_score.short_description = 'Average Score'
 
     def _get_qualification_score(self) -> int:
@@ -98,6 +152,11 @@ class Speaker(models.Model):
 
     def save(self, *args, **kwargs):
         self.qualification_score = self._get_qualification_score()
+        if not self._state.adding and kwargs.get('update_fields') is None:
+            # The running score totals may have moved on since this speaker
+            # was loaded, so they are left to the score signal handlers
+            kwargs['update_fields'] = [field.name for field in self._meta.concrete_fields
+                                       if not field.primary_key and field.name not in self.RUNNING_FIELDS]
         super().save(*args, **kwargs)
 
     def is_qualified_as_judge(self):
@@ -110,6 +169,8 @@ class Attendance(models.Model):
     team = models.ForeignKey(Team, on_delete=models.CASCADE)
     speakers = models.ManyToManyField(Speaker)
     want_to_judge = models.BooleanField(default=False, verbose_name="prefer to judge")
+    # The team pulled out after the draw was made (see repair.repair_draw)
+    withdrawn = models.BooleanField(default=False)
 
     def count_qualified_judges(self):
         return sum(1 for speaker in self.speakers.all() if speaker.is_qualified_as_judge())
@@ -127,6 +188,10 @@ class Debate(models.Model):
                                         default=None, on_delete=models.CASCADE,
                                             related_name="debates_won")
     room = models.ForeignKey('Room', on_delete=models.SET_NULL, blank=True, null=True)
+    # Parts of the debate that are kept when the rest of the draw is redone
+    pinned = models.BooleanField(default=False, verbose_name="Teams pinned")
+    judges_pinned = models.BooleanField(default=False)
+    room_pinned = models.BooleanField(default=False)
     
     def __str__(self):
         return f"{self.match_day}"
@@ -158,6 +223,14 @@ class MatchDay(models.Model):
     def __str__(self):
         return f"{self.date}"
 
+    def is_draw_editable(self):
+        """
+        Returns True if the draw can still be redone or repaired: it is for
+        today, and none of its debates have a result or scores yet.
+        """
+        return self.date == timezone.localdate() and not self.debate_set.filter(
+            models.Q(winning_team__isnull=False) | models.Q(score__isnull=False)).exists()
+
 class Score(models.Model):
 
     speaker = models.ForeignKey(Speaker, on_delete=models.CASCADE)
@@ -0,0 +1,150 @@
+import numpy as np
+from .draw_context import DrawContext
+from .matching import min_cost_perfect_matching
+from .ratings import get_ranking
+
+# Penalties for the matching strategy
+PAIRING_WEIGHTS = {
+    'win_gap': 20,          # per win between the two teams
+    'score_gap': 2,         # per point between the two teams' speaker average scores
+    'rating_gap': 0.5,      # per point between the two teams' ratings, in place of
+                            # the win and score gaps when ranking by rating
+    'rank_gap': 1,          # per position between the two teams in the rankings
+    'repeat': 40,           # per time the two teams have met before
+    'side_imbalance': 5,    # per debate the less imbalanced team is pushed further off balance
+}
+
+# Each team is only considered against the teams up to this many places
+# away in the rankings - widened to all teams if no valid draw is found
+PAIRING_WINDOW = 10
+
+# Greedy strategy: maximum difference in wins between two teams
+TEAM_WINS_DELTA_LIMIT = 1
+
+
+def greedy_pairing(attendances_ranked, context: DrawContext):
+    """
+    Pairs up attendances by repeatedly taking the highest ranked attendance and
+    pairing it with the next highest ranked attendance whose team it has not
+    debated before and whose wins are within TEAM_WINS_DELTA_LIMIT.
+    Vetoes are not taken into account.
+
+    :param attendances_ranked: attendances competing, ranked
+    :return: list of (attendance, attendance) tuples, highest ranked debate first
+    """
+    attendances_competing = list(attendances_ranked)
+    pairs = []
+    while len(attendances_competing) >= 2:
+        attendance1 = attendances_competing.pop(0)
+        # Find opponent
+        for j, attendance in enumerate(attendances_competing):
+            # TODO: can optimise so that we don't go through entire list
+            if not context.is_debated_before(attendance1.team, attendance.team) and \
+                    abs(context.get_wins(attendance1.team) - context.get_wins(attendance.team)) <= \
+                        TEAM_WINS_DELTA_LIMIT:
+                attendance2 = attendances_competing.pop(j)
+                break
+        else:
+            # No opponent found that attendance1's team has not VS'ed before
+            # In this case debate with the highest ranked team it has met the least
+            j = min(range(len(attendances_competing)), key=lambda j: context.head_to_head.times_met(
+                attendance1.team, attendances_competing[j].team))
+            attendance2 = attendances_competing.pop(j)
+        pairs.append((attendance1, attendance2))
+    return pairs
+
+
+def build_cost_matrix(attendances_ranked, context: DrawContext, ranking=None):
+    """
+    Builds the matrix of pairing costs between the given attendances, where
+    entry [i, j] is the cost of having attendances_ranked[i] debate
+    attendances_ranked[j], weighted by PAIRING_WEIGHTS:
+        - the difference in wins between the two teams, and between their
+          speaker average scores - or the difference between their ratings
+          when ranking by rating
+        - the number of places between the two attendances in the rankings
+        - the number of times the two teams have met before
+        - how far the less imbalanced team would be pushed off balance between
+          affirmative and negative, if both teams need the same side
+
+    Pairings that are vetoed, and each attendance against itself, cost infinity.
+
+    :param attendances_ranked: attendances competing, ranked
+    :param ranking: name of the ranking the attendances are ranked by - ratings.get_ranking() if None
+    :return: n x n numpy array of costs
+    """
+    teams = [attendance.team for attendance in attendances_ranked]
+    n = len(teams)
+    sides = np.array([context.compare_aff_neg(team) for team in teams], dtype=float)
+    ranks = np.arange(n, dtype=float)
+
+    side_imbalance = np.where(
+        np.outer(sides, sides) > 0,
+        np.minimum(np.abs(sides)[:, None], np.abs(sides)[None, :]),
+        0
+    )
+
+    if (ranking or get_ranking()) == 'rating':
+        ratings = np.array([context.get_rating(team) for team in teams], dtype=float)
+        standing_gap = PAIRING_WEIGHTS['rating_gap'] * np.abs(ratings[:, None] - ratings[None, :])
+    else:
+        wins = np.array([context.get_wins(team) for team in teams], dtype=float)
+        scores = np.array([context.get_speakers_avg_score(team) for team in teams], dtype=float)
+        standing_gap = PAIRING_WEIGHTS['win_gap'] * np.abs(wins[:, None] - wins[None, :]) + \
+                       PAIRING_WEIGHTS['score_gap'] * np.abs(scores[:, None] - scores[None, :])
+
+    costs = standing_gap + \
+            PAIRING_WEIGHTS['rank_gap'] * np.abs(ranks[:, None] - ranks[None, :]) + \
+            PAIRING_WEIGHTS['repeat'] * context.head_to_head.as_matrix(teams) + \
+            PAIRING_WEIGHTS['side_imbalance'] * side_imbalance
+
+    costs[context.vetoes.as_matrix(attendances_ranked)] = np.inf
+    np.fill_diagonal(costs, np.inf)
+    return costs
+
+
+def matching_pairing(attendances_ranked, context: DrawContext, window=PAIRING_WINDOW, costs=None):
+    """
+    Pairs up attendances by solving a minimum-cost perfect matching, where the
+    cost of each pairing is given by build_cost_matrix. Vetoed pairings are never
+    made.
+
+    Only pairings between attendances up to 'window' places apart in the rankings
+    are considered, which keeps the matching fast on large nights. If no valid
+    draw can be found within the window, all pairings are considered.
+
+    :param attendances_ranked: attendances competing, ranked
+    :param window: how many places apart two attendances can be, or None for no limit
+    :param costs: the cost matrix from build_cost_matrix - built if not given
+    :return: list of (attendance, attendance) tuples, highest ranked debate first,
+             or None if there is no draw that satisfies the vetoes
+    """
+    n = len(attendances_ranked)
+    if window is not None and window >= n - 1:
+        window = None
+    if costs is None:
+        costs = build_cost_matrix(attendances_ranked, context)
+
+    # Candidate pairings: finite cost and (i < j <= i + window)
+    i, j = np.triu_indices(n, 1)
+    if window is not None:
+        in_window = j - i <= window
+        i, j = i[in_window], j[in_window]
+    pair_costs = costs[i, j]
+    allowed = np.isfinite(pair_costs)
+    i, j, pair_costs = i[allowed], j[allowed], np.rint(pair_costs[allowed]).astype(int)
+
+    matching = min_cost_perfect_matching(n, dict(zip(zip(i.tolist(), j.tolist()), pair_costs.tolist())))
+    if matching is None:
+        if window is not None:
+            return matching_pairing(attendances_ranked, context, window=None, costs=costs)
+        return None
+
+    matching.sort()
+    return [(attendances_ranked[i], attendances_ranked[j]) for i, j in matching]
+
+
+PAIRING_STRATEGIES = {
+    'greedy': greedy_pairing,
+    'matching': matching_pairing,
+}
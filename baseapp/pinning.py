@@ -0,0 +1,146 @@
+from django.db import transaction
+from django.db.models import F, Q
+from .models import Attendance, Debate, MatchDay, Veto, Room
+from .draw_context import DrawContext
+from .exceptions import NotEnoughAttendancesException, NotEnoughJudgesException, NotEnoughRoomsException
+from .judge_allocation import allocate_judges
+from .allocator import get_qualified_judges, rank_attendances, create_debates, plan_pairings, check_draw_editable
+from . import draw_cache
+
+
+def get_pinned_attendances(debates):
+    """ Returns the pks of the attendances in the debates whose teams are pinned. """
+    return {attendance_pk for debate in debates if debate.pinned
+                for attendance_pk in (debate.affirmative_id, debate.negative_id)}
+
+
+def get_pinned_judges(debates):
+    """ Returns the pks of the judges in the debates whose judges are pinned. """
+    return {judge.pk for debate in debates if debate.judges_pinned for judge in debate.judges.all()}
+
+
+def redo_unpinned_debates(match_day: MatchDay, rng=None, strategy='matching', ignore_rooms=False,
+                            improve=False):
+    """
+    Redoes the draw for a match day around the parts of it that are pinned:
+        - a debate with its teams pinned (Debate.pinned) keeps its teams and sides
+        - a debate with its judges pinned keeps its panel
+        - a debate with its room pinned keeps its room
+
+    The pinned attendances, judges and rooms are taken out of the problem, and
+    only the rest is solved - the free attendances are paired up as in a full
+    draw, and the free judges are allocated to the debates without a pinned
+    panel. As only the remainder is solved, a draw with most debates pinned is
+    redone in a fraction of the time of a full run.
+
+    The existing debate rows are reused for the new pairs (rows with a pinned
+    panel or room first, so that they keep them), and only the rows that change
+    are written, in a single transaction.
+
+    :param match_day: the MatchDay to redo the draw for
+    :param rng: random.Random instance for random choices
+    :param strategy: name of the pairing strategy in pairing.PAIRING_STRATEGIES to use
+    :param ignore_rooms: if True, rooms are neither checked nor assigned
+    :param improve: if True, the new pairs are improved with local search
+    :return: dict with the number of debates 'created', 'updated' and 'deleted',
+             and the number of 'panels_changed'
+    :raises DrawLockedException: if the draw is not for today, or has results
+    :raises VetoConflictException: if the free attendances cannot be paired up
+    :raises CannotFindWorkingConfigurationException: if the vetoes cannot be satisfied
+    :raises NotEnoughAttendancesException: if an odd number of attendances are free
+    :raises NotEnoughJudgesException: if there are not enough free judges for the debates
+    :raises NotEnoughRoomsException: if there are not enough free rooms for the debates
+    """
+    check_draw_editable(match_day)
+    debates = list(match_day.debate_set.order_by('pk').prefetch_related('judges'))
+    context = DrawContext(
+        Attendance.objects.filter(Q(competing_matchdays=match_day) | Q(judging_matchdays=match_day))
+            .distinct().order_by('pk'),
+        date=match_day.date, rng=rng
+    )
+
+    # Take the pinned attendances, judges and rooms out of the problem
+    pinned_attendances = get_pinned_attendances(debates)
+    pinned_judges = get_pinned_judges(debates)
+    attendances_free = [attendance for attendance in context.get_attendances(
+                            match_day.attendances_competing.values_list('pk', flat=True))
+                        if attendance.pk not in pinned_attendances]
+    if len(attendances_free) % 2 != 0:
+        raise NotEnoughAttendancesException(
+            "An odd number of teams are not pinned - please pin or unpin a debate, or change the teams competing.")
+    judges_free = [judge
+                   for attendance in context.get_attendances(
+                       match_day.attendances_judging.values_list('pk', flat=True))
+                   for judge in get_qualified_judges(attendance) if judge.pk not in pinned_judges]
+
+    # Rows that can be reused for the new pairs - those with pins first, to keep them
+    pinned_debates = [debate for debate in debates if debate.pinned]
+    attendances = {attendance.pk: attendance for attendance in context.attendances}
+    for debate in pinned_debates:
+        debate.affirmative = attendances[debate.affirmative_id]
+        debate.negative = attendances[debate.negative_id]
+    reusable = sorted((debate for debate in debates if not debate.pinned),
+                      key=lambda debate: not (debate.judges_pinned or debate.room_pinned))
+    pairs_count = len(attendances_free) // 2
+    reused, deleted_debates = reusable[:pairs_count], reusable[pairs_count:]
+    new_debates = [Debate(match_day=match_day) for _ in range(pairs_count - len(reused))]
+    # Judges of deleted rows are free again, even if pinned
+    judges_free += [judge for debate in deleted_debates if debate.judges_pinned for judge in debate.judges.all()]
+
+    # Debates whose panel is allocated again
+    final_debates = pinned_debates + reused + new_debates
+    reallocated = [debate for debate in final_debates if not debate.judges_pinned]
+    if len(judges_free) < len(reallocated):
+        raise NotEnoughJudgesException(
+            f"{len(judges_free)} judges are not pinned, but {len(reallocated)} debates need a panel.")
+
+    # Pair up the free attendances
+    sides, vetoes_affected = [], []
+    if attendances_free:
+        sides, vetoes_affected = plan_pairings(attendances_free, context, strategy=strategy, improve=improve)
+    for debate, (affirmative, negative) in zip(reused + new_debates, sides):
+        debate.affirmative, debate.negative = affirmative, negative
+
+    # Rooms for the debates without a pinned room, highest ranked debate first
+    if not ignore_rooms:
+        unpinned_rooms = [debate for debate in final_debates if not debate.room_pinned]
+        rooms_taken = {debate.room_id for debate in final_debates if debate.room_pinned}
+        rooms_free = [room for room in Room.objects.filter(date=match_day.date) if room.pk not in rooms_taken]
+        if len(rooms_free) < len(unpinned_rooms):
+            raise NotEnoughRoomsException("Not enough rooms are left for the debates without a pinned room.")
+        ranked = rank_attendances([attendance for debate in unpinned_rooms for attendance in debate.get_attendances()],
+                                  context)
+        rank = {attendance.pk: i for i, attendance in enumerate(ranked)}
+        unpinned_rooms.sort(key=lambda debate: min(rank[debate.affirmative_id], rank[debate.negative_id]))
+        for debate, room in zip(unpinned_rooms, rooms_free):
+            debate.room = room
+
+    # Allocate the free judges to all the debates without a pinned panel together
+    panels = allocate_judges(judges_free, [(debate.affirmative, debate.negative) for debate in reallocated],
+                             context)
+
+    with transaction.atomic():
+        Debate.objects.filter(pk__in=[debate.pk for debate in deleted_debates]).delete()
+        Debate.objects.bulk_update(pinned_debates + reused, ['affirmative', 'negative', 'room'])
+        create_debates(match_day, new_debates)
+
+        DebateJudge = Debate.judges.through
+        DebateJudge.objects.filter(debate__in=[debate.pk for debate in reallocated]).delete()
+        DebateJudge.objects.bulk_create([
+            DebateJudge(debate_id=debate.pk, speaker_id=judge.pk)
+            for debate, panel in zip(reallocated, panels) for judge in panel
+        ])
+
+        if vetoes_affected:
+            Veto.objects.filter(pk__in={veto.pk for veto in vetoes_affected})\
+                .update(affected_debates=F('affected_debates') + 1)
+
+        # Bulk writes send no signals
+        draw_cache.invalidate_draw(match_day.date)
+
+    return {
+        'created': len(new_debates),
+        'updated': len(reused),
+        'deleted': len(deleted_debates),
+        'panels_changed': len(reallocated),
+    }
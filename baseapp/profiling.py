@@ -0,0 +1,114 @@
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from django.conf import settings
+from django.db import connection
+
+# Recorders collecting phases in the current thread, innermost last
+_local = threading.local()
+
+
+def is_profiling_enabled():
+    """ Returns settings.DRAW_PROFILING, or settings.DEBUG if it is not set. """
+    return getattr(settings, 'DRAW_PROFILING', settings.DEBUG)
+
+
+class PhaseRecorder:
+    """
+    Collects the wall time, number of queries and time spent in the database
+    of each phase of the allocator run while it is active (see record_phases).
+    A phase run more than once has its totals added up.
+    """
+
+    def __init__(self):
+        # phase name -> {'time': seconds, 'queries': count, 'db_time': seconds, 'calls': count},
+        # in the order first run
+        self.phases = OrderedDict()
+
+    def add(self, name: str, elapsed: float, queries: int, db_time: float):
+        totals = self.phases.setdefault(name, {'time': 0.0, 'queries': 0, 'db_time': 0.0, 'calls': 0})
+        totals['time'] += elapsed
+        totals['queries'] += queries
+        totals['db_time'] += db_time
+        totals['calls'] += 1
+
+    @property
+    def total_time(self):
+        return sum(totals['time'] for totals in self.phases.values())
+
+    @property
+    def total_queries(self):
+        return sum(totals['queries'] for totals in self.phases.values())
+
+    def as_dict(self):
+        """ Returns the phases as a dict of phase name -> totals, e.g. for JSON. """
+        return {name: dict(totals) for name, totals in self.phases.items()}
+
+    def __str__(self):
+        return ", ".join(f"{name} {totals['time'] * 1000:.0f}ms" +
+                         (f" ({totals['queries']} queries, {totals['db_time'] * 1000:.0f}ms in the database)"
+                          if totals['queries'] else "")
+                         for name, totals in self.phases.items())
+
+
+def _get_recorders():
+    if not hasattr(_local, 'recorders'):
+        _local.recorders = []
+    return _local.recorders
+
+
+@contextmanager
+def record_phases(recorder: PhaseRecorder = None, enabled=True):
+    """
+    Records the phases run in this thread within the block.
+
+    :param recorder: a PhaseRecorder to carry on recording into - a new one if None
+    :param enabled: if False, nothing is recorded and None is given instead of a recorder
+    :return: the PhaseRecorder, with the phases recorded once the block is done
+    """
+    if not enabled:
+        yield None
+        return
+    if recorder is None:
+        recorder = PhaseRecorder()
+    recorders = _get_recorders()
+    recorders.append(recorder)
+    try:
+        yield recorder
+    finally:
+        recorders.remove(recorder)
+
+
+@contextmanager
+def phase(name: str):
+    """
+    Marks the block as a phase of the allocator with the given name, e.g.
+    'pairing'. Does nothing unless a recorder is active (see record_phases).
+    Queries are counted and timed on the default database connection.
+    """
+    recorders = list(_get_recorders())
+    if not recorders:
+        yield
+        return
+
+    queries = 0
+    db_time = 0.0
+
+    def time_query(execute, sql, params, many, context):
+        nonlocal queries, db_time
+        query_start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            queries += 1
+            db_time += time.perf_counter() - query_start
+
+    start = time.perf_counter()
+    try:
+        with connection.execute_wrapper(time_query):
+            yield
+    finally:
+        elapsed = time.perf_counter() - start
+        for recorder in recorders:
+            recorder.add(name, elapsed, queries, db_time)
@@ -0,0 +1,285 @@
+"""
+Elo ratings of the teams, stored with their standings (see
+models.TeamStanding.rating). A confirmed result moves the two teams'
+ratings by an amount that grows with the speaker-score margin of the
+debate. Once the transaction entering a result or its scores commits, the
+signal handlers in signals.py move the ratings of just the two teams, if it
+is their latest result; any other change (an earlier result entered, a
+result corrected, a debate deleted) replays the whole history, so the
+stored ratings always match a replay of the results in order.
+"""
+import math
+import threading
+import weakref
+from collections import defaultdict
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Q, Sum
+from .models import Debate, Score, TeamStanding
+
+INITIAL_RATING = TeamStanding.INITIAL_RATING
+
+# Most a rating can move in a debate decided by no margin
+K_FACTOR = 32
+
+# A team rated this many points above another is expected to win 10 to 1
+RATING_SCALE = 400
+
+# How much the speaker-score margin adds to K_FACTOR, per log point of margin
+MARGIN_WEIGHT = 0.25
+
+
+def get_ranking():
+    """
+    Returns the name of the ranking the allocator ranks teams by (see
+    allocator.RANKING_KEYS) - 'wins' unless set with settings.DRAW_RANKING.
+    """
+    return getattr(settings, 'DRAW_RANKING', 'wins')
+
+
+def get_expected_score(rating: float, opponent_rating: float) -> float:
+    """ Returns the chance of a team with the given rating beating the opponent. """
+    return 1 / (1 + 10 ** ((opponent_rating - rating) / RATING_SCALE))
+
+
+def get_rating_change(winner_rating: float, loser_rating: float, margin=0) -> float:
+    """
+    Returns the number of points the winner of a debate gains (and the loser
+    loses).
+
+    :param margin: the winning team's speaker-score total minus the losing
+                   team's - a negative margin counts as none
+    """
+    k = K_FACTOR * (1 + MARGIN_WEIGHT * math.log1p(max(margin, 0)))
+    return k * (1 - get_expected_score(winner_rating, loser_rating))
+
+
+class Ratings:
+    """ The ratings of the teams, keyed by team pk. Teams not rated yet have INITIAL_RATING. """
+
+    def __init__(self, ratings=None):
+        self.ratings = dict(ratings) if ratings is not None else {}
+
+    def get(self, team_id) -> float:
+        return self.ratings.get(team_id, INITIAL_RATING)
+
+    def record(self, winner_id, loser_id, margin=0) -> float:
+        """ Applies the result of a debate, and returns the number of points that changed hands. """
+        change = get_rating_change(self.get(winner_id), self.get(loser_id), margin)
+        self.ratings[winner_id] = self.get(winner_id) + change
+        self.ratings[loser_id] = self.get(loser_id) - change
+        return change
+
+
+def replay(results, ratings: Ratings = None) -> Ratings:
+    """
+    Applies the results given in order.
+
+    :param results: (winner pk, loser pk, margin) tuples, e.g. from load_results
+    :param ratings: the Ratings to start from - everyone unrated if None
+    :return: the Ratings after the results
+    """
+    if ratings is None:
+        ratings = Ratings()
+    for winner_id, loser_id, margin in results:
+        ratings.record(winner_id, loser_id, margin)
+    return ratings
+
+
+def get_result(winning_team_id, affirmative_team_id, negative_team_id, team_scores):
+    """
+    Returns the (winner pk, loser pk, margin) tuple of a debate, or None if the
+    debate has no result between two teams.
+
+    :param team_scores: dict of team pk -> speaker-score total of the team in the debate
+    """
+    if winning_team_id is None:
+        return None
+    loser_id = negative_team_id if winning_team_id == affirmative_team_id else affirmative_team_id
+    if loser_id is None or loser_id == winning_team_id:
+        return None
+    return winning_team_id, loser_id, team_scores.get(winning_team_id, 0) - team_scores.get(loser_id, 0)
+
+
+def _get_team_scores(debates):
+    """
+    Returns a dict of debate pk -> dict of team pk -> speaker-score total of
+    the team, for the debates of the given queryset. Makes 1 query.
+    """
+    debate_scores = defaultdict(dict)
+    for debate_id, team_id, score_sum in Score.objects.filter(debate__in=debates)\
+            .values_list('debate', 'speaker__team').annotate(Sum('score')).order_by():
+        debate_scores[debate_id][team_id] = float(score_sum)
+    return debate_scores
+
+
+def load_results(before=None):
+    """
+    Returns the results of the debates held before 'before' (all of them if
+    None), in the order they are rated in: by date, then pk. Debates outside
+    of a match day are not rated. Makes 2 queries.
+
+    :return: list of (winner pk, loser pk, margin) tuples
+    """
+    debates = Debate.objects.filter(winning_team__isnull=False, match_day__isnull=False)
+    if before is not None:
+        debates = debates.filter(match_day__date__lt=before)
+    debate_scores = _get_team_scores(debates)
+
+    results = []
+    for debate_id, winning_team_id, affirmative_team_id, negative_team_id in \
+            debates.order_by('match_day__date', 'pk')\
+                .values_list('pk', 'winning_team', 'affirmative__team', 'negative__team'):
+        result = get_result(winning_team_id, affirmative_team_id, negative_team_id, debate_scores[debate_id])
+        if result is not None:
+            results.append(result)
+    return results
+
+
+def rebuild_ratings():
+    """
+    Replays all the results and stores the ratings in the teams' standings,
+    along with the latest result of each team and its rating before it (see
+    rate_debates). Makes a fixed number of queries.
+
+    :return: the number of results replayed
+    """
+    debates = Debate.objects.filter(winning_team__isnull=False, match_day__isnull=False)
+    debate_scores = _get_team_scores(debates)
+
+    ratings = Ratings()
+    latest = {}
+    results_count = 0
+    for debate_id, winning_team_id, affirmative_team_id, negative_team_id in \
+            debates.order_by('match_day__date', 'pk')\
+                .values_list('pk', 'winning_team', 'affirmative__team', 'negative__team'):
+        result = get_result(winning_team_id, affirmative_team_id, negative_team_id, debate_scores[debate_id])
+        if result is None:
+            continue
+        winner_id, loser_id, margin = result
+        latest.update({team_id: (debate_id, ratings.get(team_id)) for team_id in (winner_id, loser_id)})
+        ratings.record(*result)
+        results_count += 1
+
+    standings = list(TeamStanding.objects.only('team', 'rating', 'rated_debate', 'rating_before'))
+    for standing in standings:
+        standing.rating = ratings.get(standing.team_id)
+        standing.rated_debate_id, standing.rating_before = latest.get(standing.team_id, (None, INITIAL_RATING))
+    with transaction.atomic():
+        TeamStanding.objects.bulk_update(standings, ['rating', 'rated_debate', 'rating_before'], batch_size=500)
+    return results_count
+
+
+def rate_debates(debate_ids):
+    """
+    Rates the results of the given debates, newly entered or with their
+    scores changed, by moving only the ratings of their teams: a debate
+    already rated is rated again, with its current margin, from the ratings
+    its teams had before it. Makes a fixed number of queries, plus one
+    UPDATE per team rated.
+
+    :return: False, changing nothing, if a team has a result after one of
+             the debates, or more than one of them - all the results must be
+             replayed then, to keep them in order
+    """
+    debates = Debate.objects.filter(pk__in=debate_ids, winning_team__isnull=False, match_day__isnull=False)
+    rows = list(debates.order_by('match_day__date', 'pk')
+                .values_list('pk', 'match_day__date', 'winning_team', 'affirmative__team', 'negative__team'))
+    if not rows:
+        return True
+    team_ids = [team_id for row in rows for team_id in row[3:5]]
+    if None in team_ids or len(set(team_ids)) < len(team_ids):
+        return False
+
+    later = Debate.objects.filter(winning_team__isnull=False, match_day__date__gte=rows[0][1])\
+        .filter(Q(affirmative__team__in=team_ids) | Q(negative__team__in=team_ids))\
+        .exclude(pk__in=[row[0] for row in rows])\
+        .values_list('pk', 'match_day__date', 'affirmative__team', 'negative__team')
+    debate_keys = {team_id: (date, debate_id) for debate_id, date, winning_team_id, affirmative_id, negative_id in rows
+                   for team_id in (affirmative_id, negative_id)}
+    for other_id, other_date, *other_team_ids in later:
+        if any(team_id in debate_keys and (other_date, other_id) > debate_keys[team_id] for team_id in other_team_ids):
+            return False
+
+    debate_scores = _get_team_scores(debates)
+    standings = {standing.team_id: standing for standing in
+                 TeamStanding.objects.filter(team__in=team_ids).only('team', 'rating', 'rated_debate', 'rating_before')}
+    ratings = Ratings()
+    for team_id, standing in standings.items():
+        # Take back the debate's result if it is already rated
+        debate_id = debate_keys[team_id][1]
+        ratings.ratings[team_id] = standing.rating_before if standing.rated_debate_id == debate_id else standing.rating
+
+    rated = {}
+    for debate_id, date, winning_team_id, affirmative_id, negative_id in rows:
+        result = get_result(winning_team_id, affirmative_id, negative_id, debate_scores[debate_id])
+        if result is None:
+            continue
+        rated.update({team_id: (debate_id, ratings.get(team_id)) for team_id in (affirmative_id, negative_id)})
+        ratings.record(*result)
+    for team_id, (debate_id, rating_before) in rated.items():
+        TeamStanding.objects.filter(team=team_id).update(rating=ratings.get(team_id), rated_debate=debate_id,
+                                                         rating_before=rating_before)
+    return True
+
+
+class _Update:
+    """ The changes to the ratings to make once the current transaction commits. """
+
+    def __init__(self):
+        # Debates to rate incrementally, unless everything is replayed
+        self.debate_ids = set()
+        self.rebuild = False
+
+    def __call__(self):
+        if _get_pending() is self:
+            del _pending.update
+        if self.rebuild or not rate_debates(self.debate_ids):
+            rebuild_ratings()
+
+
+# The _Update waiting for the current transaction of this thread to commit,
+# by weak reference, so that it goes when a rollback drops Django's
+# reference to it (see draw_cache.invalidate_draw)
+_pending = threading.local()
+
+
+def _get_pending():
+    """ Returns the _Update waiting for the current transaction to commit, if any. """
+    reference = getattr(_pending, 'update', None)
+    return reference() if reference is not None else None
+
+
+def _schedule(debate_ids=(), rebuild=False):
+    update = _get_pending() if connection.in_atomic_block else None
+    if update is None:
+        update = _Update()
+        if connection.in_atomic_block:
+            _pending.update = weakref.ref(update)
+            transaction.on_commit(update)
+
+    update.debate_ids.update(pk for pk in debate_ids if pk is not None)
+    update.rebuild = update.rebuild or rebuild
+
+    if not connection.in_atomic_block:
+        update()
+
+
+def schedule_rebuild():
+    """
+    Replays all the results once the current transaction commits - right
+    away outside of a transaction - for changes to results already rated (a
+    result corrected, a debate deleted). Scheduling more than once in a
+    transaction only replays once.
+    """
+    _schedule(rebuild=True)
+
+
+def schedule_rating(*debate_ids):
+    """
+    Rates the results of the given debates (see rate_debates) once the
+    current transaction commits - right away outside of a transaction - for
+    results newly entered or scores changed. The debates scheduled in a
+    transaction are rated together, and those without a result are left out.
+    """
+    _schedule(debate_ids)
@@ -0,0 +1,274 @@
+from collections import defaultdict
+from django.db import transaction
+from django.db.models import Q
+from .models import Attendance, Speaker, Debate, MatchDay, Room
+from .draw_context import DrawContext
+from .exceptions import NotEnoughJudgesException, NotEnoughRoomsException, CannotFindWorkingConfigurationException
+from .pairing import matching_pairing
+from .judge_allocation import allocate_judges
+from .allocator import rank_attendances, assign_aff_neg, assign_judging_priority, get_qualified_judges, \
+    check_vetoes, create_debates, check_draw_editable
+from . import draw_cache
+
+
+def get_late_attendances(match_day: MatchDay):
+    """
+    Returns the attendances for the match day's date that are neither competing
+    nor judging, i.e. the teams that marked their attendance after the draw was
+    made - other than the teams that have withdrawn since.
+    """
+    return Attendance.objects.filter(date=match_day.date, withdrawn=False)\
+        .exclude(competing_matchdays=match_day)\
+        .exclude(judging_matchdays=match_day)
+
+
+def _choose_extra_judging_attendance(attendances):
+    """
+    Returns the attendance out of 'attendances' with qualified judges that has
+    the highest judging priority, or None if none of them has qualified judges.
+    """
+    qualified = [attendance for attendance in attendances if get_qualified_judges(attendance)]
+    if not qualified:
+        return None
+    return max(qualified, key=assign_judging_priority)
+
+
+def _get_other_panels(match_day: MatchDay, excluded_debates):
+    """
+    Returns a dict mapping the pk of each debate in the match day, other than
+    'excluded_debates', to the DebateJudge (Debate.judges.through) rows of its panel.
+    """
+    panels = defaultdict(list)
+    DebateJudge = Debate.judges.through
+    for debate_judge in DebateJudge.objects.filter(debate__match_day=match_day)\
+            .exclude(debate__in=[debate.pk for debate in excluded_debates])\
+            .select_related('speaker'):
+        panels[debate_judge.debate_id].append(debate_judge)
+    return panels
+
+
+def _borrow_judges(panels, count: int):
+    """
+    Takes 'count' judges from the given panels (as from _get_other_panels), taking
+    the weakest judge from the largest panel each time.
+
+    :return: the DebateJudge rows of the judges taken
+    :requires: there are at least 'count' judges in the panels beyond the first of each
+    """
+    borrowed = []
+    for _ in range(count):
+        largest = max(panels.values(), key=len)
+        weakest = min(largest, key=lambda debate_judge: debate_judge.speaker.qualification_score)
+        largest.remove(weakest)
+        borrowed.append(weakest)
+    return borrowed
+
+
+def repair_draw(match_day: MatchDay, added=None, removed=(), rng=None, ignore_rooms=False):
+    """
+    Updates the existing draw for a match day for late changes in attendance,
+    without redrawing everyone.
+
+    Only the debates affected by the change are re-solved:
+        - teams left without an opponent (because theirs was removed or its
+          attendance deleted) and the teams added are paired up with each
+          other, with pairing.matching_pairing
+        - a team left without an opponent keeps its debate, side and room
+        - debates with no teams left are deleted, freeing their room and judges
+        - judges are allocated again, with judge_allocation.allocate_judges,
+          only for the new or changed debates and the debates that lost judges.
+          If there are not enough free judges, the weakest judges are taken
+          from the largest panels of the other debates.
+
+    The rest of the draw stays as it is, and only the rows that change are
+    written, in a single transaction. If an odd number of teams need opponents,
+    or there are not enough judges, the team with the highest judging priority
+    judges instead. The attendances removed are taken off the match day and
+    marked as withdrawn, so that they are not added back as late attendances.
+
+    :param match_day: the MatchDay to repair
+    :param added: the Attendances to add to the draw - defaults to the late
+                  attendances (see get_late_attendances)
+    :param removed: the Attendances (competing or judging) to take out of the draw
+    :param rng: random.Random instance for random choices
+    :param ignore_rooms: if True, new debates are not given a room
+    :return: dict with the number of debates 'created', 'updated' and 'deleted',
+             the number of 'panels_changed', and the attendances that were to
+             compete but are 'judging' instead
+    :raises DrawLockedException: if the draw is not for today, or has results
+    :raises VetoConflictException: if the teams needing opponents cannot be paired up
+    :raises NotEnoughJudgesException: if there are not enough judges left for the debates
+    :raises NotEnoughRoomsException: if there are not enough free rooms for the new debates
+    """
+    check_draw_editable(match_day)
+    if added is None:
+        added = get_late_attendances(match_day)
+    added = list(added)
+    removed = list(removed)
+    removed_pks = {attendance.pk for attendance in removed}
+
+    # Debates with a team or judge that is being removed
+    removed_speakers = Speaker.objects.filter(attendance__in=removed_pks)
+    affected_debates = list(
+        match_day.debate_set.filter(Q(affirmative__in=removed_pks) | Q(negative__in=removed_pks) |
+                                    Q(judges__in=removed_speakers))
+            .distinct().select_related('room', 'affirmative__team', 'negative__team')
+            .prefetch_related('affirmative__speakers', 'negative__speakers', 'judges')
+    )
+    removed_speaker_pks = set(removed_speakers.values_list('pk', flat=True))
+
+    # Competing teams whose debate has been deleted along with their opponent's attendance
+    orphans_without_debate = list(
+        match_day.attendances_competing
+            .exclude(debates_affirmative__match_day=match_day)
+            .exclude(debates_negative__match_day=match_day)
+            .exclude(pk__in=removed_pks)
+            .select_related('team').prefetch_related('speakers')
+    )
+    # Judges judging that are not on any panel, e.g. after a debate was deleted
+    free_judges = [judge for judge in Speaker.objects.filter(attendance__judging_matchdays=match_day)
+                                                    .exclude(debate__match_day=match_day)
+                                                    .exclude(pk__in=removed_speaker_pks).distinct()
+                    if judge.is_qualified_as_judge()]
+
+    # Work out which debates are kept, and the teams that need an opponent.
+    # The judges of all these debates are allocated again.
+    kept_debates = {}        # attendance pk -> its debate, for teams that lost their opponent
+    deleted_debates = []
+    panel_changed_debates = []
+    needing_opponents = list(orphans_without_debate)
+    for debate in affected_debates:
+        remaining = [attendance for attendance in debate.get_attendances() if attendance.pk not in removed_pks]
+        if len(remaining) == 2:
+            # Only the panel is affected
+            panel_changed_debates.append(debate)
+        elif len(remaining) == 1:
+            kept_debates[remaining[0].pk] = debate
+            needing_opponents.append(remaining[0])
+        else:
+            deleted_debates.append(debate)
+        free_judges.extend(judge for judge in debate.judges.all() if judge.pk not in removed_speaker_pks)
+
+    # Teams judge instead of competing (the late ones first) until an even number
+    # of teams need an opponent and there are enough judges for their debates
+    added_competing = list(added)
+    added_judging = []
+    needing_opponents.extend(added_competing)
+    other_panels = None
+    while True:
+        debates_needed = len(panel_changed_debates) + len(needing_opponents) // 2
+        if len(needing_opponents) % 2 == 0:
+            if len(free_judges) >= debates_needed:
+                break
+            if other_panels is None:
+                other_panels = _get_other_panels(match_day, affected_debates)
+            if len(free_judges) + sum(len(panel) - 1 for panel in other_panels.values()) >= debates_needed:
+                break
+        extra_judging = _choose_extra_judging_attendance(added_competing) or \
+                            _choose_extra_judging_attendance(needing_opponents)
+        if extra_judging is None:
+            raise NotEnoughJudgesException(
+                "Not enough judges for the teams that need an opponent - please generate the debates again.")
+        needing_opponents.remove(extra_judging)
+        if extra_judging in added_competing:
+            added_competing.remove(extra_judging)
+        added_judging.append(extra_judging)
+        free_judges.extend(get_qualified_judges(extra_judging))
+        if extra_judging.pk in kept_debates:
+            # Its opponent is gone as well, so its debate goes
+            deleted_debates.append(kept_debates.pop(extra_judging.pk))
+
+    pairs = []
+    if needing_opponents:
+        context = DrawContext(needing_opponents, date=match_day.date, rng=rng)
+        check_vetoes(needing_opponents, context)
+        pairs = matching_pairing(rank_attendances(needing_opponents, context), context)
+        if pairs is None:
+            raise CannotFindWorkingConfigurationException(
+                "Cannot allocate debates that satisfy veto criteria - you may wish to change the vetoes."
+            )
+
+    # Make the debates for the new pairs, reusing the debates of teams that lost their opponent
+    changed_debates = []
+    new_debates = []
+    for attendance1, attendance2 in pairs:
+        kept = [kept_debates[attendance.pk] for attendance in (attendance1, attendance2)
+                    if attendance.pk in kept_debates]
+        if kept:
+            debate = kept[0]
+            if len(kept) == 2:
+                # Both teams lost their opponent - one debate is enough
+                deleted_debates.append(kept[1])
+                assign_aff_neg(debate, attendance1, attendance2, context)
+            else:
+                # The team already in the debate keeps its side
+                staying, joining = (attendance1, attendance2) if attendance1.pk in kept_debates \
+                                        else (attendance2, attendance1)
+                if debate.affirmative_id == staying.pk:
+                    debate.negative = joining
+                else:
+                    debate.affirmative = joining
+            changed_debates.append(debate)
+        else:
+            debate = assign_aff_neg(Debate(match_day=match_day), attendance1, attendance2, context)
+            new_debates.append(debate)
+
+    # Rooms for the new debates
+    if not ignore_rooms and new_debates:
+        free_rooms = list(Room.objects.filter(date=match_day.date).exclude(debate__match_day=match_day)) + \
+                        [debate.room for debate in deleted_debates if debate.room is not None]
+        if len(free_rooms) < len(new_debates):
+            raise NotEnoughRoomsException("Not enough free rooms available for the new debates.")
+        for debate, room in zip(new_debates, free_rooms):
+            debate.room = room
+
+    # Allocate judges again for the debates that changed
+    reallocated = changed_debates + panel_changed_debates + new_debates
+    judges = list(free_judges)
+    borrowed = []
+    if len(judges) < len(reallocated):
+        borrowed = _borrow_judges(other_panels, len(reallocated) - len(judges))
+        judges += [debate_judge.speaker for debate_judge in borrowed]
+    if not reallocated:
+        judge_context = None
+    else:
+        # The judges' attendances are needed for the vetoes between judges and teams
+        judge_context = DrawContext(
+            [attendance for debate in reallocated for attendance in debate.get_attendances()] +
+            list(Attendance.objects.filter(date=match_day.date, speakers__in=[judge.pk for judge in judges])
+                    .distinct()),
+            date=match_day.date
+        )
+    panels = allocate_judges(judges, [(debate.affirmative, debate.negative) for debate in reallocated],
+                             judge_context)
+
+    with transaction.atomic():
+        Debate.objects.filter(pk__in=[debate.pk for debate in deleted_debates]).delete()
+        Debate.objects.bulk_update(changed_debates, ['affirmative', 'negative'])
+        create_debates(match_day, new_debates)
+
+        DebateJudge = Debate.judges.through
+        DebateJudge.objects.filter(pk__in=[debate_judge.pk for debate_judge in borrowed]).delete()
+        DebateJudge.objects.filter(debate__in=[debate.pk for debate in reallocated]).delete()
+        DebateJudge.objects.bulk_create([
+            DebateJudge(debate_id=debate.pk, speaker_id=judge.pk)
+            for debate, panel in zip(reallocated, panels) for judge in panel
+        ])
+
+        match_day.attendances_competing.remove(*added_judging, *removed)
+        match_day.attendances_competing.add(*added_competing)
+        match_day.attendances_judging.remove(*removed)
+        match_day.attendances_judging.add(*added_judging)
+        # The teams removed are no longer attending - no debates refer to them by now
+        Attendance.objects.filter(pk__in=removed_pks).update(withdrawn=True)
+
+        # Bulk writes send no signals
+        draw_cache.invalidate_draw(match_day.date)
+
+    return {
+        'created': len(new_debates),
+        'updated': len(changed_debates),
+        'deleted': len(deleted_debates),
+        'panels_changed': len(reallocated),
+        'judging': added_judging,
+    }
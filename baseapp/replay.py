@@ -0,0 +1,126 @@
+import random
+import time
+from collections import defaultdict
+from django.db import transaction
+from .models import Debate, MatchDay, Speaker
+from .draw_result import get_draw_metrics, get_draw_score
+from .exceptions import CannotFindWorkingConfigurationException, NotEnoughAttendancesException, \
+    NotEnoughJudgesException
+from . import adapter, allocator, core
+
+
+def _set_judged_before(attendances, date):
+    """
+    Sets judged_before on the teams of the given core.Attendances as it was on
+    'date', i.e. whether a speaker of the team judged a debate before then.
+    """
+    DebateJudge = Debate.judges.through
+    team_ids = {attendance.team.pk for attendance in attendances}
+    judged_before = set(DebateJudge.objects.filter(debate__match_day__date__lt=date, speaker__team__in=team_ids)
+                            .values_list('speaker__team', flat=True).distinct())
+    for attendance in attendances:
+        attendance.team.judged_before = attendance.team.pk in judged_before
+
+
+def _get_actual_draw(match_day: MatchDay, context):
+    """
+    Returns the draw that was used for the match day, as (core.Debates, panels),
+    with the attendances and judges taken from the context where possible.
+    """
+    attendances = {attendance.pk: attendance for attendance in context.attendances}
+    speakers = {speaker.pk: speaker for attendance in context.attendances for speaker in attendance.speakers}
+    rows = [(pk, affirmative_id, negative_id) for pk, affirmative_id, negative_id in
+                match_day.debate_set.order_by('pk').values_list('pk', 'affirmative', 'negative')
+            if affirmative_id in attendances and negative_id in attendances]
+    DebateJudge = Debate.judges.through
+    judge_rows = list(DebateJudge.objects.filter(debate__match_day=match_day).values_list('debate', 'speaker'))
+
+    # Judges added by hand may not be in any of the day's attendances
+    missing = {speaker_id for debate_id, speaker_id in judge_rows if speaker_id not in speakers}
+    for pk, name, team_id, qualification_score in Speaker.objects.filter(pk__in=missing)\
+            .values_list('pk', 'name', 'team', 'qualification_score'):
+        speakers[pk] = core.Speaker(pk, name, team_id, qualification_score)
+
+    panels = defaultdict(list)
+    for debate_id, speaker_id in judge_rows:
+        panels[debate_id].append(speakers[speaker_id])
+    debates = [core.Debate(attendances[affirmative_id], attendances[negative_id])
+               for pk, affirmative_id, negative_id in rows]
+    return debates, [panels[pk] for pk, affirmative_id, negative_id in rows]
+
+
+def replay_match_day(match_day: MatchDay, strategies=('greedy',), improve=False, seed=0):
+    """
+    Reruns the allocator for a past match day, with the league as it was that
+    night, and compares the draws made with the one that was actually used.
+
+    The context is made from the attendances for the day and the history of
+    the debates before it (see DrawContext), with the teams' judged_before as
+    it was then. Vetoes are not dated, so the current ones are used. Nothing is
+    written to the database.
+
+    :param match_day: the MatchDay to replay
+    :param strategies: the pairing strategies to rerun the allocator with
+    :param improve: if True, the draws are improved with local search
+    :param seed: seed for the draws
+    :return: dict with the 'date', the 'actual' draw's metrics and score, and for each
+             strategy in 'reruns', its metrics, score and run 'time' (seconds) - or an
+             'error' if no draw could be made
+    """
+    context = adapter.load_context(match_day.date, rng=random.Random(seed))
+    _set_judged_before(context.attendances, match_day.date)
+
+    # Metrics count the draw's own debates as history, so they are recorded
+    # for the measurement and discarded again before the reruns
+    debates, panels = _get_actual_draw(match_day, context)
+    for debate in debates:
+        context.record_debate(debate.affirmative, debate.negative)
+    actual = get_draw_metrics(debates, panels, context)
+    for debate in debates:
+        context.discard_debate(debate.affirmative, debate.negative)
+
+    result = {
+        'date': match_day.date.isoformat(),
+        'attendances': len(context.attendances),
+        'actual': {'metrics': actual, 'score': get_draw_score(actual)},
+        'reruns': {},
+    }
+    for i, strategy in enumerate(strategies):
+        if i > 0:
+            # A draw is recorded in its context, so each rerun needs a fresh one
+            context = adapter.load_context(match_day.date, rng=random.Random(seed))
+            _set_judged_before(context.attendances, match_day.date)
+        start = time.perf_counter()
+        try:
+            draw = allocator.build_draw(context, [], ignore_rooms=True, strategy=strategy,
+                                        improve=improve, debate_class=core.Debate)
+        except (CannotFindWorkingConfigurationException, NotEnoughAttendancesException,
+                    NotEnoughJudgesException) as e:
+            result['reruns'][strategy] = {'error': str(e), 'time': time.perf_counter() - start}
+        else:
+            result['reruns'][strategy] = {'metrics': draw.metrics, 'score': draw.score,
+                                          'time': time.perf_counter() - start}
+    return result
+
+
+def replay_history(match_days=None, strategies=('greedy',), improve=False, seed=0):
+    """
+    Replays past match days in date order (see replay_match_day), inside a
+    transaction that is rolled back once done, so that the database is left
+    exactly as it was.
+
+    The results are yielded one match day at a time, and each match day is
+    loaded on its own, so archives of several seasons can be replayed without
+    holding them in memory.
+
+    :param match_days: MatchDay queryset to replay - defaults to all of them
+    :return: generator of the results of replay_match_day
+    """
+    if match_days is None:
+        match_days = MatchDay.objects.all()
+    with transaction.atomic():
+        try:
+            for match_day in match_days.order_by('date').iterator():
+                yield replay_match_day(match_day, strategies=strategies, improve=improve, seed=seed)
+        finally:
+            transaction.set_rollback(True)
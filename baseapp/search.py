@@ -0,0 +1,178 @@
+import multiprocessing
+import os
+import pickle
+import queue
+import random
+import time
+import django
+from django.conf import settings
+from .models import Room
+from .draw_context import DrawContext
+from .exceptions import CannotFindWorkingConfigurationException, DrawSearchTimeoutException
+from . import allocator
+
+# Default number of candidate draws to generate
+SEARCH_CANDIDATES = 16
+
+# Default wall-clock budget for the search, in seconds
+SEARCH_TIME_BUDGET = 2.0
+
+# Most time to wait for a first valid candidate, in seconds, before giving up -
+# a worker process that is killed (e.g. for running out of memory) takes its
+# candidates with it, and they never finish. Well within the web server's
+# request timeout.
+SEARCH_TIMEOUT = 20.0
+
+# Snapshot shared by the candidates in a worker process, set by _init_worker
+_snapshot = None
+
+
+def _init_worker(snapshot):
+    """ Sets up a worker process with the pickled snapshot to generate candidates from. """
+    global _snapshot
+    # Worker processes that are not forked need Django to be set up again
+    django.setup()
+    _snapshot = snapshot
+
+
+def _build_candidate(snapshot, seed, strategy, ignore_rooms=False):
+    """
+    Builds the draw for the given seed and strategy from a pickled (context, rooms)
+    snapshot. The snapshot is unpickled again for each candidate, as the context
+    is changed by the draw made with it.
+    """
+    context, rooms = pickle.loads(snapshot)
+    context.rng = random.Random(seed)
+    draw = allocator.build_draw(context, rooms, ignore_rooms=ignore_rooms, strategy=strategy)
+    draw.seed = seed
+    return draw
+
+
+def _score_candidate(seed, strategy, ignore_rooms=False):
+    """
+    Runs in a worker process. Builds the candidate draw and returns its score,
+    or None if no draw satisfying the vetoes was found.
+    """
+    try:
+        return _build_candidate(_snapshot, seed, strategy, ignore_rooms=ignore_rooms).score
+    except CannotFindWorkingConfigurationException:
+        return None
+
+
+def get_max_workers():
+    """
+    Returns the most worker processes a search may use - settings.DRAW_SEARCH_MAX_WORKERS,
+    or the number of CPUs - so that searches cannot take over the web server.
+    """
+    cpu_count = os.cpu_count() or 1
+    return min(getattr(settings, 'DRAW_SEARCH_MAX_WORKERS', cpu_count), cpu_count)
+
+
+def get_candidate_seeds(count: int, seed=None):
+    """ Returns 'count' distinct seeds for the candidates, derived from 'seed'. """
+    rng = random.Random(seed)
+    seeds = []
+    while len(seeds) < count:
+        candidate_seed = rng.randrange(2 ** 32)
+        if candidate_seed not in seeds:
+            seeds.append(candidate_seed)
+    return seeds
+
+
+def search_debates(date, candidates=SEARCH_CANDIDATES, strategies=('greedy', 'matching'),
+                    time_budget=SEARCH_TIME_BUDGET, max_workers=None, seed=None, ignore_rooms=False):
+    """
+    Generates several candidate draws for the given date and returns the best one,
+    without writing anything to the database.
+
+    The data for the draw is loaded once into a DrawContext, which is shared with
+    a pool of worker processes. Each candidate is made from the snapshot with its
+    own seed (and a pairing strategy, taken in turn from 'strategies'), so the
+    candidates differ in the random choices made, e.g. how level teams are ranked
+    and which side each team takes. The workers only send back the score of each
+    candidate (see draw_result.get_draw_score); the best one is then rebuilt here
+    from its seed.
+
+    Candidates that have not finished when the time budget runs out are dropped,
+    and the workers still making them are terminated, although the search carries
+    on until it has found a valid candidate - for up to SEARCH_TIMEOUT seconds.
+
+    :param date: the date to generate debates for
+    :param candidates: the number of candidate draws to generate
+    :param strategies: the pairing strategies to use for the candidates
+    :param time_budget: wall-clock time allowed for the search, in seconds
+    :param max_workers: number of worker processes - defaults to get_max_workers.
+                        If 1, the candidates are generated in this process.
+    :param seed: seed for the candidates' seeds, to repeat a search
+    :param ignore_rooms: if True, rooms are neither checked nor assigned
+    :return: the best DrawResult, with the seed and strategy that reproduce it
+             (with allocator.preview_debates or allocator.generate_debates)
+    :raises VetoConflictException: if no draw can satisfy the vetoes
+    :raises CannotFindWorkingConfigurationException: if no candidate satisfies the vetoes
+    :raises DrawSearchTimeoutException: if the workers find no valid candidate within SEARCH_TIMEOUT
+    """
+    deadline = time.monotonic() + time_budget
+    timeout_deadline = time.monotonic() + max(SEARCH_TIMEOUT, time_budget)
+    context = DrawContext.for_date(date)
+    rooms = list(Room.objects.filter(date=date))
+    # Check the attendances, rooms and vetoes before starting any workers
+    attendances_competing, attendances_judging = allocator._split_attendances(context, len(rooms), ignore_rooms)
+    allocator.check_vetoes(attendances_competing, context)
+    snapshot = pickle.dumps((context, rooms))
+
+    tasks = [(candidate_seed, strategies[i % len(strategies)])
+                for i, candidate_seed in enumerate(get_candidate_seeds(candidates, seed))]
+    if max_workers is None:
+        max_workers = get_max_workers()
+    max_workers = min(max_workers, len(tasks))
+
+    scores = {}
+    if max_workers <= 1:
+        global _snapshot
+        _snapshot = snapshot
+        try:
+            for task in tasks:
+                found = any(score is not None for score in scores.values())
+                if found and time.monotonic() >= deadline:
+                    break
+                scores[task] = _score_candidate(*task, ignore_rooms=ignore_rooms)
+        finally:
+            _snapshot = None
+    else:
+        # (task, score, error) of each candidate, as the workers finish them
+        finished = queue.Queue()
+        pool = multiprocessing.Pool(max_workers, initializer=_init_worker, initargs=(snapshot,))
+        try:
+            for task in tasks:
+                pool.apply_async(_score_candidate, task, {'ignore_rooms': ignore_rooms},
+                                 callback=lambda score, task=task: finished.put((task, score, None)),
+                                 error_callback=lambda error, task=task: finished.put((task, None, error)))
+            while len(scores) < len(tasks):
+                found = any(score is not None for score in scores.values())
+                # Until a valid candidate is found, wait past the deadline if need be
+                timeout = (deadline if found else timeout_deadline) - time.monotonic()
+                try:
+                    if timeout <= 0:
+                        raise queue.Empty()
+                    task, score, error = finished.get(timeout=timeout)
+                except queue.Empty:
+                    if found:
+                        break
+                    raise DrawSearchTimeoutException(
+                        "No draw was found in time - please try again, or preview a single draw instead.")
+                if error is not None:
+                    raise error
+                scores[task] = score
+        finally:
+            # Stops the workers still making candidates, rather than leaving them running
+            pool.terminate()
+            pool.join()
+
+    valid = [(score, task) for task, score in scores.items() if score is not None]
+    if not valid:
+        raise CannotFindWorkingConfigurationException(
+            "Cannot allocate debates that satisfy veto criteria - you may wish to change the vetoes."
+        )
+    # Lowest score first, then the earliest candidate
+    best_seed, best_strategy = min(valid, key=lambda item: (item[0], tasks.index(item[1])))[1]
+    return _build_candidate(snapshot, best_seed, best_strategy, ignore_rooms=ignore_rooms)
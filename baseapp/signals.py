@@ -0,0 +1,202 @@
+"""
+Signal handlers keeping the teams' standings and the speakers' running
+score totals (see standings.py) up to date as debates, scores, speakers and
+teams are saved and deleted, and invalidating the cached public draws (see
+draw_cache.py). The values a model instance was loaded with are kept on it,
+so that a save only has to take back what it changed. Fixture loading (raw
+saves) is skipped - rebuild the standings afterwards with the
+rebuild_standings command.
+"""
+from django.db.models.signals import m2m_changed, post_delete, post_init, post_save, pre_delete
+from django.dispatch import receiver
+from . import draw_cache, ratings, standings
+from .models import Attendance, Debate, MatchDay, Room, Score, Speaker, Team, TeamStanding
+
+# Fields of each model the standings, running totals and draws depend on
+TRACKED_FIELDS = {
+    Debate: ('winning_team_id', 'affirmative_id', 'negative_id', 'match_day_id'),
+    Score: ('speaker_id', 'score', 'debate_id'),
+    Speaker: ('team_id', 'name'),
+    Team: ('name',),
+}
+
+
+def _get_loaded(instance):
+    """ Returns a dict of the tracked fields of the instance as last loaded or saved. """
+    return getattr(instance, '_standings_loaded', {})
+
+
+def _set_loaded(instance):
+    instance._standings_loaded = {field: instance.__dict__.get(field) for field in TRACKED_FIELDS[type(instance)]}
+
+
+def _has_changed(instance):
+    return _get_loaded(instance) != {field: instance.__dict__.get(field) for field in TRACKED_FIELDS[type(instance)]}
+
+
+@receiver(post_init, sender=Debate)
+@receiver(post_init, sender=Score)
+@receiver(post_init, sender=Speaker)
+@receiver(post_init, sender=Team)
+def remember_loaded(sender, instance, **kwargs):
+    if instance.pk is not None:
+        _set_loaded(instance)
+
+
+def _get_debate_result_changes(winning_team_id, affirmative_id, negative_id, attendance_teams, sign):
+    return standings.get_result_changes(winning_team_id, attendance_teams.get(affirmative_id),
+                                        attendance_teams.get(negative_id), sign)
+
+
+@receiver(post_save, sender=Debate)
+def update_standings_for_debate(sender, instance, created, raw, **kwargs):
+    if raw:
+        return
+    old = {} if created else _get_loaded(instance)
+    if _has_changed(instance) and (instance.winning_team_id is not None or
+                                   old.get('winning_team_id') is not None):
+        attendance_teams = standings.get_debate_teams(instance.affirmative_id, instance.negative_id,
+                                                      old.get('affirmative_id'), old.get('negative_id'))
+        standings.apply_changes(standings.merge_changes(
+            _get_debate_result_changes(old.get('winning_team_id'), old.get('affirmative_id'),
+                                       old.get('negative_id'), attendance_teams, -1),
+            _get_debate_result_changes(instance.winning_team_id, instance.affirmative_id,
+                                       instance.negative_id, attendance_teams, 1)
+        ))
+        if old.get('winning_team_id') is None:
+            ratings.schedule_rating(instance.pk)
+        else:
+            ratings.schedule_rebuild()
+
+
+@receiver(pre_delete, sender=Debate)
+def remove_debate_from_standings(sender, instance, **kwargs):
+    if instance.winning_team_id is None:
+        return
+    attendance_teams = standings.get_debate_teams(instance.affirmative_id, instance.negative_id)
+    standings.apply_changes(_get_debate_result_changes(instance.winning_team_id, instance.affirmative_id,
+                                                       instance.negative_id, attendance_teams, -1),
+                            create=False)
+    ratings.schedule_rebuild()
+
+
+@receiver(post_save, sender=Score)
+def update_standings_for_score(sender, instance, created, raw, **kwargs):
+    if raw:
+        return
+    old = {} if created else _get_loaded(instance)
+    if _has_changed(instance):
+        speaker_teams = standings.get_speaker_teams(instance.speaker_id, old.get('speaker_id'))
+        changes = standings.get_score_changes(speaker_teams.get(instance.speaker_id), instance.score)
+        if old.get('speaker_id') is not None:
+            changes = standings.merge_changes(
+                standings.get_score_changes(speaker_teams.get(old['speaker_id']), old['score'], sign=-1),
+                changes
+            )
+        standings.apply_changes(changes)
+        standings.apply_speaker_changes(standings.merge_changes(
+            standings.get_score_changes(old.get('speaker_id'), old.get('score'), sign=-1),
+            standings.get_score_changes(instance.speaker_id, instance.score)
+        ))
+        # The score margins of debates with a result count towards the ratings
+        ratings.schedule_rating(instance.debate_id, old.get('debate_id'))
+
+
+@receiver(pre_delete, sender=Score)
+def remove_score_from_standings(sender, instance, **kwargs):
+    speaker_teams = standings.get_speaker_teams(instance.speaker_id)
+    standings.apply_changes(standings.get_score_changes(speaker_teams.get(instance.speaker_id),
+                                                        instance.score, sign=-1),
+                            create=False)
+    standings.apply_speaker_changes(standings.get_score_changes(instance.speaker_id, instance.score, sign=-1))
+    ratings.schedule_rating(instance.debate_id)
+
+
+@receiver(post_save, sender=Speaker)
+def move_speaker_scores(sender, instance, created, raw, **kwargs):
+    """
+    Moves the scores of a speaker changing team over to the new team's
+    standing. Score margins are counted by the speakers' current teams, so the
+    ratings are rebuilt too.
+    """
+    if raw:
+        return
+    old_team_id = _get_loaded(instance).get('team_id')
+    if not created and old_team_id != instance.team_id:
+        score_sum, score_count = standings.get_speaker_score_total(instance.pk)
+        standings.apply_changes(standings.merge_changes(
+            standings.get_score_changes(old_team_id, score_sum, score_count, sign=-1),
+            standings.get_score_changes(instance.team_id, score_sum, score_count)
+        ))
+        if score_count:
+            ratings.schedule_rebuild()
+
+
+@receiver(post_save, sender=Team)
+def create_standing(sender, instance, created, raw, **kwargs):
+    if created and not raw:
+        TeamStanding.objects.get_or_create(team=instance)
+
+
+# Draw cache
+
+@receiver(post_save, sender=Debate)
+@receiver(post_delete, sender=Debate)
+def invalidate_draw_for_debate(sender, instance, **kwargs):
+    draw_cache.invalidate_draw(match_day_id=instance.match_day_id)
+    old_match_day_id = _get_loaded(instance).get('match_day_id')
+    if old_match_day_id != instance.match_day_id:
+        draw_cache.invalidate_draw(match_day_id=old_match_day_id)
+
+
+@receiver(post_save, sender=MatchDay)
+@receiver(post_delete, sender=MatchDay)
+@receiver(post_save, sender=Room)
+@receiver(post_delete, sender=Room)
+@receiver(post_save, sender=Attendance)
+@receiver(post_delete, sender=Attendance)
+def invalidate_draw_for_date(sender, instance, **kwargs):
+    draw_cache.invalidate_draw(instance.date)
+
+
+@receiver(post_save, sender=Team)
+@receiver(post_save, sender=Speaker)
+def invalidate_draws_for_name(sender, instance, created, **kwargs):
+    """ Names are shown on the draws of any date, so a rename makes them all stale. """
+    if not created and _get_loaded(instance).get('name') != instance.name:
+        draw_cache.invalidate_draw(all_dates=True)
+
+
+@receiver(m2m_changed, sender=Debate.judges.through)
+def invalidate_draw_for_judges(sender, instance, action, reverse, pk_set, **kwargs):
+    if not action.startswith('post_'):
+        return
+    if not reverse:
+        draw_cache.invalidate_draw(match_day_id=instance.match_day_id)
+    elif pk_set is None:
+        draw_cache.invalidate_draw(all_dates=True)
+    else:
+        for match_day_id in set(Debate.objects.filter(pk__in=pk_set).values_list('match_day', flat=True)):
+            draw_cache.invalidate_draw(match_day_id=match_day_id)
+
+
+@receiver(m2m_changed, sender=Attendance.speakers.through)
+def invalidate_draw_for_speakers(sender, instance, action, reverse, pk_set, **kwargs):
+    if not action.startswith('post_'):
+        return
+    if not reverse:
+        draw_cache.invalidate_draw(instance.date)
+    elif pk_set is None:
+        draw_cache.invalidate_draw(all_dates=True)
+    else:
+        for date in set(Attendance.objects.filter(pk__in=pk_set).values_list('date', flat=True)):
+            draw_cache.invalidate_draw(date)
+
+
+@receiver(post_save, sender=Debate)
+@receiver(post_save, sender=Score)
+@receiver(post_save, sender=Speaker)
+@receiver(post_save, sender=Team)
+def remember_saved(sender, instance, **kwargs):
+    """ Runs after the other handlers, which compare the instance with the values it was loaded with. """
+    _set_loaded(instance)
@@ -0,0 +1,159 @@
+"""
+Keeps the teams' standings (see models.TeamStanding) and the speakers'
+running score totals in step with the results and scores entered. The
+signal handlers in signals.py pass the changes of each save or delete
+here, and rebuild_standings and rebuild_speaker_scores recompute them from
+scratch.
+"""
+from collections import Counter, defaultdict
+from django.db import transaction
+from django.db.models import Count, F, Sum
+from .models import Attendance, Debate, Score, Speaker, Team, TeamStanding
+from . import ratings
+
+
+def get_result_changes(winning_team_id, affirmative_team_id, negative_team_id, sign=1):
+    """
+    Returns the changes to the standings for adding (sign=1) or removing
+    (sign=-1) the result of a debate between the given teams.
+
+    :return: dict of team pk -> Counter of field name -> change - empty if the
+             debate has no result
+    """
+    changes = defaultdict(Counter)
+    if winning_team_id is None:
+        return changes
+    changes[winning_team_id]['wins'] += sign
+    for team_id, side_field in ((affirmative_team_id, 'affirmative_count'), (negative_team_id, 'negative_count')):
+        if team_id is None:
+            continue
+        changes[team_id]['debates'] += sign
+        changes[team_id][side_field] += sign
+        if team_id != winning_team_id:
+            changes[team_id]['losses'] += sign
+    return changes
+
+
+def get_score_changes(pk, score, count=1, sign=1):
+    """
+    Returns the changes to the score totals of a team (or speaker) for adding
+    (sign=1) or removing (sign=-1) 'count' scores adding up to 'score'.
+
+    :param pk: pk of the team, or of the speaker for apply_speaker_changes -
+               no changes if None
+    """
+    changes = defaultdict(Counter)
+    if pk is not None and count:
+        changes[pk]['score_sum'] += sign * score
+        changes[pk]['score_count'] += sign * count
+    return changes
+
+
+def merge_changes(*changes):
+    """ Returns the sum of the given changes to the standings. """
+    result = defaultdict(Counter)
+    for team_changes in changes:
+        add_changes(result, team_changes)
+    return result
+
+
+def add_changes(total, changes):
+    """ Adds the changes to the standings to 'total', in place. """
+    for team_id, fields in changes.items():
+        total[team_id].update(fields)
+
+
+def get_debate_teams(*attendance_ids):
+    """ Returns a dict of attendance pk -> team pk for the given attendances, in one query. """
+    attendance_ids = [pk for pk in attendance_ids if pk is not None]
+    if not attendance_ids:
+        return {}
+    return dict(Attendance.objects.filter(pk__in=attendance_ids).values_list('pk', 'team'))
+
+
+def get_speaker_teams(*speaker_ids):
+    """ Returns a dict of speaker pk -> team pk for the given speakers, in one query. """
+    speaker_ids = [pk for pk in speaker_ids if pk is not None]
+    if not speaker_ids:
+        return {}
+    return dict(Speaker.objects.filter(pk__in=speaker_ids).values_list('pk', 'team'))
+
+
+def get_speaker_score_total(speaker_id):
+    """ Returns the sum and number of the scores of the speaker, in one query. """
+    totals = Score.objects.filter(speaker=speaker_id).aggregate(Sum('score'), Count('pk'))
+    return totals['score__sum'] or 0, totals['pk__count']
+
+
+def apply_changes(changes, create=True):
+    """
+    Adds the changes to the teams' standings, with one UPDATE per team.
+
+    :param changes: dict of team pk -> field name -> change, e.g. from get_result_changes
+    :param create: if True, standings are created for teams that have none yet -
+                   otherwise those teams are left out
+    """
+    for team_id, fields in changes.items():
+        update = {field: F(field) + change for field, change in fields.items() if change}
+        if not update:
+            continue
+        if not TeamStanding.objects.filter(team=team_id).update(**update) and create:
+            TeamStanding.objects.get_or_create(team_id=team_id)
+            TeamStanding.objects.filter(team=team_id).update(**update)
+
+
+def apply_speaker_changes(changes):
+    """
+    Adds the changes to the speakers' running score totals, with one UPDATE
+    per speaker.
+
+    :param changes: dict of speaker pk -> Counter of field name -> change,
+                    as returned by get_score_changes with a speaker pk
+    """
+    for speaker_id, fields in changes.items():
+        update = {field: F(field) + change for field, change in fields.items() if change}
+        if update:
+            Speaker.objects.filter(pk=speaker_id).update(**update)
+
+
+def rebuild_speaker_scores():
+    """
+    Recomputes the running score totals of all the speakers from the scores,
+    in a fixed number of queries.
+
+    :return: the number of speakers with scores
+    """
+    totals = {speaker_id: (score_sum, score_count) for speaker_id, score_sum, score_count in
+              Score.objects.values_list('speaker').annotate(Sum('score'), Count('pk')).order_by()}
+    speakers = list(Speaker.objects.only('pk', 'score_sum', 'score_count'))
+    for speaker in speakers:
+        speaker.score_sum, speaker.score_count = totals.get(speaker.pk, (0, 0))
+    with transaction.atomic():
+        Speaker.objects.bulk_update(speakers, ['score_sum', 'score_count'], batch_size=500)
+    return len(totals)
+
+
+def rebuild_standings():
+    """
+    Recomputes the standings of all the teams from the debates and scores,
+    replaying their ratings, in a fixed number of queries.
+
+    :return: the number of standings rebuilt
+    """
+    changes = defaultdict(Counter)
+    for winning_team_id, affirmative_team_id, negative_team_id in \
+            Debate.objects.filter(winning_team__isnull=False)\
+                .values_list('winning_team', 'affirmative__team', 'negative__team'):
+        add_changes(changes, get_result_changes(winning_team_id, affirmative_team_id, negative_team_id))
+    for team_id, score_sum, score_count in Score.objects.filter(speaker__team__isnull=False)\
+            .values_list('speaker__team').annotate(Sum('score'), Count('pk')).order_by():
+        add_changes(changes, get_score_changes(team_id, score_sum, score_count))
+
+    with transaction.atomic():
+        TeamStanding.objects.all().delete()
+        rebuilt = TeamStanding.objects.bulk_create([
+            TeamStanding(team_id=team_id, **changes.get(team_id, {}))
+            for team_id in Team.objects.values_list('pk', flat=True)
+        ])
+        ratings.rebuild_ratings()
+    return len(rebuilt)
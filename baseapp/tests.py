@@ -1,3 +1,960 @@
-from django.test import TestCase
+import datetime
+import itertools
+import multiprocessing
+import multiprocessing.pool
+import os
+import random
+import time
+from unittest import mock
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import connection, transaction
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from .models import Team, Speaker, Attendance, Debate, MatchDay, Score, Veto, Room, TeamStanding
+from .exceptions import DrawLockedException, DrawSearchTimeoutException
+from . import adapter, allocator, benchmark, core, draw_cache, feasibility, judge_allocation, judge_selection, local_search, \
+    profiling, matching, pinning, ratings, repair, replay, search, standings, views
+from .draw_context import DrawContext, VetoIndex
 
-# Create your tests here.
\ No newline at end of file
+# Numbers of teams the query budgets are checked at - a budget must hold for
+# all of them, so it cannot depend on the number of rows
+LEAGUE_SIZES = (6, 30)
+
+# Past match days played by the teams in the leagues
+HISTORY_DAYS = 3
+
+
+def add_teams(count, rng):
+    """
+    Adds teams of three speakers, the first of them qualified as a judge, that
+    attend today and the past match days. On each day the attendances are
+    paired off into debates with results and scores, and every fourth one
+    judges instead.
+
+    Returns the list of new teams.
+    """
+    today = timezone.localdate()
+    first = Team.objects.count()
+    teams = Team.objects.bulk_create([Team(name=f"Team {first + i}") for i in range(count)])
+    teams = list(Team.objects.filter(name__in=[team.name for team in teams]).order_by('pk'))
+    for team in teams:
+        for i in range(3):
+            Speaker.objects.create(name=f"{team.name} speaker {i}", team=team, state_team=(i == 0))
+    speakers = list(Speaker.objects.filter(team__in=teams).order_by('pk'))
+    for initiator, receiver in zip(speakers[::7], speakers[3::7]):
+        Veto.objects.create(initiator=initiator, receiver=receiver)
+
+    for days_ago in range(HISTORY_DAYS, -1, -1):
+        date = today - datetime.timedelta(days=7 * days_ago)
+        match_day, created = MatchDay.objects.get_or_create(date=date)
+        attendances = []
+        for i, team in enumerate(teams):
+            attendance = Attendance.objects.create(date=date, team=team, want_to_judge=(i % 4 == 3))
+            attendance.speakers.set(team.speaker_set.all())
+            attendances.append(attendance)
+        judging = attendances[3::4]
+        competing = [attendance for attendance in attendances if attendance not in judging]
+        match_day.attendances_competing.add(*competing)
+        match_day.attendances_judging.add(*judging)
+        rooms = [Room.objects.create(date=date, name=f"Room {attendance.pk}") for attendance in attendances[::2]]
+        for affirmative, negative, judge, room in zip(competing[::2], competing[1::2], judging, rooms):
+            winner = rng.choice((affirmative, negative)) if days_ago else None
+            debate = Debate.objects.create(match_day=match_day, affirmative=affirmative, negative=negative,
+                                           room=room, winning_team=winner.team if winner else None)
+            debate.judges.set(judge.speakers.all()[:1])
+            if winner:
+                for attendance in (affirmative, negative):
+                    for speaker in attendance.speakers.all():
+                        Score.objects.create(debate=debate, speaker=speaker, score=rng.randint(70, 80))
+    return teams
+
+
+def get_min_matching_cost(vertices, costs):
+    """
+    Returns the least total cost of pairing up the vertices with the (i, j)
+    pairs in 'costs', by trying every way to - or None if there is no way.
+    """
+    if not vertices:
+        return 0
+    first, rest = vertices[0], vertices[1:]
+    best = None
+    for k, other in enumerate(rest):
+        pair = (min(first, other), max(first, other))
+        if pair in costs:
+            cost = get_min_matching_cost(rest[:k] + rest[k + 1:], costs)
+            if cost is not None and (best is None or costs[pair] + cost < best):
+                best = costs[pair] + cost
+    return best
+
+
+# The budgets count the app's own queries, so the draws are cached in memory
+# rather than in the database cache
+@override_settings(STATICFILES_STORAGE='django.contrib.staticfiles.storage.StaticFilesStorage',
+                   CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class QueryBudgetTests(TestCase):
+    """
+    Checks that the views, AJAX endpoints, admin pages and the allocator make
+    a fixed number of queries, however big the league is.
+    """
+
+    def setUp(self):
+        self.rng = random.Random(0)
+        self.user = User.objects.create_superuser('admin', 'admin@example.com', 'password')
+
+    def grow_league(self, size):
+        """ Adds teams to the league until there are 'size' of them. """
+        add_teams(size - Team.objects.count(), self.rng)
+        # The draws are only invalidated on commit, which never comes in a TestCase
+        draw_cache.get_draw_cache().clear()
+
+    def assertQueryBudget(self, budget, func, *args, **kwargs):
+        """
+        Calls func with the arguments given, and fails with the SQL run if it
+        makes more than 'budget' queries. Returns what func returned.
+        """
+        with CaptureQueriesContext(connection) as context:
+            result = func(*args, **kwargs)
+        if len(context) > budget:
+            queries = "\n".join(f"{i}. {query['sql']}" for i, query in enumerate(context.captured_queries, 1))
+            self.fail(f"{len(context)} queries made with {Team.objects.count()} teams, " +
+                      f"over the budget of {budget}:\n{queries}")
+        return result
+
+    def assertGetBudget(self, budget, url, data=None, status=200, **headers):
+        response = self.assertQueryBudget(budget, self.client.get, url, data, **headers)
+        self.assertEqual(response.status_code, status, url)
+        return response
+
+    def test_public_views(self):
+        for size in LEAGUE_SIZES:
+            self.grow_league(size)
+            debate = Debate.objects.filter(match_day__date=timezone.localdate()).first()
+            self.assertGetBudget(0, reverse('baseapp:index'))
+            self.assertGetBudget(5, reverse('baseapp:debates'))
+            self.assertGetBudget(0, reverse('baseapp:debates'))
+            response = self.assertGetBudget(0, reverse('baseapp:draw_json'))
+            self.assertGetBudget(0, reverse('baseapp:draw_json'), status=304,
+                                 HTTP_IF_NONE_MATCH=response['ETag'])
+            self.assertGetBudget(3, reverse('baseapp:debate_detail', args=(debate.pk,)))
+            self.assertGetBudget(2, reverse('baseapp:attendanceform'))
+            self.assertGetBudget(0, reverse('baseapp:signupform'))
+
+            # The table is not routed at the moment
+            request = self.client.get(reverse('baseapp:index')).wsgi_request
+            response = self.assertQueryBudget(1, views.table, request)
+            self.assertEqual(response.status_code, 200)
+
+    def test_preview_debates(self):
+        self.client.force_login(self.user)
+        for size in LEAGUE_SIZES:
+            self.grow_league(size)
+            MatchDay.objects.filter(date=timezone.localdate()).delete()
+            # 10, plus the session and user of the staff member, and saving the preview to the session
+            self.assertGetBudget(14, reverse('baseapp:preview_debates'), {'seed': 0})
+
+    def test_ajax_endpoints(self):
+        for size in LEAGUE_SIZES:
+            self.grow_league(size)
+            team = Team.objects.first()
+            debate = Debate.objects.first()
+            self.assertGetBudget(1, reverse('baseapp:filter_speakers_in_team'), {'team_id': team.pk})
+            self.assertGetBudget(5, reverse('baseapp:filter_debate_details'), {'debate_id': debate.pk})
+            self.assertGetBudget(1, '/ajax_select/ajax_lookup/speakers_team_signup', {'term': 'speaker'})
+
+    def test_generate_debates(self):
+        for size in LEAGUE_SIZES:
+            self.grow_league(size)
+            for ranking in allocator.RANKING_KEYS:
+                with self.subTest(ranking=ranking), self.settings(DRAW_RANKING=ranking):
+                    MatchDay.objects.filter(date=timezone.localdate()).delete()
+                    match_day = self.assertQueryBudget(27, allocator.generate_debates, timezone.localdate(),
+                                                       rng=random.Random(0))
+                    self.assertTrue(match_day.debate_set.exists())
+
+    def test_admin_changelists(self):
+        self.client.force_login(self.user)
+        budgets = {Team: 5, Speaker: 6, Attendance: 7, MatchDay: 7, Debate: 6, Veto: 5, Room: 5}
+        for size in LEAGUE_SIZES:
+            self.grow_league(size)
+            for model, budget in budgets.items():
+                self.assertGetBudget(budget, reverse(f'myadmin:baseapp_{model._meta.model_name}_changelist'))
+
+    def test_admin_change_pages(self):
+        self.client.force_login(self.user)
+        budgets = {Team: 7, Speaker: 7, Attendance: 9, Debate: 23, Veto: 10, Room: 6}
+        for size in LEAGUE_SIZES:
+            self.grow_league(size)
+            for model, budget in budgets.items():
+                obj = model.objects.order_by('-pk').first()
+                self.assertGetBudget(budget, reverse(f'myadmin:baseapp_{model._meta.model_name}_change',
+                                                     args=(obj.pk,)))
+
+            # Draws can still be edited on the day, and are read only afterwards
+            today, past = MatchDay.objects.order_by('-date')[:2]
+            self.assertGetBudget(29, reverse('myadmin:baseapp_matchday_change', args=(today.pk,)))
+            self.assertGetBudget(16, reverse('myadmin:baseapp_matchday_change', args=(past.pk,)))
+
+
+@override_settings(STATICFILES_STORAGE='django.contrib.staticfiles.storage.StaticFilesStorage')
+class DrawPreviewTests(TestCase):
+    """ Checks that only staff can make draws, and that the draw saved is the one previewed. """
+
+    def setUp(self):
+        add_teams(8, random.Random(0))
+        MatchDay.objects.filter(date=timezone.localdate()).delete()
+        self.client.force_login(User.objects.create_superuser('admin', 'admin@example.com', 'password'))
+
+    def preview(self):
+        response = self.client.get(reverse('baseapp:preview_debates'), {'seed': 0, 'strategy': 'greedy'})
+        self.assertEqual(200, response.status_code)
+        return response.context['debates']
+
+    def generate(self):
+        return self.client.post(reverse('baseapp:generate_debates'), {'seed': 0, 'strategy': 'greedy'})
+
+    def test_staff_only(self):
+        self.client.logout()
+        self.assertRedirects(self.client.get(reverse('baseapp:preview_debates')),
+                             reverse('myadmin:login') + '?next=' + reverse('baseapp:preview_debates'))
+        self.assertRedirects(self.generate(), reverse('myadmin:login') + '?next=' + reverse('baseapp:generate_debates'))
+        self.assertFalse(MatchDay.objects.filter(date=timezone.localdate()).exists())
+
+    def test_saves_preview(self):
+        previewed = self.preview()
+        self.generate()
+        match_day = MatchDay.objects.get(date=timezone.localdate())
+        self.assertEqual([(debate['team1']['name'], debate['team2']['name']) for debate in previewed],
+                         [(debate.affirmative.team.name, debate.negative.team.name)
+                          for debate in match_day.debate_set.order_by('pk')])
+
+    def test_shows_phases(self):
+        with self.settings(DRAW_PROFILING=True):
+            self.preview()
+            phases = self.client.get(reverse('baseapp:preview_debates'), {'seed': 0}).context['phases']
+            self.assertEqual('context', phases[0][0])
+            self.assertGreater(phases[0][2], 0)
+        with self.settings(DRAW_PROFILING=False):
+            self.assertIsNone(self.client.get(reverse('baseapp:preview_debates'), {'seed': 0}).context['phases'])
+
+    def test_refuses_changed_draw(self):
+        # Saving without a preview
+        self.assertEqual(302, self.generate().status_code)
+        self.assertFalse(MatchDay.objects.filter(date=timezone.localdate()).exists())
+
+        self.preview()
+        Attendance.objects.filter(date=timezone.localdate()).first().delete()
+        response = self.generate()
+        self.assertFalse(MatchDay.objects.filter(date=timezone.localdate()).exists())
+        self.assertIn("The draw changed since it was previewed. Please preview it again.",
+                      [str(message) for message in response.wsgi_request._messages])
+
+
+class ProfilingTests(TestCase):
+    """ Checks the phases recorded by profiling.record_phases. """
+
+    def test_records_phases(self):
+        with profiling.record_phases() as outer:
+            with profiling.phase('queries'):
+                list(Team.objects.all())
+                list(Speaker.objects.all())
+            with profiling.record_phases() as inner:
+                with profiling.phase('queries'):
+                    list(Room.objects.all())
+                with profiling.phase('sleep'):
+                    time.sleep(0.01)
+        # Phases run more than once are added up, and count towards every recorder active
+        self.assertEqual(['queries', 'sleep'], list(outer.phases))
+        self.assertEqual({'queries': 3, 'calls': 2}, {key: outer.phases['queries'][key] for key in ('queries', 'calls')})
+        self.assertEqual({'queries': 1, 'calls': 1}, {key: inner.phases['queries'][key] for key in ('queries', 'calls')})
+        self.assertGreaterEqual(outer.phases['sleep']['time'], 0.01)
+        self.assertEqual(0, outer.phases['sleep']['queries'])
+        self.assertEqual(3, outer.total_queries)
+
+    def test_disabled(self):
+        with profiling.record_phases(enabled=False) as recorder:
+            with profiling.phase('queries'):
+                list(Team.objects.all())
+        self.assertIsNone(recorder)
+        # A phase outside of any recorder does nothing
+        with self.assertNumQueries(1), profiling.phase('queries'):
+            list(Team.objects.all())
+
+    def test_setting(self):
+        add_teams(8, random.Random(0))
+        MatchDay.objects.filter(date=timezone.localdate()).delete()
+        with self.settings(DRAW_PROFILING=False):
+            self.assertIsNone(allocator.preview_debates(timezone.localdate(), rng=random.Random(0)).phases)
+        # Profiling follows DEBUG unless set
+        for debug in (False, True):
+            with self.settings(DEBUG=debug):
+                del settings.DRAW_PROFILING
+                self.assertEqual(debug, profiling.is_profiling_enabled())
+        with self.settings(DRAW_PROFILING=True):
+            draw = allocator.preview_debates(timezone.localdate(), rng=random.Random(0))
+        self.assertEqual(draw.phases.total_queries, sum(totals['queries'] for totals in draw.phases.phases.values()))
+        self.assertGreater(draw.phases.phases['context']['queries'], 0)
+
+
+class BenchmarkTests(SimpleTestCase):
+    """ Checks that the benchmark keeps away from the configured database. """
+
+    def test_refuses_configured_database(self):
+        with self.assertRaises(RuntimeError):
+            benchmark.run_benchmark(20, memory=False)
+
+
+class CoreTests(TestCase):
+    """ Checks that the allocator makes the same draws on core objects (see core.py) as on models. """
+
+    def test_same_draw(self):
+        add_teams(12, random.Random(0))
+        today = timezone.localdate()
+        MatchDay.objects.filter(date=today).delete()
+        for strategy in ('greedy', 'matching'):
+            for seed in range(3):
+                draw = allocator.preview_debates(today, rng=random.Random(seed), strategy=strategy)
+                context = adapter.load_context(today, rng=random.Random(seed))
+                core_draw = allocator.build_draw(context, adapter.load_rooms(today), strategy=strategy,
+                                                 debate_class=core.Debate)
+                self.assertEqual(draw.get_fingerprint(), core_draw.get_fingerprint())
+                self.assertEqual(draw.score, core_draw.score)
+
+
+class SearchTests(TestCase):
+    """ Checks the search for the best of several draws. """
+
+    def test_time_budget(self):
+        add_teams(12, random.Random(0))
+        MatchDay.objects.filter(date=timezone.localdate()).delete()
+        draw = search.search_debates(timezone.localdate(), candidates=8, time_budget=0, max_workers=2, seed=0)
+        self.assertTrue(draw.debates)
+        # The workers still making candidates when the budget ran out are stopped
+        self.assertEqual([], multiprocessing.active_children())
+
+    def test_lost_candidates(self):
+        add_teams(12, random.Random(0))
+        MatchDay.objects.filter(date=timezone.localdate()).delete()
+        # Candidates lost with a worker that was killed never finish
+        with mock.patch.object(multiprocessing.pool.Pool, 'apply_async'), \
+                mock.patch.object(search, 'SEARCH_TIMEOUT', 0.2):
+            with self.assertRaises(DrawSearchTimeoutException):
+                search.search_debates(timezone.localdate(), candidates=4, time_budget=0, max_workers=2, seed=0)
+        self.assertEqual([], multiprocessing.active_children())
+
+    def test_max_workers(self):
+        with self.settings(DRAW_SEARCH_MAX_WORKERS=1):
+            self.assertEqual(1, search.get_max_workers())
+        with self.settings(DRAW_SEARCH_MAX_WORKERS=10 ** 6):
+            self.assertEqual(os.cpu_count(), search.get_max_workers())
+
+
+class MatchingTests(SimpleTestCase):
+    """ Checks matching.min_cost_perfect_matching against trying every matching. """
+
+    def test_against_brute_force(self):
+        rng = random.Random(0)
+        for n in (0, 2, 4, 6, 8):
+            for _ in range(25):
+                costs = {pair: rng.randint(0, 20) for pair in itertools.combinations(range(n), 2)
+                         if rng.random() < 0.6}
+                pairs = matching.min_cost_perfect_matching(n, costs)
+                best = get_min_matching_cost(list(range(n)), costs)
+                if best is None:
+                    self.assertIsNone(pairs)
+                    continue
+                self.assertEqual(list(range(n)), sorted(vertex for pair in pairs for vertex in pair))
+                self.assertEqual(best, sum(costs[pair] for pair in pairs))
+
+
+class JudgeAllocationTests(SimpleTestCase):
+    """ Checks judge_allocation.allocate_judges on core objects. """
+
+    def setUp(self):
+        date = datetime.date(2020, 1, 1)
+        self.attendances = []
+        for pk in range(1, 5):
+            team = core.Team(pk, f"Team {pk}")
+            self.attendances.append(core.Attendance(pk, date, team, [core.Speaker(pk, f"Speaker {pk}", pk)]))
+        # The strongest judge would chair the highest ranked debate
+        self.strong_judge = core.Speaker(5, "Strong judge", 5, qualification_score=100)
+        self.weak_judge = core.Speaker(6, "Weak judge", 6, qualification_score=10)
+        self.pairs = [tuple(self.attendances[:2]), tuple(self.attendances[2:])]
+
+    def allocate(self, vetoes):
+        context = DrawContext.from_core(self.attendances, vetoes, core.History())
+        return judge_allocation.allocate_judges([self.strong_judge, self.weak_judge], self.pairs, context)
+
+    def test_avoids_conflicts(self):
+        self.assertEqual([[self.strong_judge], [self.weak_judge]], self.allocate([]))
+        # A veto against a speaker in the first debate moves the judge to the other one
+        veto = core.Veto(1, self.strong_judge, self.attendances[1].speakers[0])
+        self.assertEqual([[self.weak_judge], [self.strong_judge]], self.allocate([veto]))
+
+    def test_unavoidable_conflicts(self):
+        # Every judge has a conflict, so every debate still gets one
+        vetoes = [core.Veto(1, self.attendances[0].speakers[0], self.strong_judge),
+                  core.Veto(2, self.weak_judge, self.attendances[3].speakers[0]),
+                  core.Veto(3, self.strong_judge, self.attendances[2].speakers[0]),
+                  core.Veto(4, self.attendances[1].speakers[0], self.weak_judge)]
+        self.assertEqual([1, 1], [len(panel) for panel in self.allocate(vetoes)])
+
+
+class JudgeSelectionTests(SimpleTestCase):
+    """ Checks judge_selection.select_judging_attendances against trying every choice. """
+
+    def test_against_exhaustive_search(self):
+        rng = random.Random(0)
+        for _ in range(300):
+            attendances_count = rng.randint(1, 10)
+            judge_counts = [rng.randint(1, 3) for _ in range(rng.randint(0, attendances_count))]
+            priorities = [rng.randint(0, 10) for _ in judge_counts]
+
+            # The fewest attendances judging, with the highest total priority
+            best = None
+            for judging in range(len(judge_counts) + 1):
+                competing = attendances_count - judging
+                for chosen in itertools.combinations(range(len(judge_counts)), judging):
+                    if competing >= 2 and competing % 2 == 0 and \
+                            sum(judge_counts[i] for i in chosen) >= competing // 2:
+                        key = (judging, -sum(priorities[i] for i in chosen))
+                        best = key if best is None else min(best, key)
+                if best is not None:
+                    break
+
+            chosen = judge_selection.select_judging_attendances(attendances_count, judge_counts, priorities)
+            if best is None:
+                self.assertIsNone(chosen)
+                continue
+            self.assertEqual(len(chosen), len(set(chosen)))
+            self.assertEqual(best, (len(chosen), -sum(priorities[i] for i in chosen)))
+            self.assertGreaterEqual(sum(judge_counts[i] for i in chosen), (attendances_count - len(chosen)) // 2)
+
+
+class FeasibilityTests(SimpleTestCase):
+    """ Checks feasibility.find_conflicting_vetoes against trying every pairing. """
+
+    def can_pair_up(self, attendances, vetoes):
+        blocked = {(min(veto.initiator.pk, veto.receiver.pk), max(veto.initiator.pk, veto.receiver.pk))
+                   for veto in vetoes}
+        allowed = dict.fromkeys((pair for pair in itertools.combinations(range(len(attendances)), 2)
+                                 if pair not in blocked), 0)
+        return get_min_matching_cost(list(range(len(attendances))), allowed) is not None
+
+    def test_minimal_conflicts(self):
+        rng = random.Random(0)
+        date = datetime.date(2020, 1, 1)
+        conflicts_found = 0
+        for _ in range(100):
+            # One speaker per team, with pks from 0, so a veto blocks the pair of its speakers' indices
+            attendances = [core.Attendance(pk, date, core.Team(pk, f"Team {pk}"),
+                                           [core.Speaker(pk, f"Speaker {pk}", pk)])
+                           for pk in range(rng.choice((4, 6, 8)))]
+            speakers = [attendance.speakers[0] for attendance in attendances]
+            all_pairs = list(itertools.combinations(speakers, 2))
+            pairs = rng.sample(all_pairs, rng.randint(0, min(len(all_pairs), 2 * len(speakers))))
+            vetoes = [core.Veto(i, *rng.sample(pair, 2)) for i, pair in enumerate(pairs)]
+
+            conflicting = feasibility.find_conflicting_vetoes(attendances, VetoIndex(attendances, vetoes))
+            if self.can_pair_up(attendances, vetoes):
+                self.assertEqual([], conflicting)
+                continue
+            conflicts_found += 1
+            # The vetoes found cannot be satisfied together, but can without any one of them
+            self.assertFalse(self.can_pair_up(attendances, conflicting))
+            for veto in conflicting:
+                self.assertTrue(self.can_pair_up(attendances, [other for other in conflicting if other is not veto]))
+        self.assertGreater(conflicts_found, 10)
+
+
+class LocalSearchTests(SimpleTestCase):
+    """ Checks the simulated annealing in local_search.py. """
+
+    def test_moves_vetoed_teams_far_apart(self):
+        # Teams 0 and 1 have vetoes with each other and every team in the first
+        # debates, and other teams are far better off where they are, so 0 and 1
+        # can only be moved apart by swaps with later debates
+        debates_count = 16
+        pair_costs = [[0 if a // 2 == b // 2 else 1000 for b in range(2 * debates_count)]
+                      for a in range(2 * debates_count)]
+        for team in (0, 1):
+            for other in range(2 * (local_search.SWAP_DISTANCE + 1)):
+                pair_costs[team][other] = pair_costs[other][team] = local_search.VETO_COST
+        state = local_search._DrawState(
+            aff=list(range(0, 2 * debates_count, 2)), neg=list(range(1, 2 * debates_count, 2)),
+            panels=[[] for _ in range(debates_count)], pair_costs=pair_costs, sides=[0] * (2 * debates_count),
+            side_weight=0, conflicts=[], strengths=[], target_strengths=[0] * debates_count,
+        )
+        self.assertEqual(1, state.veto_clashes)
+        aff, neg, panels = local_search._anneal(state, random.Random(0), 5000, time.monotonic() + 60)
+        self.assertFalse(any(pair_costs[a][n] >= local_search.VETO_COST for a, n in zip(aff, neg)))
+
+    def test_independent_of_time(self):
+        rng = random.Random(0)
+        attendances, vetoes, history, rooms = benchmark.make_league(60, vetoes_per_team=0.5, rng=rng)
+        # Uneven wins and sides, so that there is something to improve
+        history = core.History(wins={attendance.team.pk: rng.randint(0, 5) for attendance in attendances},
+                               side_counts=[(attendance.team.pk, rng.randint(0, 3), rng.randint(0, 3))
+                                            for attendance in attendances])
+
+        def describe_draw():
+            context = DrawContext.from_core(attendances, vetoes, history, rng=random.Random(0))
+            draw = allocator.build_draw(context, rooms, improve=True, debate_class=core.Debate)
+            return draw.get_fingerprint()
+
+        draw = describe_draw()
+        # However slow the machine, the same seed gives the same draw
+        clock = itertools.count(step=1000)
+        with mock.patch.object(local_search.time, 'monotonic', lambda: next(clock)):
+            self.assertEqual(draw, describe_draw())
+
+
+@override_settings(STATICFILES_STORAGE='django.contrib.staticfiles.storage.StaticFilesStorage')
+class RepairTests(TestCase):
+    """ Checks the updates to a draw for late changes in attendance (see repair.py). """
+
+    def setUp(self):
+        add_teams(12, random.Random(0))
+        MatchDay.objects.filter(date=timezone.localdate()).delete()
+        self.match_day = allocator.generate_debates(timezone.localdate(), rng=random.Random(0))
+
+    def get_debates(self):
+        """ Returns a dict of debate pk -> (affirmative pk, negative pk, room pk, judge pks) for the draw. """
+        return {debate.pk: (debate.affirmative_id, debate.negative_id, debate.room_id,
+                            {judge.pk for judge in debate.judges.all()})
+                for debate in self.match_day.debate_set.prefetch_related('judges')}
+
+    def test_keeps_untouched_debates(self):
+        before = self.get_debates()
+        debate = self.match_day.debate_set.first()
+        late_team = Team.objects.create(name="Late team")
+        late = Attendance.objects.create(date=self.match_day.date, team=late_team)
+        late.speakers.set([Speaker.objects.create(name=f"Late speaker {i}", team=late_team) for i in range(3)])
+
+        result = repair.repair_draw(self.match_day, removed=[debate.negative], rng=random.Random(0))
+        self.assertEqual({'created': 0, 'updated': 1, 'deleted': 0, 'panels_changed': 1, 'judging': []}, result)
+
+        # The late team takes the withdrawn team's place, in the same row and room
+        after = self.get_debates()
+        self.assertEqual({debate.affirmative_id, late.pk}, set(after[debate.pk][:2]))
+        self.assertEqual(debate.room_id, after[debate.pk][2])
+        # The other debates are left as they were
+        del before[debate.pk], after[debate.pk]
+        self.assertEqual(before, after)
+
+    def test_refuses_draws_with_results(self):
+        self.client.force_login(User.objects.create_superuser('admin', 'admin@example.com', 'password'))
+        past = MatchDay.objects.exclude(pk=self.match_day.pk).latest('date')
+        debates = list(past.debate_set.values_list('pk', 'affirmative', 'negative', 'winning_team').order_by('pk'))
+        attendance = past.debate_set.first().affirmative
+        response = self.client.post(reverse('myadmin:baseapp_attendance_changelist'),
+                                    {'action': 'withdraw_from_draw', '_selected_action': [attendance.pk]}, follow=True)
+        self.assertIn(f"{past}: The draw for {past} can no longer be changed, as it is not for today or has results.",
+                      [str(message) for message in response.context['messages']])
+        self.assertEqual(debates, list(past.debate_set.values_list('pk', 'affirmative', 'negative', 'winning_team')
+                                       .order_by('pk')))
+        attendance.refresh_from_db()
+        self.assertFalse(attendance.withdrawn)
+
+        Score.objects.create(debate=self.match_day.debate_set.first(),
+                             speaker=self.match_day.debate_set.first().affirmative.speakers.first(), score=75)
+        with self.assertRaises(DrawLockedException):
+            repair.repair_draw(self.match_day)
+
+    def test_withdraw(self):
+        self.client.force_login(User.objects.create_superuser('admin', 'admin@example.com', 'password'))
+        debate = self.match_day.debate_set.first()
+        withdrawn, opponent = debate.affirmative, debate.negative
+        response = self.client.post(reverse('myadmin:baseapp_attendance_changelist'),
+                                    {'action': 'withdraw_from_draw', '_selected_action': [withdrawn.pk]}, follow=True)
+
+        # The attendance is kept, but is off the draw for good
+        withdrawn.refresh_from_db()
+        self.assertTrue(withdrawn.withdrawn)
+        self.assertNotIn(withdrawn, self.match_day.attendances_competing.all())
+        self.assertNotIn(withdrawn, repair.get_late_attendances(self.match_day))
+
+        # Its opponent had no one left to debate, and judges instead - which the user is told
+        self.assertIn(opponent, self.match_day.attendances_judging.all())
+        self.assertIn(f"{self.match_day}: {opponent.team.name} will judge instead of competing, " +
+                      "as there was no opponent or not enough judges for them.",
+                      [str(message) for message in response.context['messages']])
+
+
+class PinningTests(TestCase):
+    """ Checks redoing a draw around its pinned debates (see pinning.py). """
+
+    def setUp(self):
+        add_teams(12, random.Random(0))
+        MatchDay.objects.filter(date=timezone.localdate()).delete()
+        self.match_day = allocator.generate_debates(timezone.localdate(), rng=random.Random(0))
+
+    def test_keeps_pinned(self):
+        debates = list(self.match_day.debate_set.order_by('pk').prefetch_related('judges'))
+        teams_pinned, judges_pinned, room_pinned = debates[:3]
+        Debate.objects.filter(pk=teams_pinned.pk).update(pinned=True)
+        Debate.objects.filter(pk=judges_pinned.pk).update(judges_pinned=True)
+        Debate.objects.filter(pk=room_pinned.pk).update(room_pinned=True)
+
+        pinning.redo_unpinned_debates(self.match_day, rng=random.Random(1))
+        redone = self.match_day.debate_set.prefetch_related('judges').in_bulk()
+        self.assertEqual((teams_pinned.affirmative_id, teams_pinned.negative_id),
+                         (redone[teams_pinned.pk].affirmative_id, redone[teams_pinned.pk].negative_id))
+        self.assertEqual(set(judges_pinned.judges.all()), set(redone[judges_pinned.pk].judges.all()))
+        self.assertEqual(room_pinned.room_id, redone[room_pinned.pk].room_id)
+
+    def test_refuses_draws_with_results(self):
+        past = MatchDay.objects.exclude(pk=self.match_day.pk).latest('date')
+        debates = list(past.debate_set.values_list('pk', 'affirmative', 'negative', 'winning_team').order_by('pk'))
+        with self.assertRaises(DrawLockedException):
+            pinning.redo_unpinned_debates(past, rng=random.Random(1))
+        self.assertEqual(debates, list(past.debate_set.values_list('pk', 'affirmative', 'negative', 'winning_team')
+                                       .order_by('pk')))
+
+        debate = self.match_day.debate_set.first()
+        debate.winning_team = debate.affirmative.team
+        debate.save()
+        with self.assertRaises(DrawLockedException):
+            pinning.redo_unpinned_debates(self.match_day, rng=random.Random(1))
+
+    def test_allocates_judges_once(self):
+        debate = self.match_day.debate_set.first()
+        debate.pinned = True
+        debate.save()
+        with mock.patch.object(pinning, 'allocate_judges', wraps=pinning.allocate_judges) as allocate_judges, \
+                mock.patch('baseapp.allocator.allocate_judges') as allocate_for_pairs:
+            pinning.redo_unpinned_debates(self.match_day, rng=random.Random(1))
+        # The pinned debate's panel is allocated along with the new pairs'
+        allocate_judges.assert_called_once()
+        self.assertEqual(self.match_day.debate_set.count(), len(allocate_judges.call_args[0][1]))
+        allocate_for_pairs.assert_not_called()
+
+
+class ReplayTests(TestCase):
+    """ Checks that past match days are replayed with the league as it was then (see replay.py). """
+
+    def setUp(self):
+        add_teams(12, random.Random(0))
+        standings.rebuild_standings()
+
+    def get_state(self):
+        """ Returns what a replay could change in the database. """
+        DebateJudge = Debate.judges.through
+        return (list(MatchDay.objects.order_by('pk').values_list()),
+                list(Attendance.objects.order_by('pk').values_list()),
+                list(Debate.objects.order_by('pk').values_list()),
+                list(DebateJudge.objects.order_by('pk').values_list()),
+                list(Room.objects.order_by('pk').values_list()),
+                list(TeamStanding.objects.order_by('pk').values_list()))
+
+    def test_database_unchanged(self):
+        before = self.get_state()
+        results = list(replay.replay_history(strategies=('greedy', 'matching'), improve=True))
+        self.assertEqual(HISTORY_DAYS + 1, len(results))
+        for result in results:
+            for rerun in result['reruns'].values():
+                self.assertNotIn('error', rerun)
+        self.assertEqual(before, self.get_state())
+
+    def test_history_before_date(self):
+        DebateJudge = Debate.judges.through
+        build_draw = allocator.build_draw
+        dates = []
+
+        def check_context(context, *args, **kwargs):
+            before = Debate.objects.filter(match_day__date__lt=context.date)
+            judged_before = set(DebateJudge.objects.filter(debate__match_day__date__lt=context.date)
+                                .values_list('speaker__team', flat=True))
+            for attendance in context.attendances:
+                team = attendance.team
+                self.assertEqual(before.filter(winning_team=team.pk).count(), context.get_wins(team))
+                self.assertEqual(before.filter(affirmative__team=team.pk).count()
+                                 - before.filter(negative__team=team.pk).count(), context.compare_aff_neg(team))
+                self.assertEqual(team.pk in judged_before, team.judged_before)
+            for attendance1, attendance2 in itertools.combinations(context.attendances, 2):
+                met = before.filter(affirmative__team__in=(attendance1.team.pk, attendance2.team.pk),
+                                    negative__team__in=(attendance1.team.pk, attendance2.team.pk)).count()
+                self.assertEqual(met, context.head_to_head.times_met(attendance1.team, attendance2.team))
+            dates.append(context.date)
+            return build_draw(context, *args, **kwargs)
+
+        with mock.patch.object(allocator, 'build_draw', side_effect=check_context):
+            list(replay.replay_history(strategies=('greedy', 'matching')))
+        match_dates = sorted(MatchDay.objects.values_list('date', flat=True))
+        self.assertEqual([date for date in match_dates for _ in range(2)], dates)
+
+    def test_actual_draw_not_own_history(self):
+        results = list(replay.replay_history())
+        # The teams meet the same opponents every week, with no history before the first
+        first = results[0]['actual']['metrics']
+        self.assertEqual(0, first['repeats'])
+        self.assertEqual(0, first['win_gap_total'])
+        self.assertEqual(2 * first['debates'], first['side_imbalance'])
+        for result in results[1:]:
+            metrics = result['actual']['metrics']
+            self.assertEqual(metrics['debates'], metrics['repeats'])
+
+
+class StandingsTests(TestCase):
+    """
+    Checks that the standings and speakers' score totals kept up to date on
+    each change match the ones rebuilt from scratch.
+    """
+
+    def setUp(self):
+        self.rng = random.Random(0)
+        add_teams(8, self.rng)
+        # The teams are bulk created, without standings for the ones yet to win or score
+        standings.rebuild_standings()
+
+    def assertStandingsUpToDate(self):
+        fields = ('team', 'wins', 'losses', 'debates', 'affirmative_count', 'negative_count',
+                  'score_sum', 'score_count')
+        kept = list(TeamStanding.objects.order_by('team').values_list(*fields))
+        standings.rebuild_standings()
+        self.assertEqual(kept, list(TeamStanding.objects.order_by('team').values_list(*fields)))
+
+        speaker_fields = ('pk', 'score_sum', 'score_count')
+        kept = list(Speaker.objects.order_by('pk').values_list(*speaker_fields))
+        standings.rebuild_speaker_scores()
+        self.assertEqual(kept, list(Speaker.objects.order_by('pk').values_list(*speaker_fields)))
+        for speaker in Speaker.analytics.filter(score__isnull=False).distinct():
+            self.assertAlmostEqual(speaker.get_avg_score(), float(speaker.avg_score))
+
+    def test_results_and_scores(self):
+        # Results entered, changed and taken back
+        debate = Debate.objects.filter(winning_team__isnull=True).first()
+        debate.winning_team = debate.affirmative.team
+        debate.save()
+        self.assertStandingsUpToDate()
+        debate = Debate.objects.get(pk=debate.pk)
+        debate.winning_team = debate.negative.team
+        debate.save()
+        self.assertStandingsUpToDate()
+        debate.winning_team = None
+        debate.save()
+        self.assertStandingsUpToDate()
+
+        # Scores changed, moved to another speaker and deleted
+        score = Score.objects.first()
+        score.score += 1
+        score.save()
+        self.assertStandingsUpToDate()
+        score.speaker = Speaker.objects.exclude(team=score.speaker.team).first()
+        score.save()
+        self.assertStandingsUpToDate()
+        score.delete()
+        self.assertStandingsUpToDate()
+
+        # A speaker changing team, and debates and teams deleted
+        speaker = Speaker.objects.filter(score__isnull=False).first()
+        speaker.team = Team.objects.exclude(pk=speaker.team_id).first()
+        speaker.save()
+        self.assertStandingsUpToDate()
+        Debate.objects.filter(winning_team__isnull=False).first().delete()
+        self.assertStandingsUpToDate()
+        Team.objects.last().delete()
+        self.assertStandingsUpToDate()
+
+
+class RatingsTests(TransactionTestCase):
+    """ Checks that ratings applied as results are entered match a replay of the history. """
+
+    def assertRatingsReplayed(self):
+        replayed = ratings.replay(ratings.load_results())
+        for team_id, rating in TeamStanding.objects.values_list('team', 'rating'):
+            self.assertAlmostEqual(replayed.get(team_id), rating)
+
+    def test_results_in_order(self):
+        add_teams(8, random.Random(0))
+        Score.objects.all().delete()
+        results = list(Debate.objects.filter(winning_team__isnull=False)
+                       .order_by('match_day__date', 'pk').values_list('pk', 'winning_team'))
+        Debate.objects.update(winning_team=None)
+        standings.rebuild_standings()
+
+        # Results entered one at a time, in date order, are applied as they come
+        for pk, winning_team_id in results:
+            debate = Debate.objects.get(pk=pk)
+            debate.winning_team_id = winning_team_id
+            debate.save()
+        applied = dict(TeamStanding.objects.values_list('team', 'rating'))
+        self.assertEqual(len(results), ratings.rebuild_ratings())
+        replayed = dict(TeamStanding.objects.values_list('team', 'rating'))
+        self.assertEqual(applied.keys(), replayed.keys())
+        for team_id, rating in replayed.items():
+            self.assertAlmostEqual(applied[team_id], rating)
+        self.assertNotEqual(set(replayed.values()), {ratings.INITIAL_RATING})
+
+    def test_result_and_scores_entered_together(self):
+        add_teams(8, random.Random(0))
+        debate = Debate.objects.filter(winning_team__isnull=False).latest('match_day__date', 'pk')
+        winning_team_id = debate.winning_team_id
+        scores = [(score.speaker_id, score.score) for score in debate.score_set.all()]
+        debate.winning_team = None
+        debate.save()
+        debate.score_set.all().delete()
+        self.assertRatingsReplayed()
+
+        # As saved from the admin: the result, then its scores, in one transaction
+        with mock.patch.object(ratings, 'rebuild_ratings', side_effect=AssertionError("replayed")):
+            with transaction.atomic():
+                debate.winning_team_id = winning_team_id
+                debate.save()
+                for speaker_id, score in scores:
+                    Score.objects.create(debate=debate, speaker_id=speaker_id, score=score)
+            self.assertRatingsReplayed()
+
+            # Its scores corrected later
+            score = debate.score_set.filter(speaker__team=winning_team_id).first()
+            score.score += 10
+            score.save()
+            self.assertRatingsReplayed()
+        self.assertEqual([debate.pk] * 2, list(TeamStanding.objects.filter(
+            team__in=(debate.affirmative.team_id, debate.negative.team_id)).values_list('rated_debate', flat=True)))
+
+    def test_earlier_result_changed(self):
+        add_teams(8, random.Random(0))
+        debate = Debate.objects.filter(winning_team__isnull=False).earliest('match_day__date', 'pk')
+        self.assertFalse(ratings.rate_debates([debate.pk]))
+        debate.score_set.first().delete()
+        self.assertRatingsReplayed()
+        debate.winning_team_id = debate.negative.team_id if debate.winning_team_id == debate.affirmative.team_id \
+            else debate.affirmative.team_id
+        debate.save()
+        self.assertRatingsReplayed()
+
+    def test_replay(self):
+        rng = random.Random(0)
+        results = [(rng.randrange(10), rng.randrange(10, 20), rng.uniform(-5, 20)) for _ in range(500)]
+        replayed = ratings.replay(results)
+        self.assertEqual(replayed.ratings, ratings.replay(results).ratings)
+        # Points only change hands
+        self.assertAlmostEqual(sum(replayed.ratings.values()), 20 * ratings.INITIAL_RATING)
+        # A bigger margin moves the ratings further
+        self.assertGreater(ratings.Ratings().record(1, 2, margin=10), ratings.Ratings().record(1, 2))
+
+    def test_ranking_by_rating(self):
+        add_teams(8, random.Random(0))
+        standings.rebuild_standings()
+        context = DrawContext.for_date(timezone.localdate())
+        attendances = [attendance for attendance in context.attendances if not attendance.want_to_judge]
+        ranked = allocator.rank_attendances(attendances, context, ranking='rating')
+        team_ratings = [context.get_rating(attendance.team) for attendance in ranked]
+        self.assertEqual(team_ratings, sorted(team_ratings, reverse=True))
+        self.assertEqual(team_ratings, [Team.objects.get(pk=attendance.team_id).get_rating()
+                                        for attendance in ranked])
+
+
+@override_settings(STATICFILES_STORAGE='django.contrib.staticfiles.storage.StaticFilesStorage')
+class DrawCacheTests(TransactionTestCase):
+    """ Checks that the cached draw is rebuilt once the draw changes, and only then. """
+
+    def setUp(self):
+        draw_cache.get_draw_cache().clear()
+        add_teams(6, random.Random(0))
+        self.today = timezone.localdate()
+
+    def assertDrawCached(self, cached=True):
+        with CaptureQueriesContext(connection) as context:
+            draw = draw_cache.get_draw(self.today)
+        # The draw is cached in the database, so reading the cache is a query
+        cache_table = settings.CACHES[settings.DRAW_CACHE_ALIAS]['LOCATION']
+        draw_queries = [query['sql'] for query in context.captured_queries
+                        if cache_table not in query['sql'] and query['sql'] != 'BEGIN']
+        self.assertEqual(cached, not draw_queries, draw_queries)
+        self.assertEqual(draw, draw_cache.build_draw(self.today))
+        return draw
+
+    def test_invalidation(self):
+        self.assertDrawCached(False)
+        self.assertDrawCached()
+
+        debate = Debate.objects.filter(match_day__date=self.today).first()
+        judge = Speaker.objects.exclude(debate=debate).first()
+        debate.judges.add(judge)
+        self.assertIn(judge.name, self.assertDrawCached(False)[0]['judges'])
+
+        debate.room = Room.objects.create(date=self.today, name="New room")
+        debate.save()
+        self.assertDrawCached(False)
+
+        team = debate.affirmative.team
+        team.name = "Renamed team"
+        team.save()
+        self.assertEqual("Renamed team", self.assertDrawCached(False)[0]['team1']['name'])
+        team.judged_before = True
+        team.save()
+        self.assertDrawCached()
+
+        # Past debates are not on today's draw
+        Debate.objects.exclude(match_day__date=self.today).first().delete()
+        self.assertDrawCached()
+
+        MatchDay.objects.filter(date=self.today).delete()
+        self.assertEqual([], self.assertDrawCached(False))
+        self.assertEqual([], self.client.get(reverse('baseapp:draw_json')).json()['debates'])
+
+        allocator.generate_debates(self.today, rng=random.Random(0))
+        self.assertTrue(self.assertDrawCached(False))
+        self.assertDrawCached()
+
+    def test_rollback(self):
+        self.assertDrawCached(False)
+        room = Room.objects.create(date=self.today, name="New room")
+        self.assertDrawCached(False)
+
+        # Nothing changed, so nothing is invalidated - not even by the next commit
+        with self.assertRaises(ValueError):
+            with transaction.atomic():
+                room.name = "Renamed room"
+                room.save()
+                raise ValueError
+        with transaction.atomic():
+            Room.objects.create(date=self.today - datetime.timedelta(days=1), name="Past room")
+        self.assertDrawCached()
+
+        # A savepoint rolled back takes its dates with it, not the rest of the transaction
+        with transaction.atomic():
+            try:
+                with transaction.atomic():
+                    room.save()
+                    raise ValueError
+            except ValueError:
+                pass
+            Room.objects.create(date=self.today - datetime.timedelta(days=1), name="Other past room")
+        self.assertDrawCached()
+        with transaction.atomic():
+            try:
+                with transaction.atomic():
+                    room.save()
+                    raise ValueError
+            except ValueError:
+                pass
+            room.save()
+        self.assertDrawCached(False)
+
+    def test_conditional_get(self):
+        url = reverse('baseapp:draw_json_for_date', args=(self.today.isoformat(),))
+        response = self.client.get(url)
+        self.assertEqual(200, response.status_code)
+        draw = response.json()
+        self.assertEqual(self.today.isoformat(), draw['date'])
+        debate = Debate.objects.get(pk=draw['debates'][0]['id'])
+        self.assertEqual(debate.affirmative.team.name, draw['debates'][0]['affirmative']['team'])
+        self.assertEqual(sorted(judge.pk for judge in debate.judges.all()),
+                         sorted(judge['id'] for judge in draw['debates'][0]['judges']))
+
+        etag, last_modified = response['ETag'], response['Last-Modified']
+        self.assertEqual(304, self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code)
+        self.assertEqual(304, self.client.get(url, HTTP_IF_MODIFIED_SINCE=last_modified).status_code)
+
+        debate.judges.clear()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(200, response.status_code)
+        self.assertNotEqual(etag, response['ETag'])
+        self.assertEqual([], response.json()['debates'][0]['judges'])
+
+        self.assertEqual(404, self.client.get(reverse('baseapp:draw_json_for_date', args=('tomorrow',))).status_code)
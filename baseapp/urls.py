@@ -7,6 +7,8 @@ urlpatterns = [
     path('', views.index, name='index'),
     path('draw/', views.debates, name='debates'),
     path('draw/<int:debate_id>/', views.detail, name='debate_detail'),
+    path('api/v1/draw/', views.draw_json, name='draw_json'),
+    path('api/v1/draw/<str:date_string>/', views.draw_json, name='draw_json_for_date'),
     path('signupform/', views.signupform, name='signupform'),
     path('attendanceform/', views.attendanceform, name='attendanceform'),
     # path('table/', views.table, name='table'),
@@ -14,6 +16,7 @@ urlpatterns = [
     path('simulate-rounds/', views.simulate_rounds, name='simulate_rounds'),
 
     path('generate-debates', views.generate_debates, name="generate_debates"),
+    path('preview-debates', views.preview_debates, name="preview_debates"),
     path('ajax/filter_speakers_in_team/', views.filter_speakers_in_team, name="filter_speakers_in_team"),
     path('ajax/filter_debate_details', views.filter_debate_details, name="filter_debate_details"),
 ]
\ No newline at end of file
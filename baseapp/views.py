@@ -1,16 +1,22 @@
 from django.shortcuts import render, get_object_or_404
-from django.http import HttpResponse, JsonResponse, HttpResponseRedirect
+from django.http import Http404, HttpResponse, JsonResponse, HttpResponseRedirect
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import http_date, quote_etag
+from django.views.decorators.http import require_safe
 from datetime import date, datetime, timedelta
 from django.utils import timezone
-from . import allocator
+from . import allocator, draw_cache, search
 from .forms import TeamAttendanceForm, TeamSignupForm, DebateResultsForm, ScoreForm
 from .models import Attendance, Speaker, Team, Score, Debate, MatchDay
-from .exceptions import NotEnoughJudgesException, CannotFindWorkingConfigurationException, NotEnoughAttendancesException, NotEnoughRoomsException
-from django.core.exceptions import ObjectDoesNotExist
+from .exceptions import NotEnoughJudgesException, CannotFindWorkingConfigurationException, NotEnoughAttendancesException, NotEnoughRoomsException, \
+    DrawSearchTimeoutException
 from django.contrib import messages
+from django.contrib.admin.views.decorators import staff_member_required
 from django.urls import reverse
 from operator import itemgetter
 from itertools import chain
+import random
+from .pairing import PAIRING_STRATEGIES
 
 def stringify(l):
     """ Concatenates list of strings into a comma-separated string. """
@@ -25,39 +31,42 @@ def index(request):
     return render(request, 'baseapp/index.html')
 
 def debates(request):
-    # Check if debates are finalised
-    try:
-        match_day = MatchDay.objects.get(date=timezone.localdate())
-        debates = list(match_day.debate_set.all())
-    except ObjectDoesNotExist:
-        debates = []
-
+    # The draw is cached until it changes, as everyone loads it when it is released
     context = {
-        'debates': []
+        'debates': draw_cache.get_draw(timezone.localdate())
     }
-
-    for debate in debates:
-
-        context['debates'].append({
-            'debate_id': debate.id,
-            'room': debate.room.name if debate.room else '',
-            'team1': {
-                'name': debate.affirmative.team.name,
-                'speakers': debate.affirmative.speakers.all()
-            },
-            'team2': {
-                'name': debate.negative.team.name,
-                'speakers': debate.negative.speakers.all()
-            },
-            'judges': stringify([judge.name for judge in debate.judges.all()])
-        })
-
     return render(request, 'baseapp/debates.html', context)
 
+@require_safe
+def draw_json(request, date_string=None):
+    """
+    Returns the draw for the given date (YYYY-MM-DD), or today, as JSON from
+    the draw cache. Polls with the ETag or Last-Modified of the draw they
+    have get a 304 response if it has not changed since.
+    """
+    if date_string is None:
+        draw_date = timezone.localdate()
+    else:
+        try:
+            draw_date = date.fromisoformat(date_string)
+        except ValueError:
+            raise Http404(f"Invalid date: {date_string} - use YYYY-MM-DD.")
+    entry = draw_cache.get_draw_entry(draw_date)
+
+    response = get_conditional_response(request, etag=quote_etag(entry['etag']),
+                                         last_modified=entry['last_modified'])
+    if response is None:
+        response = HttpResponse(entry['json'], content_type='application/json')
+    response['ETag'] = quote_etag(entry['etag'])
+    response['Last-Modified'] = http_date(entry['last_modified'])
+    # Clients should check with the server before reusing the draw they have
+    patch_cache_control(response, no_cache=True)
+    return response
+
 def detail(request, debate_id: int):
     # return HttpResponse(f"You are looking at debate {debate_id}.")
     # Get debate based on debate_id
-    debate = get_object_or_404(Debate, pk=debate_id)
+    debate = get_object_or_404(Debate.objects.select_related('affirmative__team', 'negative__team'), pk=debate_id)
 
     context = {
         'debate_id': debate.id,
@@ -85,7 +94,9 @@ def attendanceform(request):
                 team=form.cleaned_data["team"],
                 date=timezone.localdate(),
                 defaults={
-                    'want_to_judge': form.cleaned_data["want_to_judge"]
+                    'want_to_judge': form.cleaned_data["want_to_judge"],
+                    # Marking attendance again after withdrawing brings the team back
+                    'withdrawn': False,
                 }
             )
             attendance.speakers.set(form.cleaned_data["speakers"])
@@ -148,8 +159,8 @@ def signupform(request):
     return render(request, 'baseapp/signupform.html', context)
 
 def table(request):
-    # Gets all the teams
-    teams = list(Team.objects.all())
+    # Gets all the teams, with their standings
+    teams = Team.objects.select_related('standing')
 
     sorting_list = []
     for team in teams:
@@ -160,8 +171,8 @@ def table(request):
         team = item[2]
         sorted_teams.append({
             'name': team.name,
-            'wins': team.get_wins(),
-            'speaker_avg_score': "%.2f" % team.get_speakers_avg_score(),
+            'wins': item[0],
+            'speaker_avg_score': "%.2f" % item[1],
         })
     context = {
         'teams': sorted_teams,
@@ -284,9 +295,7 @@ def filter_speakers_in_team(request):
         "speakers": [],
     }
     if (team_id is not None) and team_id != '':
-        team = Team.objects.get(pk=team_id)
-        for speaker in team.speaker_set.all():
-            data["speakers"].append(speaker.id)
+        data["speakers"] = list(Speaker.objects.filter(team=team_id).values_list('pk', flat=True))
     return JsonResponse(data)
 
 def filter_debate_details(request):
@@ -296,7 +305,8 @@ def filter_debate_details(request):
         'speakers': []
     }
     if (debate_id is not None) and debate_id != '':
-        debate = Debate.objects.get(pk=debate_id)
+        debate = Debate.objects.select_related('affirmative__team', 'negative__team')\
+                    .prefetch_related('affirmative__speakers__team', 'negative__speakers__team').get(pk=debate_id)
         data['teams'] = [attendance.team.id for attendance in debate.get_attendances()]
         for attendance in debate.get_attendances():
             data['speakers'] += [
@@ -309,6 +319,94 @@ def filter_debate_details(request):
             ]
     return JsonResponse(data)
 
+def _format_phases(recorder):
+    """
+    Returns the phases recorded while making a draw as (name, milliseconds,
+    queries, milliseconds in the database) tuples for the preview page, or
+    None if the draw was not profiled (see profiling.is_profiling_enabled).
+    """
+    if recorder is None:
+        return None
+    return [(name, totals['time'] * 1000, totals['queries'], totals['db_time'] * 1000)
+            for name, totals in recorder.phases.items()]
+
+def _format_draw(draw):
+    """ Formats a DrawResult for the list_debates template. """
+    return [
+        {
+            'room': debate.room.name if debate.room else '',
+            'team1': {
+                'name': debate.affirmative.team.name,
+                'speakers': debate.affirmative.speakers.all()
+            },
+            'team2': {
+                'name': debate.negative.team.name,
+                'speakers': debate.negative.speakers.all()
+            },
+            'judges': stringify([judge.name for judge in panel])
+        }
+        for debate, panel in draw
+    ]
+
+def _get_draw_options(params):
+    """
+    Returns the (seed, strategy) to generate a draw with from the request parameters given.
+    A new random seed is chosen if none is given.
+    """
+    strategy = params.get('strategy', 'greedy')
+    if strategy not in PAIRING_STRATEGIES:
+        strategy = 'greedy'
+    try:
+        seed = int(params['seed'])
+    except (KeyError, ValueError):
+        seed = random.randrange(2 ** 32)
+    return seed, strategy
+
+# Session key of the draw last previewed (see preview_debates)
+DRAW_PREVIEW_SESSION_KEY = 'draw_preview'
+
+@staff_member_required(login_url='myadmin:login')
+def preview_debates(request):
+    if MatchDay.objects.filter(date=timezone.localdate()).exists():
+        messages.warning(
+            request,
+            "Debates already generated. Please select the matchday for today below to edit the debates."
+        )
+        return HttpResponseRedirect("/admin/baseapp/matchday/")
+
+    seed, strategy = _get_draw_options(request.GET)
+    try:
+        if request.GET.get('search'):
+            # Pick the best of several candidate draws instead
+            draw = search.search_debates(date=timezone.localdate(), seed=seed)
+            seed, strategy = draw.seed, draw.strategy
+        else:
+            draw = allocator.preview_debates(date=timezone.localdate(), rng=random.Random(seed),
+                                             strategy=strategy)
+    except (NotEnoughAttendancesException, NotEnoughJudgesException, NotEnoughRoomsException,
+                CannotFindWorkingConfigurationException, DrawSearchTimeoutException) as e:
+        messages.error(request, str(e))
+        return HttpResponseRedirect("/admin/baseapp/matchday/")
+
+    # Remembered so that generate_debates only saves this draw
+    request.session[DRAW_PREVIEW_SESSION_KEY] = {
+        'date': draw.date.isoformat(),
+        'seed': seed,
+        'strategy': strategy,
+        'fingerprint': draw.get_fingerprint(),
+    }
+    context = {
+        'date': draw.date,
+        'debates': _format_draw(draw),
+        'metrics': draw.metrics,
+        'phases': _format_phases(draw.phases),
+        'seed': seed,
+        'strategy': strategy,
+        'strategies': list(PAIRING_STRATEGIES),
+    }
+    return render(request, 'baseapp/preview_debates.html', context)
+
+@staff_member_required(login_url='myadmin:login')
 def generate_debates(request):
     match_day = MatchDay.objects.filter(date=timezone.localdate())
     if match_day:
@@ -317,8 +415,22 @@ def generate_debates(request):
             "Debates already generated. Please select the matchday for today below to edit the debates."
         )
     else:
+        # The same seed and strategy as a preview gives the same draw as the preview,
+        # unless the attendances, rooms or history changed in between
+        seed, strategy = _get_draw_options(request.POST)
+        preview = request.session.get(DRAW_PREVIEW_SESSION_KEY, {})
+        preview_url = reverse('baseapp:preview_debates') + f"?seed={seed}&strategy={strategy}"
+        if (preview.get('date'), preview.get('seed'), preview.get('strategy')) != \
+                (timezone.localdate().isoformat(), seed, strategy):
+            messages.error(request, "Please preview the draw before saving it.")
+            return HttpResponseRedirect(preview_url)
         try:
-            match_day = allocator.generate_debates(date=timezone.localdate())
+            draw = allocator.preview_debates(date=timezone.localdate(), rng=random.Random(seed),
+                                             strategy=strategy)
+            if draw.get_fingerprint() != preview['fingerprint']:
+                messages.error(request, "The draw changed since it was previewed. Please preview it again.")
+                return HttpResponseRedirect(preview_url)
+            match_day = allocator.commit_draw(draw)
         except NotEnoughAttendancesException as nea:
             messages.error(request, str(nea))
         except NotEnoughJudgesException as nej:
@@ -328,6 +440,7 @@ def generate_debates(request):
         except CannotFindWorkingConfigurationException as e:
             messages.error(request, str(e))
         else:
+            del request.session[DRAW_PREVIEW_SESSION_KEY]
             messages.success(request, "Please review the debates generated, and click 'Save' once you are happy with the allocated debates.")
             return HttpResponseRedirect(f"/admin/baseapp/matchday/{match_day.id}/change/")
 
@@ -62,6 +62,22 @@ LOGGING = {
     }
 }
 
+# Record and log the time and queries of each phase of the allocator when
+# making a draw
+DRAW_PROFILING = DEBUG
+
+# Most worker processes a search for the best draw may use (see search.py)
+DRAW_SEARCH_MAX_WORKERS = 2
+
+# What the allocator ranks teams by - 'wins' (then speaker averages) or 'rating'
+DRAW_RANKING = 'wins'
+
+# Cache (in CACHES) the public draw is kept in until it changes, and for how
+# many seconds at most - it must be shared by all the workers, or they would
+# serve the draw they cached before it changed
+DRAW_CACHE_ALIAS = 'default'
+DRAW_CACHE_TIMEOUT = 60 * 60 * 24
+
 
 # Application definition
 
@@ -126,6 +142,19 @@ DATABASES = {
 }
 
 
+# Cache
+# https://docs.djangoproject.com/en/2.1/topics/cache/#database-caching
+
+# Kept in the database so that all the workers share it - create the table
+# with 'python manage.py createcachetable'
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+        'LOCATION': 'django_cache',
+    }
+}
+
+
 # Password validation
 # https://docs.djangoproject.com/en/2.1/ref/settings/#auth-password-validators
 
@@ -171,6 +200,13 @@ STATICFILES_DIRS = [
 # Activate Django-Heroku.
 django_heroku.settings(locals())
 
+# Log the teams moved apart for vetoes, and the draw timings when
+# debugging, with the console handler set up by Django-Heroku
+LOGGING['loggers']['baseapp'] = {
+    'handlers': ['console'],
+    'level': 'DEBUG' if DEBUG else 'INFO',
+}
+
 # Database on Heroku
 import dj_database_url
 DATABASES['default'] = dj_database_url.config(conn_max_age=600, ssl_require=True)